@@ -0,0 +1,374 @@
+import argparse
+import json
+import os
+import platform
+import subprocess
+import sys
+import tempfile
+import time
+import multiprocessing
+import queue as queue_module
+import traceback
+import numpy as np
+
+# 整条处理流程的基准测试。仓库里的TIFF是LFS指针，干净的checkout里没有真实数据，
+# 所以这里先生成和DMSP类似的合成栅格（大小、nodata分布、CRS都可以设置）以及合成的省、市多边形，
+# 再把每一步分开计时：切割、省级和市级的分区统计、以及main.py里的数据准备（整合长表、GeoJSON、3D图层）。
+# startup这一步不用合成数据，测的是一个全新进程导入main.py的时间，也就是streamlit新起一个worker的冷启动。
+# 每一步都在单独的子进程里跑，这样内存峰值是这一步自己的；结果写成JSON，方便和以前的结果对比
+
+CHINA_BOUNDS = (73.0, 18.0, 135.0, 54.0)
+NODATA = -128
+# 等子进程结果的时候，每隔这么多秒看一下子进程是不是还活着
+POLL_SECONDS = 1.0
+STAGES = ("startup", "preprocess", "zonal_provinces", "zonal_cities", "consolidate", "geojson", "layer_3d")
+# 冷启动的时候不应该被导入的重量级库，startup这一步会报告其中哪些被导入了
+HEAVY_MODULES = ("geopandas", "folium", "streamlit_folium", "pydeck", "matplotlib", "plotly")
+
+
+# ---------- 合成数据 ----------
+
+def raster_grid(width, height, crs):
+    from rasterio.transform import from_bounds
+    from rasterio.warp import transform_bounds
+    bounds = CHINA_BOUNDS if crs == "EPSG:4326" else transform_bounds("EPSG:4326", crs, *CHINA_BOUNDS)
+    return from_bounds(*bounds, width, height), bounds
+
+
+def nodata_mask(shape, pattern, fraction, rng):
+    height, width = shape
+    if pattern == "none":
+        return np.zeros(shape, dtype=bool)
+    if pattern == "random":
+        return rng.random(shape) < fraction
+    if pattern == "border":
+        # 四周一圈nodata，像原始数据里国界以外的部分
+        mask = np.zeros(shape, dtype=bool)
+        band_h, band_w = int(height * fraction / 2), int(width * fraction / 2)
+        mask[:band_h, :] = mask[height - band_h:, :] = True
+        mask[:, :band_w] = mask[:, width - band_w:] = True
+        return mask
+    if pattern == "blocks":
+        # 随机的矩形空洞，像云遮挡或者缺失的条带
+        mask = np.zeros(shape, dtype=bool)
+        target = fraction * height * width
+        while mask.sum() < target:
+            h, w = rng.integers(1, max(2, height // 8)), rng.integers(1, max(2, width // 8))
+            r, c = rng.integers(0, height - h + 1), rng.integers(0, width - w + 1)
+            mask[r:r + h, c:c + w] = True
+        return mask
+    raise ValueError(f"不支持的nodata模式: {pattern}")
+
+
+def make_synthetic_raster(path, width, height, crs="EPSG:4326", year=2000, nodata_pattern="border",
+                          nodata_fraction=0.1, seed=0, block_size=256):
+    import rasterio
+    rng = np.random.default_rng(seed + year)
+    transform, _ = raster_grid(width, height, crs)
+    # 灯光值0-63，少数“城市”亮斑加上随年份增长的趋势
+    values = rng.gamma(0.6, 4.0, size=(height, width))
+    for _ in range(max(1, width * height // 200000)):
+        r, c = rng.integers(0, height), rng.integers(0, width)
+        radius = rng.integers(3, 30)
+        values[max(0, r - radius):r + radius, max(0, c - radius):c + radius] += 40
+    values = np.clip(values * (1 + 0.02 * (year - 1992)), 0, 63).astype(np.int16)
+    values[nodata_mask(values.shape, nodata_pattern, nodata_fraction, rng)] = NODATA
+    profile = {
+        "driver": "GTiff", "width": width, "height": height, "count": 1, "dtype": "int16",
+        "crs": crs, "transform": transform, "nodata": NODATA,
+        "tiled": True, "blockxsize": block_size, "blockysize": block_size,
+    }
+    with rasterio.open(path, "w", **profile) as dst:
+        dst.write(values, 1)
+    return path
+
+
+def make_synthetic_zones(n_zones, seed=0):
+    # 在中国范围内随机撒点，用泰森多边形生成互不重叠、铺满整个范围的“行政区”
+    import geopandas as gpd
+    import shapely
+    rng = np.random.default_rng(seed)
+    minx, miny, maxx, maxy = CHINA_BOUNDS
+    points = shapely.multipoints(np.column_stack([rng.uniform(minx, maxx, n_zones),
+                                                  rng.uniform(miny, maxy, n_zones)]))
+    extent = shapely.box(*CHINA_BOUNDS)
+    cells = shapely.get_parts(shapely.voronoi_polygons(points, extend_to=extent))
+    cells = shapely.intersection(cells, extent)
+    names = [f"Zone{i}" for i in range(len(cells))]
+    return gpd.GeoDataFrame({"省": names, "ENG_NAME": names, "NAME": names},
+                            geometry=list(cells), crs="EPSG:4326")
+
+
+def make_dataset(work_dir, config):
+    tif_dir = os.path.join(work_dir, "tifs")
+    os.makedirs(tif_dir, exist_ok=True)
+    for year in config["years"]:
+        prefix = "DMSP" if year <= 2013 else "DMSP-like"
+        make_synthetic_raster(os.path.join(tif_dir, f"{prefix}{year}.tif"), config["width"], config["height"],
+                              crs=config["crs"], year=year, nodata_pattern=config["nodata_pattern"],
+                              nodata_fraction=config["nodata_fraction"], seed=config["seed"])
+    provinces = make_synthetic_zones(config["n_provinces"], seed=config["seed"])
+    cities = make_synthetic_zones(config["n_cities"], seed=config["seed"] + 1)
+    provinces.to_file(os.path.join(work_dir, "provinces.shp"), encoding="utf-8")
+    cities.to_file(os.path.join(work_dir, "cities.shp"), encoding="utf-8")
+
+
+# ---------- 各个阶段 ----------
+# 每个阶段返回一个字典，写明这一步处理了多少像元、多少区域，用来算吞吐量
+
+def _tif_files(work_dir, folder="tifs", pattern="*.tif"):
+    import glob
+    return sorted(glob.glob(os.path.join(work_dir, folder, pattern)))
+
+
+def _pixel_count(tif_files):
+    import rasterio
+    total = 0
+    for path in tif_files:
+        with rasterio.open(path) as src:
+            total += src.width * src.height
+    return total
+
+
+def stage_startup(work_dir, config):
+    # 在全新的Python进程里导入main.py，记下导入用了多久、整个进程用了多久，以及哪些重量级库被导入了
+    script = ("import json, sys, time; start = time.perf_counter(); import main; "
+              "print(json.dumps([time.perf_counter() - start, "
+              f"[name for name in {HEAVY_MODULES!r} if name in sys.modules]]))")
+    start = time.perf_counter()
+    completed = subprocess.run([sys.executable, "-c", script], cwd=os.path.dirname(os.path.abspath(__file__)),
+                               capture_output=True, text=True, check=True)
+    process_s = time.perf_counter() - start
+    import_s, loaded = json.loads(completed.stdout.strip().splitlines()[-1])
+    return {"import_s": import_s, "process_s": process_s, "heavy_modules_loaded": loaded}
+
+
+def stage_preprocess(work_dir, config):
+    import data_preprocessing
+    tif_files = _tif_files(work_dir)
+    data_preprocessing.preprocess(tif_files, os.path.join(work_dir, "provinces.shp"),
+                                  os.path.join(work_dir, "clipped"), workers=config["workers"],
+                                  force=True, tile_budget_mb=config["tile_budget_mb"])
+    return {"pixels": _pixel_count(tif_files)}
+
+
+def _zonal_stage(work_dir, config, script, shp_name, store_name):
+    tif_files = _tif_files(work_dir, "clipped", "clipped_*.tif")
+    script.run(shp_path=os.path.join(work_dir, shp_name), tiff_path=os.path.join(work_dir, "clipped"),
+               output_dir=os.path.join(work_dir, "ntl_store", store_name), tile_budget_mb=config["tile_budget_mb"])
+    import ntl_store
+    n_zones = len(ntl_store.read_zone_attributes(os.path.join(work_dir, "ntl_store", store_name), columns=[]))
+    return {"pixels": _pixel_count(tif_files), "zones": n_zones * len(tif_files)}
+
+
+def stage_zonal_provinces(work_dir, config):
+    import provinces_nightlight
+    return _zonal_stage(work_dir, config, provinces_nightlight, "provinces.shp", "provinces")
+
+
+def stage_zonal_cities(work_dir, config):
+    import cities_nightlight
+    return _zonal_stage(work_dir, config, cities_nightlight, "cities.shp", "cities")
+
+
+def stage_consolidate(work_dir, config):
+    # 对应main.py里的数据模型和趋势动画的帧
+    import ntl_model
+    import trend_animation
+    store_dir = os.path.join(work_dir, "ntl_store", "provinces")
+    model = ntl_model.load_model(store_dir)
+    years, zone_names, matrix = model.trend_series("省")
+    figure = trend_animation.build_trend_figure(years, zone_names, matrix)
+    payload = figure.to_json()
+    return {"zones": model.values.size, "bytes": len(payload)}
+
+
+def stage_geojson(work_dir, config):
+    # 对应main.py的2D地图：简化几何一次，然后每一年挂上数值并序列化
+    import ntl_store
+    import geometry_tiers
+    store_dir = os.path.join(work_dir, "ntl_store", "cities")
+    zones = ntl_store.read_zones(store_dir)
+    tier = geometry_tiers.build_tier_geojson(zones, geometry_tiers.TIERS["low"])
+    stats_df = ntl_store.read_stats(store_dir, stats=("mean",))
+    total_bytes = 0
+    for year, values in stats_df.groupby("year"):
+        geo_data = geometry_tiers.attach_values(tier, values.set_index("zone_id")[["mean"]])
+        total_bytes += len(json.dumps(geo_data))
+    return {"zones": len(stats_df), "bytes": total_bytes}
+
+
+def stage_layer_3d(work_dir, config):
+    # 对应main.py的3D地图：外环只拆一次，每一年换数值和颜色
+    import ntl_store
+    import map_layers
+    store_dir = os.path.join(work_dir, "ntl_store", "cities")
+    zones = ntl_store.read_zones(store_dir)
+    rings = map_layers.polygon_rings(zones)
+    stats_df = ntl_store.read_stats(store_dir, stats=("mean",))
+    for year, values in stats_df.groupby("year"):
+        map_layers.polygon_layer_data(rings, values.set_index("zone_id")[["mean"]], "mean", "YlOrRd")
+    return {"zones": len(stats_df)}
+
+
+STAGE_FUNCTIONS = {
+    "startup": stage_startup,
+    "preprocess": stage_preprocess,
+    "zonal_provinces": stage_zonal_provinces,
+    "zonal_cities": stage_zonal_cities,
+    "consolidate": stage_consolidate,
+    "geojson": stage_geojson,
+    "layer_3d": stage_layer_3d,
+}
+
+
+# ---------- 计时和内存 ----------
+
+def peak_rss_bytes():
+    # 本进程和它已结束的子进程（比如切割用的进程池）中最大的常驻内存
+    try:
+        import resource
+    except ImportError:
+        try:
+            import psutil
+            return psutil.Process().memory_info().peak_wset
+        except (ImportError, AttributeError):
+            return None
+    scale = 1 if sys.platform == "darwin" else 1024
+    return max(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss,
+               resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss) * scale
+
+
+def _run_stage_in_child(stage, work_dir, config, queue):
+    sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+    start = time.perf_counter()
+    try:
+        counts = STAGE_FUNCTIONS[stage](work_dir, config)
+    except Exception:
+        # 异常也要送回去，不然父进程会一直等下去
+        queue.put({"error": traceback.format_exc()})
+        return
+    wall = time.perf_counter() - start
+    queue.put({"wall_s": wall, "peak_rss_bytes": peak_rss_bytes(), **counts})
+
+
+def _wait_for_result(process, queue):
+    # 子进程被杀掉（比如内存不够被OOM killer杀掉）的时候什么也不会放进队列，所以不能一直阻塞在get上
+    while True:
+        try:
+            return queue.get(timeout=POLL_SECONDS)
+        except queue_module.Empty:
+            if not process.is_alive():
+                # 进程刚好在最后一次检查之前放好了结果再退出的情况
+                try:
+                    return queue.get_nowait()
+                except queue_module.Empty:
+                    return None
+
+
+def run_stage(stage, work_dir, config):
+    # 返回这一步的结果；失败的话结果里有error，说明是异常还是进程异常退出
+    context = multiprocessing.get_context("spawn")
+    queue = context.Queue()
+    process = context.Process(target=_run_stage_in_child, args=(stage, work_dir, config, queue))
+    process.start()
+    result = _wait_for_result(process, queue)
+    process.join()
+    if result is None:
+        result = {"error": f"子进程异常退出，退出码 {process.exitcode}"}
+    elif process.exitcode != 0 and "error" not in result:
+        result["error"] = f"子进程退出码 {process.exitcode}"
+    result["stage"] = stage
+    if "error" in result:
+        return result
+    if result.get("pixels"):
+        result["pixels_per_s"] = result["pixels"] / result["wall_s"]
+    if result.get("zones"):
+        result["zones_per_s"] = result["zones"] / result["wall_s"]
+    return result
+
+
+def git_revision():
+    try:
+        return subprocess.run(["git", "rev-parse", "HEAD"], capture_output=True, text=True,
+                              cwd=os.path.dirname(os.path.abspath(__file__))).stdout.strip() or None
+    except OSError:
+        return None
+
+
+def compare(results, baseline_path):
+    with open(baseline_path, "r", encoding="utf-8") as f:
+        baseline = {r["stage"]: r for r in json.load(f)["results"]}
+    print(f"{'阶段':<18}{'基准(s)':>10}{'本次(s)':>10}{'比值':>8}")
+    for result in results:
+        old = baseline.get(result["stage"])
+        if old is None or "wall_s" not in old or "wall_s" not in result:
+            continue
+        ratio = result["wall_s"] / old["wall_s"] if old["wall_s"] else float("nan")
+        print(f"{result['stage']:<18}{old['wall_s']:>10.3f}{result['wall_s']:>10.3f}{ratio:>8.2f}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="用合成数据对夜间灯光处理流程的各个阶段做基准测试")
+    parser.add_argument("--width", type=int, default=2000)
+    parser.add_argument("--height", type=int, default=1200)
+    parser.add_argument("--years", type=int, default=8, help="生成多少年的栅格（从1992年开始）")
+    parser.add_argument("--crs", default="EPSG:4326")
+    parser.add_argument("--nodata-pattern", choices=("none", "random", "border", "blocks"), default="border")
+    parser.add_argument("--nodata-fraction", type=float, default=0.1)
+    parser.add_argument("--provinces", type=int, default=34)
+    parser.add_argument("--cities", type=int, default=370)
+    parser.add_argument("--workers", type=int, default=None)
+    parser.add_argument("--tile-budget-mb", type=float, default=None)
+    parser.add_argument("--stages", nargs="+", choices=STAGES, default=list(STAGES))
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--work-dir", default=None, help="合成数据放在哪里，不指定就用临时目录")
+    parser.add_argument("--output", default="benchmark_results.json")
+    parser.add_argument("--compare", default=None, help="和之前的一次结果对比")
+    args = parser.parse_args()
+
+    config = {
+        "width": args.width, "height": args.height, "years": list(range(1992, 1992 + args.years)),
+        "crs": args.crs, "nodata_pattern": args.nodata_pattern, "nodata_fraction": args.nodata_fraction,
+        "n_provinces": args.provinces, "n_cities": args.cities, "workers": args.workers,
+        "tile_budget_mb": args.tile_budget_mb, "seed": args.seed,
+    }
+
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        work_dir = args.work_dir or tmp_dir
+        results = []
+        # 阶段之间有先后依赖，所以总是按固定顺序跑，没选中的阶段如果被后面依赖也会先跑一遍但不记录
+        needed = STAGES[:max(STAGES.index(stage) for stage in args.stages) + 1]
+        if set(needed) - {"startup"}:
+            make_dataset(work_dir, config)
+        for stage in needed:
+            if stage == "startup" and stage not in args.stages:
+                continue
+            result = run_stage(stage, work_dir, config)
+            if "error" in result:
+                # 后面的阶段都依赖前面的输出，有一步失败就不再往下跑了，已有的结果照样写出去
+                results.append(result)
+                print(f"{stage:<18}失败\n{result['error']}", file=sys.stderr)
+                break
+            if stage in args.stages:
+                results.append(result)
+                print(f"{stage:<18}{result['wall_s']:>10.3f} s")
+
+    report = {
+        "timestamp": time.strftime("%Y-%m-%dT%H:%M:%S"),
+        "git_revision": git_revision(),
+        "python": platform.python_version(),
+        "platform": platform.platform(),
+        "config": config,
+        "results": results,
+    }
+    with open(args.output, "w", encoding="utf-8") as f:
+        json.dump(report, f, ensure_ascii=False, indent=2)
+    if args.compare:
+        compare(results, args.compare)
+    if any("error" in result for result in results):
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
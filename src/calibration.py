@@ -0,0 +1,221 @@
+import argparse
+import glob
+import os
+from contextlib import ExitStack
+import numpy as np
+import rasterio
+from rasterio.enums import Resampling
+from rasterio.vrt import WarpedVRT
+from manifest import file_fingerprint, load_manifest, save_manifest
+from raster_windows import iter_tile_windows, tile_budget_to_pixels
+from zonal_engine import grid_key, valid_pixel_mask, year_from_path, DEFAULT_NODATA
+
+# DMSP（1992-2013）和类DMSP（2014-2023，由VIIRS数据转换来的）两个传感器的数据直接放在一起用，
+# 趋势图在2013和2014之间会有一个明显的跳变；DMSP各颗卫星之间、同一颗卫星不同年份之间也有系统偏差。
+# 这里用“不变区域法”做相互校正：先找出在各自传感器的年份里一直亮着、亮度又很稳定、没有饱和的像元，
+# 认为这些地方真实的灯光没有变化，然后对每一年拟合一个二次多项式 参考年 = a + b·DN + c·DN²，
+# 把所有年份都校正到参考年（默认是DMSP的最后一年）的水平上。
+# 拟合和应用都是按块读、向量化计算的：拟合时每块只累加最小二乘的正规方程，不用保存任何像元；
+# 应用时每块直接套多项式。校正结果写在切割结果旁边，文件名前缀是calibrated_
+
+abspath = os.path.dirname(os.path.abspath(__file__))
+tiff_path = os.path.join(abspath, "regions_excluded_tiffs")
+coefficients_file_name = "calibration_coefficients.json"
+DEFAULT_REFERENCE_YEAR = "2013"
+# 不变像元的条件：在自己传感器的每一年都亮（DN大于MIN_DN），变异系数小于MAX_CV，DMSP的值没有饱和
+MIN_DN = 3.0
+MAX_CV = 0.1
+DMSP_SATURATION = 63.0
+# 拟合一年至少需要这么多不变像元，少于这个数就不校正这一年
+MIN_PIXELS = 100
+DEFAULT_BUDGET_MB = 256
+# 重新拟合出来的系数和上次的差别都在这个范围内，就认为这一年没变，不重写它的calibrated_*.tif
+COEFFICIENT_TOLERANCE = 1e-4
+# 校正的算法改了（比如背景像元的处理），旧的calibrated_*.tif就算系数没变也要重写
+METHOD_VERSION = 2
+
+
+def sensor_of(path):
+    return "DMSP-like" if "DMSP-like" in os.path.basename(path) else "DMSP"
+
+
+def calibrated_path_for(clipped_path):
+    folder, base_name = os.path.split(clipped_path)
+    if base_name.startswith("clipped_"):
+        base_name = base_name[len("clipped_"):]
+    return os.path.join(folder, "calibrated_" + base_name)
+
+
+def coefficients_path(folder):
+    return os.path.join(folder, coefficients_file_name)
+
+
+def _aligned_reader(stack, src, reference, nodata):
+    # 和参考年不在同一个格网上的年份，按参考格网重采样后再读；WarpedVRT交给stack，读完一起关掉
+    if grid_key(src) == grid_key(reference):
+        return src
+    return stack.enter_context(WarpedVRT(src, crs=reference.crs, transform=reference.transform,
+                                         width=reference.width, height=reference.height,
+                                         resampling=Resampling.nearest, src_nodata=nodata, nodata=nodata))
+
+
+def _nodata_of(src):
+    return src.nodata if src.nodata is not None else DEFAULT_NODATA
+
+
+def invariant_mask(stack, sensor_groups, min_dn=MIN_DN, max_cv=MAX_CV):
+    # stack是 (年份, 行, 列)，NaN是没有数据。每个传感器的年份分别判断，所有条件都满足的才算不变像元
+    invariant = np.ones(stack.shape[1:], dtype=bool)
+    for sensor, rows in sensor_groups.items():
+        group = stack[rows]
+        with np.errstate(invalid="ignore", divide="ignore"):
+            mean = group.mean(axis=0)
+            cv = group.std(axis=0) / mean
+            invariant &= np.all(group > min_dn, axis=0) & (cv < max_cv)
+            if sensor == "DMSP":
+                invariant &= np.all(group < DMSP_SATURATION, axis=0)
+    return invariant
+
+
+def _normal_equations(values, target):
+    # 二次多项式最小二乘的正规方程 XᵀX 和 Xᵀy，X的三列是 1、DN、DN²
+    powers = np.stack([values ** k for k in range(5)])
+    sums = powers.sum(axis=1)
+    xtx = np.array([[sums[i + j] for j in range(3)] for i in range(3)])
+    xty = np.array([(powers[k] * target).sum() for k in range(3)])
+    return xtx, xty
+
+
+def fit_coefficients(tif_paths, reference_year=DEFAULT_REFERENCE_YEAR, budget_mb=DEFAULT_BUDGET_MB,
+                     min_dn=MIN_DN, max_cv=MAX_CV, min_pixels=MIN_PIXELS):
+    # 返回 {年份: {"coefficients": [a, b, c], "pixels": 不变像元数}}
+    tif_paths = sorted((p for p in tif_paths if year_from_path(p)), key=year_from_path)
+    years = [year_from_path(p) for p in tif_paths]
+    if reference_year not in years:
+        raise ValueError(f"参考年{reference_year}不在输入的年份里")
+    ref_index = years.index(reference_year)
+    sensor_groups = {}
+    for i, path in enumerate(tif_paths):
+        sensor_groups.setdefault(sensor_of(path), []).append(i)
+
+    xtx = np.zeros((len(years), 3, 3))
+    xty = np.zeros((len(years), 3))
+    counts = np.zeros(len(years), dtype=np.int64)
+    with ExitStack() as stack:
+        sources = [stack.enter_context(rasterio.open(p)) for p in tif_paths]
+        reference = sources[ref_index]
+        readers = [_aligned_reader(stack, src, reference, _nodata_of(src)) for src in sources]
+        # 每块要同时放下所有年份的数据，所以每块的像元数按年份数分摊
+        max_tile_pixels = max(1, tile_budget_to_pixels(budget_mb) // len(years))
+        for window in iter_tile_windows(reference, max_tile_pixels):
+            block = np.empty((len(years), int(window.height), int(window.width)), dtype=np.float64)
+            for t, (src, reader) in enumerate(zip(sources, readers)):
+                band = reader.read(1, window=window).astype(np.float64)
+                band[~valid_pixel_mask(band, _nodata_of(src))] = np.nan
+                block[t] = band
+            invariant = invariant_mask(block, sensor_groups, min_dn, max_cv)
+            if not invariant.any():
+                continue
+            target = block[ref_index][invariant]
+            for t in range(len(years)):
+                values = block[t][invariant]
+                block_xtx, block_xty = _normal_equations(values, target)
+                xtx[t] += block_xtx
+                xty[t] += block_xty
+                counts[t] += values.size
+
+    result = {}
+    for t, year in enumerate(years):
+        if t == ref_index or counts[t] < min_pixels:
+            # 参考年本身和不变像元太少的年份都不做校正
+            coefficients = [0.0, 1.0, 0.0]
+        else:
+            coefficients = np.linalg.lstsq(xtx[t], xty[t], rcond=None)[0].tolist()
+        result[year] = {"coefficients": coefficients, "pixels": int(counts[t]), "sensor": sensor_of(tif_paths[t])}
+    return result
+
+
+def apply_polynomial(band, coefficients, valid):
+    a, b, c = coefficients
+    values = band.astype(np.float32)
+    calibrated = a + values * (b + c * values)
+    # 校正以后不会有负的亮度
+    np.maximum(calibrated, 0, out=calibrated)
+    # 只校正有灯光的像元。DN是0的背景要保持0，否则截距a会让所有没有灯光的地方都变“亮”，
+    # 灯光面积、亮灭转换这些按阈值判断的指标就全错了
+    return np.where(valid & (values > 0), calibrated, values)
+
+
+def apply_calibration(tif_path, coefficients, budget_mb=DEFAULT_BUDGET_MB):
+    # 按块套用多项式，写到切割结果旁边；输出是float32，nodata沿用源文件的
+    output_path = calibrated_path_for(tif_path)
+    with rasterio.open(tif_path) as src:
+        nodata = _nodata_of(src)
+        profile = src.profile.copy()
+        profile.update(driver="GTiff", dtype="float32", nodata=nodata, tiled=True,
+                       blockxsize=256, blockysize=256, compress="deflate")
+        with rasterio.open(output_path, "w", **profile) as dst:
+            for window in iter_tile_windows(src, tile_budget_to_pixels(budget_mb)):
+                band = src.read(1, window=window)
+                dst.write(apply_polynomial(band, coefficients, valid_pixel_mask(band, nodata)), 1, window=window)
+    return output_path
+
+
+def _needs_rewrite(tif_path, entry, previous, fingerprints, tolerance):
+    # 输入文件、输出文件都在，系数也没有超出容差的变化，这一年的校正结果就不用重写
+    name = os.path.basename(tif_path)
+    old_entry = previous.get("years", {}).get(year_from_path(tif_path))
+    if old_entry is None or not os.path.exists(calibrated_path_for(tif_path)):
+        return True
+    if previous.get("inputs", {}).get(name) != fingerprints[name]:
+        return True
+    return not np.allclose(entry["coefficients"], old_entry["coefficients"], rtol=0, atol=tolerance)
+
+
+def calibrate(tif_paths, reference_year=DEFAULT_REFERENCE_YEAR, budget_mb=DEFAULT_BUDGET_MB, force=False,
+              tolerance=COEFFICIENT_TOLERANCE):
+    # 输入都没变就跳过。任何一年变了都要重新拟合，因为不变像元是由所有年份一起决定的；
+    # 但只重写系数真正变了（或者输入本身变了）的那几年，其他年份的calibrated_*.tif保留
+    tif_paths = sorted(tif_paths)
+    if not tif_paths:
+        return {}
+    folder = os.path.dirname(tif_paths[0])
+    fingerprints = {os.path.basename(p): file_fingerprint(p) for p in tif_paths}
+    previous = load_manifest(coefficients_path(folder))
+    outputs_exist = all(os.path.exists(calibrated_path_for(p)) for p in tif_paths)
+    if previous.get("reference_year") != reference_year or previous.get("method") != METHOD_VERSION:
+        previous = {}
+    if not force and outputs_exist and previous.get("inputs") == fingerprints:
+        return previous["years"]
+
+    coefficients = fit_coefficients(tif_paths, reference_year, budget_mb)
+    for tif_path in tif_paths:
+        entry = coefficients[year_from_path(tif_path)]
+        if force or _needs_rewrite(tif_path, entry, previous, fingerprints, tolerance):
+            apply_calibration(tif_path, entry["coefficients"], budget_mb)
+        else:
+            # 没重写的年份记下文件实际用的系数，小的变化不会一次次累积过容差
+            coefficients[year_from_path(tif_path)] = previous["years"][year_from_path(tif_path)]
+    save_manifest({"method": METHOD_VERSION, "reference_year": reference_year, "inputs": fingerprints,
+                   "years": coefficients},
+                  coefficients_path(folder))
+    return coefficients
+
+
+def main():
+    parser = argparse.ArgumentParser(description="DMSP和类DMSP夜间灯光数据的相互校正")
+    parser.add_argument("--input", default=tiff_path, help="切割结果所在的文件夹，校正结果也写在这里")
+    parser.add_argument("--reference-year", default=DEFAULT_REFERENCE_YEAR)
+    parser.add_argument("--budget-mb", type=float, default=DEFAULT_BUDGET_MB, help="每块的内存预算（MB）")
+    parser.add_argument("--force", action="store_true")
+    args = parser.parse_args()
+
+    tif_files = glob.glob(os.path.join(args.input, "clipped_*.tif"))
+    coefficients = calibrate(tif_files, args.reference_year, args.budget_mb, args.force)
+    for year, entry in sorted(coefficients.items()):
+        a, b, c = entry["coefficients"]
+        print(f"{year} {entry['sensor']:<10} a={a:.4f} b={b:.4f} c={c:.6f} 不变像元{entry['pixels']}个")
+
+
+if __name__ == "__main__":
+    main()
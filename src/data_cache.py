@@ -0,0 +1,182 @@
+import functools
+import hashlib
+import json
+import os
+import shutil
+import sys
+import threading
+from collections import OrderedDict
+import numpy as np
+from manifest import file_fingerprint
+import metrics
+
+# app用的进程级共享缓存。st.cache_data每次调用都要把所有参数哈希一遍，返回的还是一份拷贝，
+# 每个会话各存一份，也从来不淘汰。这里的缓存：
+#   - 以“数据集版本”作为键的一部分，版本就是底层文件的大小和修改时间的哈希，文件不变就一直命中，
+#     文件一变版本就变，旧版本的条目会被立刻丢掉
+#   - 整个进程只有一份，所有会话共用同一个对象
+#   - 条目数和总字节数都有上限，超出时按最近最少使用淘汰
+# 返回的对象是共享的，不能原地修改。DataFrame返回的是浅拷贝，配合pandas的copy-on-write，
+# 调用方加列、改值都只会影响自己那一份；numpy数组会被设成只读
+
+DEFAULT_MAX_ENTRIES = 128
+DEFAULT_MAX_BYTES = 1024 * 1024 * 1024
+# 磁盘缓存的版本子目录名取版本号的前这么多位
+DISK_VERSION_LENGTH = 16
+
+
+def files_version(*paths):
+    # 一组文件的版本号，只看大小和修改时间，每次只需要几次stat
+    fingerprints = {path: file_fingerprint(path) if os.path.exists(path) else None for path in paths}
+    return hashlib.sha1(json.dumps(fingerprints, sort_keys=True).encode("utf-8")).hexdigest()
+
+
+def directory_version(directory):
+    if not os.path.isdir(directory):
+        return files_version(directory)
+    paths = sorted(os.path.join(directory, name) for name in os.listdir(directory))
+    return files_version(*[path for path in paths if os.path.isfile(path)])
+
+
+# 磁盘上的缓存（切片、每年的数值数组）按数据版本分子目录存放：cache_dir/<版本>/...，数据一变就写到新的子目录里。
+# 还在用旧版本生成文件的线程只会写进旧版本的子目录，不会把旧数据写进新版本，
+# 删旧目录的时候也不会删到新版本正在写的文件。每个目录在本进程里第一次看到新版本时，把其他版本的子目录删掉
+_disk_versions = {}
+_disk_lock = threading.Lock()
+
+
+def version_dir(cache_dir, version):
+    return os.path.join(cache_dir, version[:DISK_VERSION_LENGTH])
+
+
+def use_disk_version(cache_dir, version):
+    # 返回这个版本的子目录
+    path = version_dir(cache_dir, version)
+    with _disk_lock:
+        if _disk_versions.get(cache_dir) == version:
+            return path
+        _disk_versions[cache_dir] = version
+    os.makedirs(path, exist_ok=True)
+    for name in os.listdir(cache_dir):
+        old_path = os.path.join(cache_dir, name)
+        if old_path != path and os.path.isdir(old_path):
+            shutil.rmtree(old_path, ignore_errors=True)
+    return path
+
+
+def estimate_bytes(value):
+    # NtlModel这种自己有nbytes的对象走下面的nbytes分支
+    if hasattr(value, "memory_usage") and hasattr(value, "columns"):
+        # deep=True才会算上字符串、category里的对象本身，不然每个对象只按一个指针8字节算，max_bytes基本管不住
+        total = int(value.memory_usage(index=True, deep=True).sum())
+        geometry_columns = [column for column in value.columns if str(value[column].dtype) == "geometry"]
+        if geometry_columns:
+            # 几何对象的大小pandas算不出来，和NtlModel.nbytes一样按坐标数粗略估计
+            import shapely
+            for column in geometry_columns:
+                total += int(shapely.get_num_coordinates(np.asarray(value[column].values)).sum()) * 16
+        return total
+    if isinstance(value, np.ndarray) or hasattr(value, "nbytes"):
+        return int(value.nbytes)
+    if isinstance(value, (str, bytes)):
+        return len(value)
+    return sys.getsizeof(value)
+
+
+def _freeze(value):
+    if isinstance(value, np.ndarray):
+        value.flags.writeable = False
+    return value
+
+
+def _share(value):
+    # DataFrame/GeoDataFrame每次给一个浅拷贝，底层数据不复制
+    if hasattr(value, "copy") and hasattr(value, "columns"):
+        return value.copy(deep=False)
+    return value
+
+
+class SharedCache:
+    def __init__(self, max_entries=DEFAULT_MAX_ENTRIES, max_bytes=DEFAULT_MAX_BYTES):
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+        self._loading = {}
+        self.total_bytes = 0
+        self.hits = 0
+        self.misses = 0
+
+    def _evict(self):
+        while self._entries and (len(self._entries) > self.max_entries or self.total_bytes > self.max_bytes):
+            _, (_, size) = self._entries.popitem(last=False)
+            self.total_bytes -= size
+
+    def _drop_stale(self, name, key, version):
+        # 同一个数据换了版本以后，旧版本的条目不会再被用到，直接删掉
+        for entry_key in [k for k in self._entries if k[0] == name and k[1] == key and k[2] != version]:
+            _, size = self._entries.pop(entry_key)
+            self.total_bytes -= size
+
+    def contains(self, name, key, version):
+        with self._lock:
+            return (name, key, version) in self._entries
+
+    def get_or_load(self, name, key, version, loader):
+        entry_key = (name, key, version)
+        with self._lock:
+            if entry_key in self._entries:
+                self._entries.move_to_end(entry_key)
+                self.hits += 1
+                metrics.count("cache_hits", loader=name)
+                return _share(self._entries[entry_key][0])
+            # 同一个键只让一个线程去加载，其他会话等它加载完直接用结果
+            load_lock = self._loading.setdefault(entry_key, threading.Lock())
+
+        with load_lock:
+            with self._lock:
+                if entry_key in self._entries:
+                    self._entries.move_to_end(entry_key)
+                    self.hits += 1
+                    metrics.count("cache_hits", loader=name)
+                    return _share(self._entries[entry_key][0])
+            metrics.count("cache_misses", loader=name)
+            try:
+                with metrics.span("cache_load", loader=name):
+                    value = _freeze(loader())
+                size = estimate_bytes(value)
+                with self._lock:
+                    self.misses += 1
+                    self._drop_stale(name, key, version)
+                    self._entries[entry_key] = (value, size)
+                    self.total_bytes += size
+                    self._evict()
+                    metrics.gauge("cache_bytes", self.total_bytes)
+            finally:
+                # 加载失败（数据目录、立方体还没生成）也要把这个键的锁去掉，不然每次失败的重跑都留下一把锁
+                with self._lock:
+                    self._loading.pop(entry_key, None)
+        return _share(value)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self.total_bytes = 0
+
+    def stats(self):
+        with self._lock:
+            return {"entries": len(self._entries), "bytes": self.total_bytes, "hits": self.hits, "misses": self.misses}
+
+
+shared_cache = SharedCache()
+
+
+def cached(version_of, cache=None):
+    # 装饰器：version_of用和被装饰函数相同的参数算出数据版本。参数本身要可以哈希（一般都是路径和年份这样的字符串）
+    def decorator(func):
+        @functools.wraps(func)
+        def wrapper(*args):
+            target = cache or shared_cache
+            return target.get_or_load(func.__qualname__, args, version_of(*args), lambda: func(*args))
+        return wrapper
+    return decorator
@@ -3,34 +3,54 @@ import rasterio
 from rasterio.mask import mask
 import os
 import glob
-import numpy as np
+import argparse
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from manifest import file_fingerprint, shapefile_fingerprint, load_manifest, save_manifest
+from raster_windows import mask_raster_windowed, tile_budget_to_pixels
+import metrics
 
 # 由于数据的TIFF文件有些有港澳台数据，有些没有，所以为了便于处理，在这个程序中我将所有TIFF文件的港澳台区域切割出来。
 # 要做到这一点，我的思路是用省级的shp文件，使用港澳台区域的属性字段把这三个区域筛选出来，进行掩膜切割
+#
+# 每个TIFF的切割互不相关，所以放到进程池里并行处理。掩膜的几何对每种CRS只投影一次。
+# 处理过的文件会记在输出目录的清单里，源TIFF和边界文件都没变的年份下次直接跳过。
+# 对于一次读不进内存的高分辨率栅格，可以用--tile-budget-mb按块流式切割
 
-shp_path = ".\\boundaries\\省级.shp"
-tif_folder_path = "."
-output_folder_path = ".\\regions_excluded_tiffs"
+abspath = os.path.dirname(os.path.abspath(__file__))
+shp_path = os.path.join(abspath, "boundaries", "省级.shp")
+tif_folder_path = abspath
+output_folder_path = os.path.join(abspath, "regions_excluded_tiffs")
 attribute_name = "ENG_NAME"
 regions_to_exclude = ["HongKong", "Aomen", "Taiwan"]
+manifest_file_name = "preprocess_manifest.json"
 
-gdf = gpd.read_file(shp_path)
-gdf_filtered = gdf[~gdf[attribute_name].isin(regions_to_exclude)]
+# 进程池里每个进程各自持有一份投影好的掩膜几何，只在进程启动时传一次
+_worker_shapes = {}
 
-tif_files = glob.glob(os.path.join(tif_folder_path, "*.tif"))
 
-tif_files = sorted(list(set(tif_files)))
+def load_mask_gdf(shp_path):
+    gdf = gpd.read_file(shp_path)
+    return gdf[~gdf[attribute_name].isin(regions_to_exclude)]
 
-#这里开始对TIFF文件进行切割处理
-processed_files_count = 0
-for tif_path in tif_files:
-    with rasterio.open(tif_path) as src:
-        mask_gdf = gdf_filtered.copy()  # 使用副本以防万一
 
-        if mask_gdf.crs != src.crs:
-            mask_gdf = mask_gdf.to_crs(src.crs)
-        shapes = [geom for geom in mask_gdf.geometry]
+def crs_key(crs):
+    return crs.to_wkt() if crs else None
+
+
+def output_path_for(tif_path, output_folder_path):
+    base_name = os.path.basename(tif_path)
+    return os.path.join(output_folder_path, f"clipped_{base_name}")
+
 
+def _init_worker(shapes_by_crs):
+    global _worker_shapes
+    _worker_shapes = shapes_by_crs
+
+
+def clip_tif(tif_path, output_folder_path, shapes=None, max_tile_pixels=None):
+    with rasterio.open(tif_path) as src:
+        if shapes is None:
+            shapes = _worker_shapes[crs_key(src.crs)]
 
         # 进行掩膜操作
         # 有些TIFF文件没有定义NoData值，所以对于这些文件，我把nodata值设为-128，和有定义NoData值的文件保持一致
@@ -39,6 +59,13 @@ for tif_path in tif_files:
             nodata_for_masking = -128.0
         else:
             nodata_for_masking = float(current_nodata)
+        output_tif_path = output_path_for(tif_path, output_folder_path)
+
+        # 分块模式：内存峰值由每块的像元数决定，不会把整个裁剪结果读进内存
+        if max_tile_pixels is not None:
+            mask_raster_windowed(src, shapes, output_tif_path, nodata_for_masking, max_tile_pixels)
+            return output_tif_path
+
         out_image, out_transform = mask(src, shapes, crop=True, nodata=nodata_for_masking,
                                         all_touched=False)
         out_meta = src.meta.copy()
@@ -50,8 +77,121 @@ for tif_path in tif_files:
             "nodata": nodata_for_masking
         })
 
-        base_name = os.path.basename(tif_path)
-        output_tif_path = os.path.join(output_folder_path, f"clipped_{base_name}")
-
         with rasterio.open(output_tif_path, "w", **out_meta) as file:
             file.write(out_image)
+    return output_tif_path
+
+
+def project_mask_shapes(gdf_filtered, tif_files):
+    # 先只读每个TIFF的文件头拿到CRS，然后每种CRS只投影一次掩膜几何
+    shapes_by_crs = {}
+    for tif_path in tif_files:
+        with rasterio.open(tif_path) as src:
+            key = crs_key(src.crs)
+            if key in shapes_by_crs:
+                continue
+            mask_gdf = gdf_filtered
+            if mask_gdf.crs != src.crs:
+                mask_gdf = mask_gdf.to_crs(src.crs)
+            shapes_by_crs[key] = [geom for geom in mask_gdf.geometry]
+    return shapes_by_crs
+
+
+def files_to_process(tif_files, manifest, boundary_fingerprint, output_folder_path, use_hash=False):
+    todo = []
+    fingerprints = {}
+    for tif_path in tif_files:
+        base_name = os.path.basename(tif_path)
+        fingerprint = file_fingerprint(tif_path, use_hash)
+        fingerprints[base_name] = fingerprint
+        entry = manifest.get("files", {}).get(base_name)
+        unchanged = (entry is not None
+                     and entry.get("source") == fingerprint
+                     and entry.get("boundary") == boundary_fingerprint
+                     and os.path.exists(output_path_for(tif_path, output_folder_path)))
+        if not unchanged:
+            todo.append(tif_path)
+    return todo, fingerprints
+
+
+def preprocess(tif_files, shp_path, output_folder_path, workers=None, use_hash=False, force=False,
+               tile_budget_mb=None):
+    # 返回这次实际处理了的TIFF列表
+    os.makedirs(output_folder_path, exist_ok=True)
+    manifest_path = os.path.join(output_folder_path, manifest_file_name)
+    manifest = {} if force else load_manifest(manifest_path)
+    manifest.setdefault("files", {})
+
+    with metrics.span("fingerprint_inputs"):
+        boundary_fingerprint = shapefile_fingerprint(shp_path, use_hash)
+        todo, fingerprints = files_to_process(tif_files, manifest, boundary_fingerprint,
+                                              output_folder_path, use_hash)
+    metrics.count("files_skipped", len(tif_files) - len(todo))
+    if not todo:
+        return []
+
+    with metrics.span("project_mask_shapes"):
+        gdf_filtered = load_mask_gdf(shp_path)
+        shapes_by_crs = project_mask_shapes(gdf_filtered, todo)
+
+    max_tile_pixels = tile_budget_to_pixels(tile_budget_mb) if tile_budget_mb else None
+
+    def record(tif_path, output_tif_path):
+        metrics.count("files_clipped")
+        base_name = os.path.basename(tif_path)
+        manifest["files"][base_name] = {
+            "source": fingerprints[base_name],
+            "boundary": boundary_fingerprint,
+            "output": os.path.basename(output_tif_path),
+        }
+        # 每处理完一个就保存一次清单，中途中断的话下次从没做完的开始
+        save_manifest(manifest, manifest_path)
+
+    if workers == 1:
+        _init_worker(shapes_by_crs)
+        for tif_path in todo:
+            with metrics.span("clip_tif"):
+                output_tif_path = clip_tif(tif_path, output_folder_path, max_tile_pixels=max_tile_pixels)
+            record(tif_path, output_tif_path)
+        return todo
+
+    # 进程池里的子进程各自有一份metrics，这里只记整个进程池从开始到全部切完的时间
+    with metrics.span("clip_pool"), ProcessPoolExecutor(max_workers=workers, initializer=_init_worker,
+                                                        initargs=(shapes_by_crs,)) as pool:
+        futures = {pool.submit(clip_tif, tif_path, output_folder_path, None, max_tile_pixels): tif_path
+                   for tif_path in todo}
+        for future in as_completed(futures):
+            record(futures[future], future.result())
+    return todo
+
+
+def main():
+    parser = argparse.ArgumentParser(description="切割掉所有夜间灯光TIFF中的港澳台区域")
+    parser.add_argument("--shp", default=shp_path, help="省级边界shapefile")
+    parser.add_argument("--input", default=tif_folder_path, help="原始TIFF所在的文件夹")
+    parser.add_argument("--output", default=output_folder_path, help="切割结果的输出文件夹")
+    parser.add_argument("--workers", type=int, default=None, help="并行进程数，默认等于CPU核数，1表示不开进程池")
+    parser.add_argument("--hash", action="store_true", help="用文件内容哈希而不是修改时间来判断文件是否变化")
+    parser.add_argument("--force", action="store_true", help="忽略清单，全部重新处理")
+    parser.add_argument("--tile-budget-mb", type=float, default=None,
+                        help="按块流式切割时每块的内存预算（MB），不指定就整幅读入")
+    parser.add_argument("--calibrate", action="store_true",
+                        help="切割完以后再做DMSP和类DMSP的传感器相互校正，结果写在切割结果旁边")
+    args = parser.parse_args()
+
+    tif_files = glob.glob(os.path.join(args.input, "*.tif"))
+    tif_files = sorted(list(set(tif_files)))
+
+    processed = preprocess(tif_files, args.shp, args.output, workers=args.workers,
+                           use_hash=args.hash, force=args.force, tile_budget_mb=args.tile_budget_mb)
+    print(f"处理了{len(processed)}个文件，跳过了{len(tif_files) - len(processed)}个没有变化的文件")
+
+    if args.calibrate:
+        import calibration
+        with metrics.span("calibrate"):
+            calibration.calibrate(glob.glob(os.path.join(args.output, "clipped_*.tif")))
+    metrics.dump_if_requested()
+
+
+if __name__ == "__main__":
+    main()
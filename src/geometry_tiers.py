@@ -0,0 +1,102 @@
+import json
+import os
+import numpy as np
+import ntl_store
+
+# 地图上用的简化几何。以前每次重新运行都把全精度的省级几何to_json一遍再传给浏览器，几MB的GeoJSON，
+# 换个年份或者换个配色都要重来一次。这里离线把几何按几档缩放级别简化好，只带zone_id存成GeoJSON，
+# 和灯光数值分开存放；app里每档几何只读一次，之后每年只把当年的数值挂到属性上
+
+# 每一档的简化容差，单位是度
+TIERS = {"low": 0.05, "medium": 0.01, "high": 0.002}
+# 每一档适用的最大缩放级别，超过最后一档的都用最精细的
+TIER_MAX_ZOOM = (("low", 5), ("medium", 8), ("high", None))
+# 坐标保留的小数位数，5位大约是1米，对全国地图完全够用
+COORD_DECIMALS = 5
+
+abspath = os.path.dirname(os.path.abspath(__file__))
+store_dirs = {
+    "provinces": os.path.join(abspath, "ntl_store", "provinces"),
+    "cities": os.path.join(abspath, "ntl_store", "cities"),
+}
+output_dir = os.path.join(abspath, "geometry_tiers")
+
+
+def tier_for_zoom(zoom):
+    for tier, max_zoom in TIER_MAX_ZOOM:
+        if max_zoom is None or zoom <= max_zoom:
+            return tier
+    return TIER_MAX_ZOOM[-1][0]
+
+
+def tier_path(tiers_dir, layer, tier):
+    return os.path.join(tiers_dir, layer, f"{tier}.geojson")
+
+
+def simplify_coverage(geometries, tolerance):
+    # 相邻区域的公共边界要一起简化，不然简化后省界之间会出现缝隙或者重叠。
+    # shapely 2.1以上有coverage_simplify可以做到；数据本身不是严格的覆盖（有重叠）时退回到逐个简化。
+    # main.py启动时会导入这个模块，shapely在用到的时候才导入
+    import shapely
+    if hasattr(shapely, "coverage_simplify"):
+        try:
+            return shapely.coverage_simplify(geometries, tolerance)
+        except shapely.errors.GEOSException:
+            pass
+    return shapely.simplify(geometries, tolerance, preserve_topology=True)
+
+
+def build_tier_geojson(zones, tolerance):
+    # zones是带zone_id列的GeoDataFrame或者ntl_model的数据模型，返回一个只带zone_id属性的FeatureCollection字典
+    import shapely
+    from map_layers import zone_geometries
+    geometries, zone_ids = zone_geometries(zones)
+    geometries = simplify_coverage(geometries, tolerance)
+    geometries = shapely.transform(geometries, lambda coords: np.round(coords, COORD_DECIMALS))
+    features = []
+    for zone_id, geometry_json in zip(zone_ids, shapely.to_geojson(geometries)):
+        if geometry_json is None:
+            continue
+        features.append({
+            "type": "Feature",
+            "id": int(zone_id),
+            "properties": {"zone_id": int(zone_id)},
+            "geometry": json.loads(geometry_json),
+        })
+    return {"type": "FeatureCollection", "features": features}
+
+
+def load_tier(path):
+    with open(path, "r", encoding="utf-8") as f:
+        return json.load(f)
+
+
+def write_tiers(store_dir, layer, tiers_dir):
+    zones = ntl_store.read_zones(store_dir, columns=[])
+    os.makedirs(os.path.join(tiers_dir, layer), exist_ok=True)
+    for tier, tolerance in TIERS.items():
+        feature_collection = build_tier_geojson(zones, tolerance)
+        with open(tier_path(tiers_dir, layer, tier), "w", encoding="utf-8") as f:
+            json.dump(feature_collection, f, ensure_ascii=False, separators=(",", ":"))
+
+
+def attach_values(feature_collection, values_by_zone):
+    # values_by_zone是以zone_id为索引的DataFrame，每一列都会作为属性挂到对应的要素上。
+    # 几何对象直接复用缓存里的，不复制也不重新序列化；缓存里的字典本身不会被修改
+    values_by_zone = values_by_zone.astype(object).where(values_by_zone.notna(), None)
+    properties = values_by_zone.to_dict("index")
+    features = []
+    for feature in feature_collection["features"]:
+        zone_id = feature["properties"]["zone_id"]
+        features.append({
+            "type": "Feature",
+            "id": feature.get("id", zone_id),
+            "properties": {"zone_id": zone_id, **properties.get(zone_id, {})},
+            "geometry": feature["geometry"],
+        })
+    return {"type": "FeatureCollection", "features": features}
+
+
+if __name__ == "__main__":
+    for layer, store_dir in store_dirs.items():
+        write_tiers(store_dir, layer, output_dir)
@@ -0,0 +1,94 @@
+import argparse
+import glob
+import os
+import re
+import threading
+import pandas as pd
+import ntl_store
+import ntl_analytics
+
+# 把以前每年一份的shapefile（yearly_nightlight_stats_provinces/NTL_1992.shp这种，属性表里一列NTL_1992_m）
+# 一次性导入成ntl_store的格式：几何和属性写一份zones.parquet，各年的平均值写进ntl_stats.parquet的mean列。
+# 仓库里带的是这些shapefile，没有ntl_store，也没有能重新跑分区统计的原始TIFF，
+# 所以dashboard第一次启动时发现数据目录是空的，就先用这里导入一遍，之后只读ntl_store。
+# 注意这些shapefile是用切割后的原始DN（clipped_*.tif）算的，没有经过传感器相互校正；
+# 有了calibrated_*.tif以后重新运行 python ntl.py run 会覆盖掉导入的结果
+# 在src目录下运行：
+#   python legacy_import.py            导入还没有数据目录的边界
+#   python legacy_import.py --force    已经有数据目录也重新导入
+
+abspath = os.path.dirname(os.path.abspath(__file__))
+# {图层名: (旧shapefile目录, 文件名模式, ntl_store目录)}
+LEGACY_LAYERS = {
+    "provinces": (os.path.join(abspath, "yearly_nightlight_stats_provinces"), "NTL_*.shp",
+                  os.path.join(abspath, "ntl_store", "provinces")),
+    "cities": (os.path.join(abspath, "yearly_nightlight_stats_cities"), "NTL_*_cities.shp",
+               os.path.join(abspath, "ntl_store", "cities")),
+}
+LEGACY_TIF_PATTERN = "clipped_*.tif"
+# 同一个进程里多个会话同时发现数据目录是空的，只让一个去导入
+_import_lock = threading.Lock()
+
+
+def legacy_value_column(year):
+    return f"NTL_{year}_m"
+
+
+def legacy_shapefiles(shp_dir, pattern):
+    # {年份: shapefile路径}，文件名里的四位数字就是年份
+    paths = {}
+    for path in glob.glob(os.path.join(shp_dir, pattern)):
+        match = re.search(r'(\d{4})', os.path.basename(path))
+        if match:
+            paths[match.group(1)] = path
+    return paths
+
+
+def import_layer(shp_dir, pattern, store_dir):
+    # 返回导入了多少年，没有旧shapefile的返回0
+    import geopandas as gpd
+    paths = legacy_shapefiles(shp_dir, pattern)
+    if not paths:
+        return 0
+    years = sorted(paths)
+    # 各年的shapefile是同一套边界、同样的行顺序，几何和属性取最后一年的，去掉按年份变化的列
+    zones = gpd.read_file(paths[years[-1]])
+    zones = zones.drop(columns=[column for column in zones.columns
+                                if column == "year" or re.fullmatch(r"NTL_\d{4}_m", column)])
+    yearly_stats = {}
+    for year in years:
+        attributes = gpd.read_file(paths[year], ignore_geometry=True)
+        if len(attributes) != len(zones):
+            raise ValueError(f"{paths[year]}有{len(attributes)}个区域，和{paths[years[-1]]}的{len(zones)}个对不上")
+        values = pd.to_numeric(attributes[legacy_value_column(year)], errors="coerce")
+        yearly_stats[year] = {"mean": values.to_numpy(dtype="float64")}
+    ntl_store.write_zone_table(zones, store_dir)
+    ntl_store.write_stats_table(yearly_stats, store_dir, replace_all=True)
+    # 旧shapefile是用未校正的TIFF算的，记下来，之后用calibrated_*.tif统计时会整张表重算
+    ntl_store.write_source(store_dir, LEGACY_TIF_PATTERN)
+    ntl_analytics.write_analytics(store_dir)
+    return len(years)
+
+
+def ensure_store(layer, force=False):
+    # 数据目录还没有的时候从旧shapefile导入，已经有了就什么都不做
+    shp_dir, pattern, store_dir = LEGACY_LAYERS[layer]
+    with _import_lock:
+        if not force and os.path.exists(ntl_store.zones_path(store_dir)) \
+                and os.path.exists(ntl_store.stats_path(store_dir)):
+            return 0
+        return import_layer(shp_dir, pattern, store_dir)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="把以前每年一份的shapefile导入成ntl_store")
+    parser.add_argument("--layers", nargs="+", default=list(LEGACY_LAYERS), choices=list(LEGACY_LAYERS))
+    parser.add_argument("--force", action="store_true", help="已经有数据目录也重新导入")
+    args = parser.parse_args()
+    for layer in args.layers:
+        count = ensure_store(layer, args.force)
+        print(f"{layer}: 导入了{count}年" if count else f"{layer}: 已有数据目录或没有旧shapefile，跳过")
+
+
+if __name__ == "__main__":
+    main()
@@ -1,20 +1,27 @@
+import time
+_import_start = time.perf_counter()
 import streamlit as st
 import os
-import glob
-import re
-import geopandas as gpd
-import folium
-from streamlit_folium import st_folium
+import json
 import pandas as pd
-import plotly.express as px
-from folium.plugins import HeatMap, SideBySideLayers, MarkerCluster
-import pydeck as pdk
-from matplotlib import cm
-from matplotlib.colors import Normalize
-
-
-
+import ntl_store
+import geometry_tiers
+import map_layers
+import data_cache
+import ntl_model
+import metrics
+import map_payloads
+
+# 启动的时候只导入上面这些轻量的模块。重的可视化库都在第一次用到的时候才导入：
+# folium和它的插件只有2D视图用，pydeck只有3D视图用，plotly只有趋势图用，matplotlib只在算颜色的时候用，
+# geopandas只有读国界shapefile的时候用；预先算好的数据（统计表、指标表、区域几何、简化几何）都不需要geopandas。
+# 导入花的时间记在startup_import这个span里，调试面板里能看到；python benchmark_pipeline.py --stages startup
+# 可以测一个全新进程导入main.py要多久
+
+metrics.observe("startup_import", time.perf_counter() - _import_start)
 st.set_page_config(layout="wide")
+# 缓存里的DataFrame是所有会话共享的，打开copy-on-write以后，拿到浅拷贝再加列、改值都不会影响缓存里的那份
+pd.set_option("mode.copy_on_write", True)
 
 # 这个CSS代码是为了消除folium地图下方的大片空白，参考来源https://discuss.streamlit.io/t/folium-map-white-space-under-the-map-on-the-first-rendering/84363
 st.markdown("""
@@ -28,76 +35,222 @@ st.markdown("""
 abspath = os.path.dirname(os.path.abspath(__file__))
 png_dir = os.path.join(abspath, "processed_nightlights")
 file = "*.png"
-yearly_provinces_shp_dir= os.path.join(abspath, "yearly_nightlight_stats_provinces")
-yearly_cities_shp_dir= os.path.join(abspath, "yearly_nightlight_stats_cities")
+provinces_store_dir = os.path.join(abspath, "ntl_store", "provinces")
+cities_store_dir = os.path.join(abspath, "ntl_store", "cities")
 china_boundary_dir=os.path.join(abspath, "CN_boundary")
+geometry_tiers_dir = os.path.join(abspath, "geometry_tiers")
 province = "省"
+map_zoom_start = 4
+# 矢量切片服务的地址，先在src目录下运行 python tile_server.py
+tile_server_url = os.environ.get("NTL_TILE_SERVER", "http://localhost:8765")
 
 
-@st.cache_data
-def load_yearly_data(shp_path):
-    gdf = gpd.read_file(shp_path)
-    gdf.loc[32, 'ENG_NAME'] = 'Macao'
-    return gdf
+def ntl_column_name(year):
+    # 沿用以前shapefile里被截断成10个字符的列名，地图和提示框都用这个名字
+    return f"NTL_{year}_m"
+
+
+# 下面这些加载函数都用进程级的共享缓存，键里带着数据目录的版本，文件不变就不会重新读
+def store_version(store_dir, *args):
+    return data_cache.directory_version(store_dir)
+
+
+def geometry_tier_version(store_dir, layer, tier):
+    return data_cache.files_version(geometry_tiers.tier_path(geometry_tiers_dir, layer, tier),
+                                    ntl_store.zones_path(store_dir))
+
+
+@data_cache.cached(store_version)
+# 每个区域类型只有一个紧凑的数据模型：区域 × 年份的float32矩阵、category类型的名称和一份共用的几何，
+# 各个年份、各个视图都从这里切片
+def load_model(store_dir):
+    model = ntl_model.load_model(store_dir)
+    if 'ENG_NAME' in model.attributes.columns and model.n_zones > 32:
+        model.set_attribute(32, 'ENG_NAME', 'Macao')
+    return model
 
 
-@st.cache_data
+@data_cache.cached(geometry_tier_version)
+# 简化好的几何只读一次，整个进程共用同一份，各年份只是把数值挂上去，不重新序列化几何
+def load_geometry_tier(store_dir, layer, tier):
+    path = geometry_tiers.tier_path(geometry_tiers_dir, layer, tier)
+    if os.path.exists(path):
+        return geometry_tiers.load_tier(path)
+    # 还没有离线生成的话，就现场简化一次
+    return geometry_tiers.build_tier_geojson(load_model(store_dir), geometry_tiers.TIERS[tier])
+
+
+@data_cache.cached(store_version)
+# 区域中心点只和几何有关，每套几何算一次就够了
+def load_zone_points(store_dir):
+    return map_layers.zone_points(load_model(store_dir))
+
+
+@data_cache.cached(store_version)
+# 3D视图用的多边形外环，拆分和取坐标只做一次
+def load_polygon_rings(store_dir):
+    return map_layers.polygon_rings(load_model(store_dir))
+
+
+@data_cache.cached(store_version)
+def load_border_path_data(shp_path):
+    return map_layers.path_layer_data(map_layers.line_paths(load_china_boundary(shp_path)))
+
+
+@data_cache.cached(store_version)
 def load_china_boundary(shp_path):
+    import geopandas as gpd
     gdf = gpd.read_file(shp_path)
     return gdf
 
 
-@st.cache_data
-# 这个用来返回每年夜间灯光值的路径、属性表列的字典
-def generate_shapefile_dict(directory):
-    year_data_map = {}
-    pattern = os.path.join(directory, "NTL_*.shp")
-    for shp in glob.glob(pattern):
-        filename = os.path.basename(shp)
-        match = re.search(r'(\d{4})', filename)  # 查找文件名中的四位数字作为年份
-        if match:
-            year = match.group(1)
-            data_column_name = f"NTL_{year}_m"
-            year_data_map[year] = {"path": shp, "data_column": data_column_name}
-
-    sorted_years = sorted(year_data_map.keys(), reverse=True)
-    return {year: year_data_map[year] for year in sorted_years}
-
-
-def generate_shapefile_dict_for_cities(directory):
-    year_data_map = {}
-    pattern = os.path.join(directory, "NTL_*_cities.shp")
-    for shp in glob.glob(pattern):
-        filename = os.path.basename(shp)
-        match = re.search(r'(\d{4})', filename)  # 查找文件名中的四位数字作为年份
-        if match:
-            year = match.group(1)
-            data_column_name = f"NTL_{year}_m"
-            year_data_map[year] = {"path": shp, "data_column": data_column_name}
-
-    sorted_years = sorted(year_data_map.keys(), reverse=True)
-    return {year: year_data_map[year] for year in sorted_years}
-
-
-@st.cache_data
-# 返回一个整合各个省份从1992到2022年的每年平均夜间灯光值的DataFrame
-def generate_yearly_ntl_dataframe(year_dict, province):
-    data = []
-    for year_str, year_info in year_dict.items():
-        gdf_year = load_yearly_data(year_info["path"])
-        ntl_col = year_info["data_column"]
-        gdf_year[ntl_col] = pd.to_numeric(gdf_year[ntl_col], errors='coerce')
-        for index, row in gdf_year.iterrows():
-            data.append({
-                "Year": int(year_str),
-                province: row[province],
-                "NTL_Value": row[ntl_col]
-            })
-    return pd.DataFrame(data)
+# 返回有数据的年份，从新到旧排列
+def load_available_years(store_dir):
+    return [str(year) for year in load_model(store_dir).years[::-1]]
+
+
+@data_cache.cached(store_version)
+# 折线只画一次，动画的每一帧只挪动x轴的范围，帧的大小和区域数、年份数无关。
+# 折线的数据直接就是模型里的矩阵，不再拼长表再pivot
+def load_trend_figure(store_dir, name_column, mode="window"):
+    import trend_animation
+    years, names, matrix = load_model(store_dir).trend_series(name_column)
+    with metrics.span("build_trend_figure", mode=mode):
+        return trend_animation.build_trend_figure(years, names, matrix, mode=mode)
+
+
+def show_region_series(geometry, title):
+    # 任意区域的历年灯光，直接从像元立方体的积分图里查，需要先运行ntl.py的trend_cube阶段
+    import region_query
+    if not region_query.block_tables_ready(os.path.join(abspath, "ntl_cube")):
+        st.info("还没有生成像元数据立方体和积分图，先在src目录下运行 python ntl.py run --only trend_cube")
+        return
+    if isinstance(geometry, dict):
+        from shapely.geometry import shape
+        geometry = shape(geometry)
+    query = region_query.default_query()
+    series_df = query.series(geometry)
+    st.subheader(f"{title}历年平均灯光强度:triangular_ruler:")
+    st.line_chart(series_df.set_index("year")["mean"])
+    zones_df = query.zones_in(geometry)
+    with st.expander("区域覆盖的省市"):
+        st.dataframe(zones_df, use_container_width=True)
+
+
+def proportion_column(year):
+    return f"NTL_{year}_占比"
+
+
+def rank_column(year):
+    return f"NTL_{year}_排名"
+
+
+def load_province_year(year):
+    # 这一年各省的灯光平均值、占比和排名，都是模型矩阵里的一列，以zone_id为索引
+    return load_model(provinces_store_dir).year_frame(year, ntl_column_name(year), proportion_column(year),
+                                                      rank_column(year), name_columns=[province])
+
+
+def build_province_map(year, color_scheme, num_bins, map_progress=None):
+    # 省级分级设色图的基础部分，只由（年份, 配色方案, 分级数）决定，其他叠加图层在外面再加
+    import folium
+    ntl_column = ntl_column_name(year)
+    proportion_column_name = proportion_column(year)
+    rank_column_name = rank_column(year)
+    m = folium.Map((35.8617, 104.1954), zoom_start=map_zoom_start, tiles='cartodbpositron')
+    data_for_map = load_province_year(year).reset_index()
+    geometry_tier = load_geometry_tier(provinces_store_dir, "provinces", geometry_tiers.tier_for_zoom(map_zoom_start))
+    geo_data = geometry_tiers.attach_values(geometry_tier, data_for_map.set_index('zone_id'))
+    if metrics.enabled():
+        # 只有调试的时候才额外序列化一遍，看看发给浏览器的GeoJSON有多大
+        metrics.gauge("bytes_serialized", len(json.dumps(geo_data, default=str)), payload="province_geojson")
+
+    if map_progress is not None:
+        map_progress.done("geojson")
+
+    # 缓存的只是Python这边简化、组装GeoJSON的工作；folium.Choropleth仍然把整份省级GeoJSON嵌进每次生成的HTML里，
+    # 每次渲染的序列化和传输都还在。要省掉这部分就用服务模式（整段HTML在所有会话间共用），
+    # 或者打开“市级灯光强度（矢量切片）”那种按URL加载的图层
+    choropleth_layer = folium.Choropleth(
+        geo_data=geo_data,
+        name=f'灯光强度 {year}',
+        data=data_for_map,
+        columns=['zone_id', ntl_column],
+        key_on='feature.properties.zone_id',
+        fill_color=color_scheme,
+        fill_opacity=0.7,
+        line_opacity=0.3,
+        legend_name=f'{year}年 夜间灯光平均强度',
+        highlight=True,
+        bins=num_bins
+    ).add_to(m)
+
+    if map_progress is not None:
+        map_progress.done("choropleth")
+
+    folium.GeoJsonTooltip(
+        fields=[province, ntl_column,proportion_column_name, rank_column_name],
+        aliases=['省份/区域:', f'{year}年灯光强度:',f'{year}年{province}灯光强度在全国中的占比',
+                 f'{year}年全国排名:'],
+        sticky=False,
+        localize=True,
+        style="""
+            background-color: #F0EFEF;
+            border: 2px solid black;
+            border-radius: 3px;
+            box-shadow: 3px;
+        """
+    ).add_to(choropleth_layer.geojson)
+
+    if map_progress is not None:
+        map_progress.done("tooltip")
+
+    return m
+
+
+def build_map_payload(key):
+    # 给地图缓存用的：生成整段HTML，不带任何叠加图层
+    import folium
+    year, color_scheme, num_bins = key
+    m = build_province_map(year, color_scheme, num_bins)
+    folium.LayerControl().add_to(m)
+    return map_payloads.render_html(m)
+
+
+def render_debug_panel():
+    # 调试面板：各阶段耗时、缓存命中情况和序列化的字节数，也可以下载Prometheus文本或JSON
+    snapshot = metrics.snapshot()
+    with st.sidebar.expander("性能调试", expanded=True):
+        if snapshot["spans"]:
+            spans_df = pd.DataFrame(snapshot["spans"])
+            spans_df["labels"] = spans_df["labels"].map(lambda labels: ",".join(f"{k}={v}" for k, v in labels.items()))
+            st.dataframe(spans_df.sort_values("total", ascending=False), use_container_width=True)
+        for kind in ("counters", "gauges"):
+            if snapshot[kind]:
+                kind_df = pd.DataFrame(snapshot[kind])
+                kind_df["labels"] = kind_df["labels"].map(lambda labels: ",".join(f"{k}={v}" for k, v in labels.items()))
+                st.dataframe(kind_df, use_container_width=True)
+        st.write(data_cache.shared_cache.stats())
+        st.download_button("下载Prometheus格式", metrics.to_prometheus(), file_name="ntl_metrics.prom")
+        st.download_button("下载JSON", metrics.to_json(), file_name="ntl_metrics.json")
+        if st.button("清空计数"):
+            metrics.reset()
+
+
+def ensure_stores():
+    # 干净的checkout里只有以前每年一份的shapefile，没有ntl_store，第一次启动时先导入一遍（见legacy_import.py）
+    if all(os.path.exists(ntl_store.stats_path(store_dir)) for store_dir in (provinces_store_dir, cities_store_dir)):
+        return
+    import legacy_import
+    with st.spinner("第一次启动，正在把yearly_nightlight_stats_*里的shapefile导入成ntl_store..."):
+        for layer in ("provinces", "cities"):
+            legacy_import.ensure_store(layer)
+
 
 def main():
 
     st.title("中国省级年度夜间灯光强度交互式地图:world_map:")
+    ensure_stores()
 
     game_html = """
     <div id="game-container" style="text-align:center; padding:20px; border:1px solid #ddd;">
@@ -118,18 +271,21 @@ def main():
 
 
     st.sidebar.header("地图选项:thinking_face:")
-    year_dict_provinces = generate_shapefile_dict(yearly_provinces_shp_dir)
-    sorted_years_list = list(year_dict_provinces.keys())
-    year_dict_cities = generate_shapefile_dict_for_cities(yearly_cities_shp_dir)
+    # 记不记录耗时和计数是整个进程的设置，只能在启动时用环境变量NTL_METRICS=1打开，
+    # 不让某一个会话的勾选影响到别的会话。这个勾选框只决定本会话显不显示调试面板
+    show_debug_panel = st.sidebar.checkbox("显示性能调试面板", value=False, key="show_debug_panel",
+                                           disabled=not metrics.enabled(),
+                                           help=None if metrics.enabled() else "启动前设置环境变量NTL_METRICS=1才会记录")
+    sorted_years_list = load_available_years(provinces_store_dir)
+    if os.environ.get("NTL_SERVING_MODE", "") not in ("", "0"):
+        # 服务模式启动的进程，一开始就在后台生成默认组合的地图
+        map_payloads.render_cache.seed(sorted_years_list, store_version(provinces_store_dir), build_map_payload)
 
     selected_year = st.sidebar.selectbox("选择年份:", sorted_years_list)
+    selected_ntl_column = ntl_column_name(selected_year)
 
-    selected_year_info_provinces= year_dict_provinces[selected_year]
-    selected_shp_path_provinces = selected_year_info_provinces["path"]
-    selected_ntl_column = selected_year_info_provinces["data_column"]
-
-    selected_year_info_cities = year_dict_cities[selected_year]
-    selected_shp_path_cities = selected_year_info_cities["path"]
+    # 按经纬度范围查询任意区域，格式是 最小经度,最小纬度,最大经度,最大纬度
+    bbox_text = st.sidebar.text_input("按经纬度范围查询（最小经度,最小纬度,最大经度,最大纬度）:", "")
 
     view_mode = st.sidebar.radio(
         "选择地图视角:",
@@ -146,93 +302,106 @@ def main():
     selected_color_scheme = st.sidebar.selectbox(
         "选择配色方案:",
         available_color_schemes,
-        index=available_color_schemes.index('YlOrRd')
+        index=available_color_schemes.index(map_payloads.DEFAULT_SCHEME)
     )
 
     if view_mode == '2D 平面视图 (Folium)':
-        num_bins = st.sidebar.slider("选择分级数量 (2D地图):", min_value=3, max_value=20, value=7, step=1)
+        num_bins = st.sidebar.slider("选择分级数量 (2D地图):", min_value=3, max_value=20,
+                                     value=map_payloads.DEFAULT_BINS, step=1)
 
     if view_mode == '3D 立体视图 (Pydeck)':
         elevation_multiplier = st.sidebar.slider("调整立体拉伸倍数 (3D地图):", min_value=5000, max_value=100000,
                                                  value=20000, step=5000)
 
     st.sidebar.info(f"当前显示年份: {selected_year}")
-    st.sidebar.info(f"数据文件: {os.path.basename(selected_shp_path_provinces)}")
+    st.sidebar.info(f"数据文件: {ntl_store.STATS_FILE}")
     st.sidebar.info(f"灯光数据列: {selected_ntl_column}")
     st.sidebar.info(f"当前配色方案: {selected_color_scheme}")
 
     map_progress_bar = st.progress(0)
+    if view_mode == '2D 平面视图 (Folium)':
+        map_progress = metrics.StageProgress(map_progress_bar, ["load_data", "geojson", "choropleth", "tooltip",
+                                                                "overlays", "render"])
+    else:
+        map_progress = metrics.StageProgress(map_progress_bar, ["load_data", "polygon_data", "polygon_layer",
+                                                                "border_data", "render"])
     st.components.v1.html(game_html, height=200)
-    # 加载选定年份的数据，其实就是得到Shapefile的属性表
-    gdf_provinces_yearly = load_yearly_data(selected_shp_path_provinces)
-    gdf_cities_yearly = load_yearly_data(selected_shp_path_cities)
-    china_boundary=load_china_boundary(china_boundary_dir)
-
-    # 这里计算灯光强度占比
-    gdf_provinces_yearly[selected_ntl_column] = pd.to_numeric(gdf_provinces_yearly[selected_ntl_column],errors='coerce')
-    total_ntl_this_year = gdf_provinces_yearly[selected_ntl_column].fillna(0).sum()
-    proportion_column_name = f"NTL_{selected_year}_占比"
-    gdf_provinces_yearly[proportion_column_name] = (gdf_provinces_yearly[selected_ntl_column] / total_ntl_this_year)
+    # 加载选定年份的数据，其实就是区域几何加上这一年的灯光平均值
+    with metrics.span("load_yearly_data"):
+        provinces_yearly = load_province_year(selected_year)
+        city_model = load_model(cities_store_dir)
+    map_progress.done("load_data")
 
     if view_mode == '2D 平面视图 (Folium)':
-        m = folium.Map((35.8617, 104.1954), zoom_start=4, tiles='cartodbpositron')
-        data_for_map = gdf_provinces_yearly[[province, selected_ntl_column,proportion_column_name, 'geometry']].copy()
-
-        map_progress_bar.progress(30)
-
-        choropleth_layer = folium.Choropleth(
-            geo_data=data_for_map.to_json(),
-            name=f'灯光强度 {selected_year}',
-            data=data_for_map,
-            columns=[province, selected_ntl_column,proportion_column_name],
-            key_on=f'feature.properties.{province}',
-            fill_color=selected_color_scheme,
-            fill_opacity=0.7,
-            line_opacity=0.3,
-            legend_name=f'{selected_year}年 夜间灯光平均强度',
-            highlight=True,
-            bins=num_bins
-        ).add_to(m)
-
-        map_progress_bar.progress(50)
-
-        folium.GeoJsonTooltip(
-            fields=[province, selected_ntl_column,proportion_column_name],
-            aliases=['省份/区域:', f'{selected_year}年灯光强度:',f'{selected_year}年{province}灯光强度在全国中的占比'],
-            sticky=False,
-            localize=True,
-            style="""
-                background-color: #F0EFEF;
-                border: 2px solid black;
-                border-radius: 3px;
-                box-shadow: 3px;
-            """
-        ).add_to(choropleth_layer.geojson)
-
-        map_progress_bar.progress(60)
-
         st.sidebar.markdown("---")
         st.sidebar.write("其他选项：")
 
         show_cluster_option = st.sidebar.checkbox("查看市级灯光强度标记簇")
         show_layer_option = st.sidebar.checkbox('使用并排底图')
         show_antpath_option = st.sidebar.checkbox('添加国界流动线', value=False)
+        show_city_tiles_option = st.sidebar.checkbox('显示市级灯光强度（矢量切片）', value=False)
+        show_raster_tiles_option = st.sidebar.checkbox('显示像元级灯光影像（栅格切片）', value=False)
+        # 服务模式下，没有叠加图层的地图直接用所有会话共用的HTML缓存，不再每次重新生成；
+        # 代价是拿不到在地图上画的区域，按经纬度范围查询还是可以用
+        serving_mode = st.sidebar.checkbox('服务模式（共用预先生成的地图）',
+                                           value=os.environ.get("NTL_SERVING_MODE", "") not in ("", "0"))
+        has_overlays = any([show_cluster_option, show_layer_option, show_antpath_option, show_city_tiles_option,
+                            show_raster_tiles_option])
+
+    if view_mode == '2D 平面视图 (Folium)' and serving_mode and not has_overlays:
+        payload_key = (selected_year, selected_color_scheme, num_bins)
+        payload_version = store_version(provinces_store_dir)
+        map_payloads.render_cache.seed(sorted_years_list, payload_version, build_map_payload)
+        map_html = map_payloads.render_cache.get(payload_key, payload_version, build_map_payload)
+        # 同一配色和分级下的其他年份，以及请求最多的几个组合，在后台线程里提前生成好
+        map_payloads.render_cache.warm([(year, selected_color_scheme, num_bins) for year in sorted_years_list]
+                                       + map_payloads.render_cache.popular(), payload_version, build_map_payload)
+        map_progress.done("overlays")
+
+        st.subheader(f"{selected_year}年 中国省级夜间灯光强度分布图:cityscape:(配色方案: {selected_color_scheme})")
+        with metrics.span("components_html"):
+            st.components.v1.html(map_html, height=700)
+        map_progress.done("render")
+
+        container1 = st.container(border=True)
+        container1.latex('注1：港澳台地区无数据')
+        container1.latex('注2；灯光强度占比保留到小数后3位，如果显示0，则是占比太小')
+
+    elif view_mode == '2D 平面视图 (Folium)':
+        import folium
+        from folium.plugins import SideBySideLayers, FastMarkerCluster, VectorGridProtobuf, Draw, AntPath
+        from streamlit_folium import st_folium
+        m = build_province_map(selected_year, selected_color_scheme, num_bins, map_progress)
+
+        if show_raster_tiles_option:
+            # 像元级影像由切片服务按视野从COG里取，需要先运行raster_tiles.py生成COG
+            folium.TileLayer(
+                tiles=f"{tile_server_url}/raster/{selected_year}/{{z}}/{{x}}/{{y}}.png",
+                attr="DMSP/NPP-VIIRS",
+                name=f"{selected_year}年像元级灯光影像",
+                overlay=True,
+                opacity=0.8
+            ).add_to(m)
+
+        if show_city_tiles_option:
+            import vector_tiles
+            # 城市几何由切片服务按视野和缩放级别分片提供，这里只传当年每个城市的颜色数组，在浏览器里按zone_id对上
+            city_colors = map_layers.hex_colors(city_model.column(selected_year), selected_color_scheme)
+            VectorGridProtobuf(
+                f"{tile_server_url}/tiles/cities/{{z}}/{{x}}/{{y}}.pbf",
+                f"{selected_year}年市级灯光强度",
+                vector_tiles.style_function_js("cities", city_colors)
+            ).add_to(m)
 
         if show_cluster_option:
-            map_progress_bar.progress(65)
-            marker_cluster = MarkerCluster(name=f"{selected_year}年城市灯光点").add_to(m)
-
-            for index, row in gdf_cities_yearly.iterrows():
-                ntl_value = row[selected_ntl_column]
-                if pd.notna(ntl_value) and row['geometry'] and not row['geometry'].is_empty:
-                    centroid = row['geometry'].centroid
-                    tooltip_text = f"{row['NAME']} - 灯光强度: {ntl_value:.2f}"
-                    folium.Marker(
-                        location=[centroid.y, centroid.x],
-                        tooltip=tooltip_text,
-                        icon=folium.Icon(color='blue', icon='circle-arrow-down', prefix='glyphicon')
-                    ).add_to(marker_cluster)
-            map_progress_bar.progress(75)
+            # 城市中心点是缓存好的，这里只把当年的数值拼成一个数组，标记在浏览器里一次性生成
+            city_points = load_zone_points(cities_store_dir)
+            city_values = city_model.year_frame(selected_year, selected_ntl_column, name_columns=['NAME'])
+            FastMarkerCluster(
+                data=map_layers.marker_rows(city_points, city_values['NAME'], city_values[selected_ntl_column]),
+                callback=map_layers.CITY_MARKER_CALLBACK,
+                name=f"{selected_year}年城市灯光点"
+            ).add_to(m)
 
         layer_right = folium.TileLayer('openstreetmap')
         layer_left = folium.TileLayer('cartodbpositron')
@@ -244,6 +413,7 @@ def main():
 
         # 这里添加AntPath
         if show_antpath_option:
+            china_boundary = load_china_boundary(china_boundary_dir)
             if china_boundary.crs and china_boundary.crs.to_epsg() != 4326:
                 china_boundary = china_boundary.to_crs(epsg=4326)
             ant_path_segment_coords_list = []
@@ -253,7 +423,7 @@ def main():
                 current_segment_coords = [(lat, lon) for lon, lat in list(geometry.coords)]
                 ant_path_segment_coords_list.append(current_segment_coords)
 
-            ant_path_layer = folium.plugins.AntPath(
+            ant_path_layer = AntPath(
                 locations=ant_path_segment_coords_list,
                 dash_array=[5, 60],
                 delay=1000,
@@ -265,41 +435,39 @@ def main():
             )
             ant_path_layer.add_to(m)
 
+        # 在地图上画多边形或矩形，可以查询这个区域的历年灯光
+        Draw(export=False, draw_options={"polyline": False, "circle": False, "marker": False,
+                                         "circlemarker": False}).add_to(m)
         folium.LayerControl().add_to(m)
+        map_progress.done("overlays")
 
         # 生成地图主要界面
         st.subheader(f"{selected_year}年 中国省级夜间灯光强度分布图:cityscape:(配色方案: {selected_color_scheme})")
         with st.spinner("正在生成地图..."):
-            st_folium(m, width=1200, height=700, returned_objects=[])
+            with metrics.span("st_folium"):
+                map_output = st_folium(m, width=1200, height=700, returned_objects=["last_active_drawing"])
+        map_progress.done("render")
 
         container1 = st.container(border=True)
         container1.latex('注1：港澳台地区无数据')
         container1.latex('注2；灯光强度占比保留到小数后3位，如果显示0，则是占比太小')
-        map_progress_bar.progress(100)
+
+        drawn_region = (map_output or {}).get("last_active_drawing")
+        if drawn_region:
+            show_region_series(drawn_region["geometry"], "所画区域")
 
     elif view_mode == '3D 立体视图 (Pydeck)':
+        import pydeck as pdk
         st.subheader(f"{selected_year}年 中国省级夜间灯光强度分布图 (3D):earth_asia:")
         with st.spinner("正在生成 3D 地图..."):
 
-            data_for_3d = gdf_provinces_yearly.dropna(subset=[selected_ntl_column]).copy()
-
-            # 最重要的一步！！！使用 explode() 将 MultiPolygon 转换为 Polygon，不然图层显示不出来，就只有底图了
-            data_for_3d = data_for_3d.explode(index_parts=True)
-
-            # Pydeck的PolygonLayer需要一个包含多边形顶点坐标的列
-            data_for_3d['coordinates'] = data_for_3d['geometry'].apply(lambda x: [list(x.exterior.coords)])
-            map_progress_bar.progress(30)
-
-            # 对灯光强度进行拉伸，不然全都是黑的
-            min_value, max_value = data_for_3d[selected_ntl_column].min(), data_for_3d[selected_ntl_column].max()
-            normalize = Normalize(vmin=min_value, vmax=max_value)
-            cmap = cm.get_cmap(selected_color_scheme)
-
-            def get_color(value):
-                rgba = cmap(normalize(value))
-                return [int(c * 255) for c in rgba[:3]]
-
-            data_for_3d['fill_color'] = data_for_3d[selected_ntl_column].apply(get_color)
+            # 多边形外环是缓存好的扁平坐标，这里只按环的归属换上当年的数值，
+            # 填充颜色也是整列一次性用色带算出来的
+            province_rings = load_polygon_rings(provinces_store_dir)
+            values_by_zone = provinces_yearly[[province, selected_ntl_column]]
+            data_for_3d = map_layers.polygon_layer_data(province_rings, values_by_zone,
+                                                        selected_ntl_column, selected_color_scheme)
+            map_progress.done("polygon_data")
 
             province_layer = pdk.Layer(
                 'PolygonLayer',
@@ -316,17 +484,14 @@ def main():
                 pickable=True,
                 auto_highlight=True
             )
-            map_progress_bar.progress(50)
+            map_progress.done("polygon_layer")
             layers_to_render = [province_layer]
 
-            gdf_border = load_china_boundary(china_boundary_dir)
-            gdf_border_exploded = gdf_border.explode(index_parts=False)
-
-            gdf_border_exploded['path'] = gdf_border_exploded['geometry'].apply(lambda x: list(x.coords))
-            map_progress_bar.progress(70)
+            border_data = load_border_path_data(china_boundary_dir)
+            map_progress.done("border_data")
             border_layer = pdk.Layer(
                 'PathLayer',
-                data=gdf_border_exploded,
+                data=border_data,
                 get_path='path',
                 get_color=[0, 0, 0, 180],
                 width_min_pixels=1.5,
@@ -339,26 +504,22 @@ def main():
                 "html": f"<b>省份:</b> {{{'省'}}}<br/><b>{selected_year}年平均灯光强度:</b> {{{selected_ntl_column}}}"}
 
             deck = pdk.Deck(layers=layers_to_render, initial_view_state=view_state, map_style='light', tooltip=tooltip)
-            st.pydeck_chart(deck)
+            with metrics.span("pydeck_chart"):
+                st.pydeck_chart(deck)
+            map_progress.done("render")
 
     st.balloons()
 
     map_progress_bar.empty()
 
-    consolidated_df = generate_yearly_ntl_dataframe(year_dict_provinces, province)
-    consolidated_df['Year'] = pd.to_numeric(consolidated_df['Year'],errors='coerce')
-    consolidated_df = consolidated_df.sort_values(by=['Year', province])
-
-    # 创建累积数据的DataFrame，每一年的数据都会包含小于等于这个年份的所有数据，从而在下方实现折线图动画
-    sorted_years = sorted(consolidated_df['Year'].unique())
-    cumulative_list = []
-
-    for year in sorted_years:
-        animation_df = consolidated_df[consolidated_df['Year'] <= year].copy()
-        animation_df['animation_frame_id'] = year
-        cumulative_list.append(animation_df)
-
-    cumulative_plot_df = pd.concat(cumulative_list)
+    if bbox_text:
+        try:
+            minx, miny, maxx, maxy = (float(v) for v in bbox_text.replace("，", ",").split(","))
+        except ValueError:
+            st.sidebar.warning("经纬度范围的格式不对，应该是四个用逗号分开的数字")
+        else:
+            import shapely
+            show_region_series(shapely.box(minx, miny, maxx, maxy), f"范围({bbox_text})")
 
     st.subheader("所有省份夜间灯光强度历年变化趋势（动画）:chart_with_upwards_trend:")
     container=st.container(border=True)
@@ -366,30 +527,16 @@ def main():
 
     with st.spinner("正在生成动画折线图"):
 
-        fig_all_provinces = px.line(
-            cumulative_plot_df,
-            x="Year",
-            y="NTL_Value",
-            color="省",
-            line_group="省",
-            animation_frame="animation_frame_id",
-            animation_group="省",
-            markers=True,
-            labels={
-                "Year": "年份",
-                "NTL_Value": f"平均灯光强度",
-                "省": "省份/区域",
-                "animation_frame_id": "动画播放年份"
-            },
-            width = 1000, height = 600,
-            color_discrete_sequence = px.colors.qualitative.Light24
-        )
-
-
-        #这个设置的参考来源https://stackoverflow.com/questions/70523979/how-to-create-an-animated-line-plot-with-ploty-express
-        fig_all_provinces.layout.updatemenus[0].buttons[0].args[1]['frame']['redraw'] = True
-
-        st.plotly_chart(fig_all_provinces, use_container_width=True)
+        # 动画的帧每个数据集只生成一次，之后各次重新运行直接复用
+        fig_all_provinces = load_trend_figure(provinces_store_dir, province)
+        if metrics.enabled():
+            metrics.gauge("bytes_serialized", len(fig_all_provinces.to_json()), payload="trend_figure")
+
+        with metrics.span("plotly_chart"):
+            st.plotly_chart(fig_all_provinces, use_container_width=True)
+
+    if show_debug_panel:
+        render_debug_panel()
 
 
 
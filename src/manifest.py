@@ -0,0 +1,49 @@
+import hashlib
+import json
+import os
+
+# 记录输入文件“指纹”的清单，用来判断某一步的输入有没有变化，没变就跳过不重新计算。
+# 默认只比较文件大小和修改时间，速度很快；如果担心修改时间不可靠（比如从别处拷贝过来），可以用内容哈希
+
+
+def file_fingerprint(path, use_hash=False):
+    stat = os.stat(path)
+    fingerprint = {"size": stat.st_size, "mtime_ns": stat.st_mtime_ns}
+    if use_hash:
+        sha = hashlib.sha256()
+        with open(path, "rb") as f:
+            for chunk in iter(lambda: f.read(1 << 20), b""):
+                sha.update(chunk)
+        # 用哈希的时候修改时间就不参与比较了
+        fingerprint = {"size": stat.st_size, "sha256": sha.hexdigest()}
+    return fingerprint
+
+
+def shapefile_fingerprint(shp_path, use_hash=False):
+    # shapefile是好几个同名文件一起用的，任何一个变了都算变了
+    stem = os.path.splitext(shp_path)[0]
+    fingerprint = {}
+    for ext in (".shp", ".shx", ".dbf", ".prj", ".cpg"):
+        part = stem + ext
+        if os.path.exists(part):
+            fingerprint[ext] = file_fingerprint(part, use_hash)
+    return fingerprint
+
+
+def load_manifest(path):
+    if not os.path.exists(path):
+        return {}
+    try:
+        with open(path, "r", encoding="utf-8") as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        # 清单坏了就当作没有，大不了全部重新算一遍
+        return {}
+
+
+def save_manifest(manifest, path):
+    # 先写临时文件再替换，中途被打断也不会留下写了一半的清单
+    tmp_path = path + ".tmp"
+    with open(tmp_path, "w", encoding="utf-8") as f:
+        json.dump(manifest, f, ensure_ascii=False, indent=2, sort_keys=True)
+    os.replace(tmp_path, path)
@@ -0,0 +1,257 @@
+import argparse
+import glob
+import hashlib
+import json
+import os
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
+import numpy as np
+from manifest import file_fingerprint, load_manifest, save_manifest
+from zonal_engine import year_from_path
+import metrics
+
+# 把每一年的地图离线渲染出来，拼成GIF或MP4动画，这就是README里说的“1992-2022夜间灯光变化动画地图”。
+# 以前只能在页面上一年一年地切换选择框。这里：
+#   - 区域几何只投影一次（Web墨卡托），拆成扁平的外环坐标，发给每个渲染进程一次，每个进程只建一次画布
+#   - 颜色用所有年份统一的数值范围，不同年份之间颜色才能对比
+#   - 各年份的帧在进程池里并行渲染成PNG写到帧目录，编码器按年份顺序一帧一帧地读进来，
+#     同一时间只有进程池里正在渲染的那几帧在内存里
+#   - 每一帧记下它的数据和渲染参数的哈希，数据没变的年份下次直接用上次的PNG，不再重新渲染
+# 除了省级/市级的分区着色图，也可以直接把切割后的像元级栅格画成帧（--layer raster）。
+# 编码用imageio：GIF需要pillow，MP4还需要imageio-ffmpeg
+
+abspath = os.path.dirname(os.path.abspath(__file__))
+store_dirs = {
+    "provinces": os.path.join(abspath, "ntl_store", "provinces"),
+    "cities": os.path.join(abspath, "ntl_store", "cities"),
+}
+tiff_path = os.path.join(abspath, "regions_excluded_tiffs")
+output_dir = os.path.join(abspath, "exports")
+frames_manifest_name = "frames.json"
+DEFAULT_SIZE = (1000, 800)
+DEFAULT_CMAP = "YlOrRd"
+PROJECTED_EPSG = 3857
+NO_DATA_COLOR = (0.85, 0.85, 0.85, 1.0)
+# 标题是中文，matplotlib默认的DejaVu Sans没有中文字形，会画成方块。按顺序找系统里有的中文字体，
+# matplotlib 3.6以上缺字的时候会依次往后找
+CJK_FONTS = ["Noto Sans CJK SC", "Source Han Sans SC", "WenQuanYi Zen Hei", "WenQuanYi Micro Hei", "SimHei",
+             "Microsoft YaHei", "PingFang SC", "Heiti SC", "Arial Unicode MS"]
+# 像元级栅格默认用哪一种TIFF，和分区统计一样用传感器相互校正以后的
+DEFAULT_TIF_PATTERN = "calibrated_*.tif"
+
+# 每个渲染进程自己的画布，进程启动时建好，之后每一帧只换颜色和标题
+_worker = {}
+
+
+def frame_path(frames_dir, year):
+    return os.path.join(frames_dir, f"{year}.png")
+
+
+def _frame_hash(*parts):
+    sha = hashlib.sha1()
+    for part in parts:
+        sha.update(part if isinstance(part, bytes) else json.dumps(part, sort_keys=True).encode("utf-8"))
+    return sha.hexdigest()
+
+
+def _save_png(rgba, path):
+    from PIL import Image
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    tmp_path = path + ".tmp.png"
+    Image.fromarray(rgba).save(tmp_path)
+    os.replace(tmp_path, path)
+    return path
+
+
+# ---------- 分区着色图 ----------
+
+def _init_choropleth_worker(coords, offsets, owners, size, cmap_name, vmin, vmax, title):
+    import matplotlib
+    matplotlib.use("Agg")
+    matplotlib.rcParams["font.family"] = "sans-serif"
+    matplotlib.rcParams["font.sans-serif"] = CJK_FONTS + list(matplotlib.rcParams["font.sans-serif"])
+    matplotlib.rcParams["axes.unicode_minus"] = False
+    from matplotlib import colormaps
+    from matplotlib.backends.backend_agg import FigureCanvasAgg
+    from matplotlib.cm import ScalarMappable
+    from matplotlib.collections import PolyCollection
+    from matplotlib.colors import Normalize
+    from matplotlib.figure import Figure
+
+    width, height = size
+    figure = Figure(figsize=(width / 100, height / 100), dpi=100)
+    canvas = FigureCanvasAgg(figure)
+    ax = figure.add_axes([0.02, 0.02, 0.86, 0.9])
+    ax.set_axis_off()
+    collection = PolyCollection(np.split(coords, offsets[1:-1]), edgecolors=(1, 1, 1, 0.5), linewidths=0.3)
+    ax.add_collection(collection)
+    ax.set_xlim(coords[:, 0].min(), coords[:, 0].max())
+    ax.set_ylim(coords[:, 1].min(), coords[:, 1].max())
+    ax.set_aspect("equal")
+    norm = Normalize(vmin=vmin, vmax=vmax)
+    cmap = colormaps[cmap_name]
+    figure.colorbar(ScalarMappable(norm=norm, cmap=cmap), cax=figure.add_axes([0.9, 0.15, 0.02, 0.6]))
+    title_text = figure.suptitle("", fontsize=16)
+    _worker.update(canvas=canvas, collection=collection, owners=owners, norm=norm, cmap=cmap,
+                   title_text=title_text, title=title)
+
+
+def _render_choropleth_frame(year, zone_values, path):
+    colors = _worker["cmap"](_worker["norm"](zone_values[_worker["owners"]]))
+    colors[np.isnan(zone_values[_worker["owners"]])] = NO_DATA_COLOR
+    _worker["collection"].set_facecolor(colors)
+    _worker["title_text"].set_text(f"{year}年 {_worker['title']}")
+    canvas = _worker["canvas"]
+    canvas.draw()
+    return _save_png(np.asarray(canvas.buffer_rgba())[:, :, :3].copy(), path)
+
+
+def choropleth_jobs(layer, frames_dir, size, cmap_name, previous, force):
+    # 返回 (进程池初始化参数, [(年份, 需要渲染的参数或None, 哈希)])，数据没变的年份参数是None
+    import ntl_store
+    from ntl_analytics import stats_matrix
+    import map_layers
+    store_dir = store_dirs[layer]
+    zones = ntl_store.read_zones(store_dir)
+    rings = map_layers.polygon_rings(zones, epsg=PROJECTED_EPSG)
+    stats_df = ntl_store.read_stats(store_dir, stats=("mean",))
+    # 行数按区域表来定：最后几个zone_id要是空几何、没有环，按owners的最大值就会少几行，取色时越界
+    years, matrix = stats_matrix(stats_df, "mean", n_zones=len(zones))
+    # 所有年份统一的颜色范围
+    vmin, vmax = float(np.nanmin(matrix)), float(np.nanmax(matrix))
+    title = "省级夜间灯光平均强度" if layer == "provinces" else "市级夜间灯光平均强度"
+    params = {"layer": layer, "size": list(size), "cmap": cmap_name, "vmin": vmin, "vmax": vmax}
+    geometry_hash = _frame_hash(rings.coords.tobytes(), rings.owners.tobytes())
+    initargs = (rings.coords, rings.offsets, rings.owners, size, cmap_name, vmin, vmax, title)
+    jobs = []
+    for j, year in enumerate(years):
+        zone_values = np.ascontiguousarray(matrix[:, j])
+        digest = _frame_hash(params, geometry_hash.encode("utf-8"), zone_values.tobytes())
+        path = frame_path(frames_dir, year)
+        unchanged = not force and previous.get(str(year)) == digest and os.path.exists(path)
+        jobs.append((int(year), None if unchanged else (int(year), zone_values, path), digest))
+    return (_init_choropleth_worker, initargs), _render_choropleth_frame, jobs
+
+
+# ---------- 像元级栅格 ----------
+
+def _init_raster_worker(size, cmap_name):
+    import raster_tiles
+    _worker.update(size=size, lut=raster_tiles.colormap_lut(cmap_name))
+
+
+def _render_raster_frame(year, tif_path, path):
+    # 整幅栅格按输出尺寸抽稀着读，读进来的像元数只和帧的大小有关
+    import rasterio
+    from rasterio.enums import Resampling
+    from PIL import Image, ImageDraw
+    import raster_tiles
+    width, height = _worker["size"]
+    with rasterio.open(tif_path) as src:
+        scale = min(width / src.width, height / src.height)
+        out_shape = (max(1, int(src.height * scale)), max(1, int(src.width * scale)))
+        band = src.read(1, out_shape=out_shape, resampling=Resampling.average)
+        nodata = src.nodata
+    valid = np.ones(band.shape, dtype=bool) if nodata is None else band != nodata
+    rgba = raster_tiles.colorize(band, valid, _worker["lut"])
+    canvas = Image.new("RGB", (width, height), (0, 0, 0))
+    tile = Image.fromarray(rgba, mode="RGBA")
+    canvas.paste(tile, ((width - tile.width) // 2, (height - tile.height) // 2), tile)
+    ImageDraw.Draw(canvas).text((20, 20), f"{year}", fill=(255, 255, 255))
+    return _save_png(np.asarray(canvas), path)
+
+
+def raster_jobs(frames_dir, size, cmap_name, previous, force, tif_pattern=DEFAULT_TIF_PATTERN):
+    tif_files = sorted(glob.glob(os.path.join(tiff_path, tif_pattern)), key=year_from_path)
+    params = {"layer": "raster", "size": list(size), "cmap": cmap_name}
+    jobs = []
+    for tif_path in tif_files:
+        year = int(year_from_path(tif_path))
+        digest = _frame_hash(params, file_fingerprint(tif_path))
+        path = frame_path(frames_dir, year)
+        unchanged = not force and previous.get(str(year)) == digest and os.path.exists(path)
+        jobs.append((year, None if unchanged else (year, tif_path, path), digest))
+    return (_init_raster_worker, (size, cmap_name)), _render_raster_frame, jobs
+
+
+# ---------- 渲染和编码 ----------
+
+def ordered_frames(pool, render, jobs, frames_dir, max_in_flight):
+    # 按年份顺序依次给出每一帧的PNG路径。需要渲染的帧提交到进程池，但同时在路上的不超过max_in_flight个，
+    # 编码器消费得慢的时候就不会有一堆渲染好的帧堆在内存里
+    pending = deque()
+    for year, args, _ in jobs:
+        pending.append(pool.submit(render, *args) if args is not None else frame_path(frames_dir, year))
+        if len(pending) >= max_in_flight:
+            item = pending.popleft()
+            yield item if isinstance(item, str) else item.result()
+    while pending:
+        item = pending.popleft()
+        yield item if isinstance(item, str) else item.result()
+
+
+def export_animation(layer, output_path, fps=2, size=DEFAULT_SIZE, cmap_name=DEFAULT_CMAP, workers=None,
+                     force=False, tif_pattern=DEFAULT_TIF_PATTERN):
+    try:
+        import imageio.v2 as imageio
+    except ImportError as error:
+        raise ImportError("导出动画需要安装imageio（MP4还需要imageio-ffmpeg）: pip install imageio imageio-ffmpeg") from error
+    from PIL import Image
+
+    frames_dir = os.path.join(output_dir, "frames", f"{layer}_{cmap_name}_{size[0]}x{size[1]}")
+    manifest_path = os.path.join(frames_dir, frames_manifest_name)
+    previous = load_manifest(manifest_path)
+    with metrics.span("export_prepare", layer=layer):
+        if layer == "raster":
+            (initializer, initargs), render, jobs = raster_jobs(frames_dir, size, cmap_name, previous, force,
+                                                                tif_pattern)
+        else:
+            (initializer, initargs), render, jobs = choropleth_jobs(layer, frames_dir, size, cmap_name,
+                                                                    previous, force)
+    if not jobs:
+        # 一帧都没有的时候不写一个空动画出来
+        source = os.path.join(tiff_path, tif_pattern) if layer == "raster" else store_dirs[layer]
+        raise FileNotFoundError(f"{source}里没有任何年份的数据，没有可以导出的帧")
+    rendered = sum(1 for _, args, _ in jobs if args is not None)
+
+    os.makedirs(os.path.dirname(os.path.abspath(output_path)), exist_ok=True)
+    writer_args = {"duration": 1 / fps, "loop": 0} if output_path.lower().endswith(".gif") else {"fps": fps}
+    with metrics.span("export_encode", layer=layer), \
+            ProcessPoolExecutor(max_workers=workers, initializer=initializer, initargs=initargs) as pool, \
+            imageio.get_writer(output_path, **writer_args) as writer:
+        max_in_flight = 2 * (workers or os.cpu_count() or 1)
+        for path in ordered_frames(pool, render, jobs, frames_dir, max_in_flight):
+            with Image.open(path) as image:
+                writer.append_data(np.asarray(image.convert("RGB")))
+
+    save_manifest({str(year): digest for year, _, digest in jobs}, manifest_path)
+    return len(jobs), rendered
+
+
+def main():
+    parser = argparse.ArgumentParser(description="把历年夜间灯光地图导出成GIF/MP4动画")
+    parser.add_argument("--layer", choices=(*store_dirs, "raster"), default="provinces")
+    parser.add_argument("--output", default=None, help="输出文件，后缀是.gif或.mp4，默认是exports/{图层}.gif")
+    parser.add_argument("--fps", type=float, default=2)
+    parser.add_argument("--width", type=int, default=DEFAULT_SIZE[0])
+    parser.add_argument("--height", type=int, default=DEFAULT_SIZE[1])
+    parser.add_argument("--cmap", default=None, help="色带名称，分区图默认YlOrRd，栅格默认inferno")
+    parser.add_argument("--workers", type=int, default=None)
+    parser.add_argument("--force", action="store_true", help="忽略帧缓存，所有帧都重新渲染")
+    parser.add_argument("--tif-pattern", default=DEFAULT_TIF_PATTERN,
+                        help="--layer raster用哪一种TIFF，没有运行过calibration.py的话用clipped_*.tif")
+    args = parser.parse_args()
+
+    output_path = args.output or os.path.join(output_dir, f"{args.layer}.gif")
+    cmap_name = args.cmap or ("inferno" if args.layer == "raster" else DEFAULT_CMAP)
+    try:
+        total, rendered = export_animation(args.layer, output_path, args.fps, (args.width, args.height), cmap_name,
+                                           args.workers, args.force, args.tif_pattern)
+    except FileNotFoundError as error:
+        parser.exit(1, f"{error}\n")
+    print(f"{output_path}: 共{total}帧，重新渲染了{rendered}帧")
+    metrics.dump_if_requested()
+
+
+if __name__ == "__main__":
+    main()
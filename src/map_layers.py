@@ -0,0 +1,149 @@
+import numpy as np
+import pandas as pd
+
+# 地图图层要用到的、只和几何有关的数据都在这里预先算好。这些东西只依赖区域几何，
+# 和年份、配色都没有关系，所以每套几何只算一次，缓存起来以后每次交互只需要换数值。
+# main.py启动时就会导入这个模块，shapely只在真正要算几何的函数里才导入
+
+# 城市灯光点标记在浏览器里由这个回调函数生成，Python这边只需要传一个 [纬度, 经度, 名称, 数值] 的数组
+CITY_MARKER_CALLBACK = """
+function (row) {
+    var icon = L.AwesomeMarkers.icon({icon: 'circle-arrow-down', prefix: 'glyphicon', markerColor: 'blue'});
+    var marker = L.marker(new L.LatLng(row[0], row[1]), {icon: icon});
+    marker.bindTooltip(row[2] + ' - 灯光强度: ' + row[3].toFixed(2));
+    return marker;
+};
+"""
+# 没有数值的区域画成浅灰色，和map_export.py导出的图一致
+NO_DATA_RGB = (217, 217, 217)
+
+
+def to_wgs84(gdf):
+    if gdf.crs is not None and gdf.crs.to_epsg() != 4326:
+        gdf = gdf.to_crs(epsg=4326)
+    return gdf
+
+
+def zone_geometries(zones, epsg=4326):
+    # zones可以是带zone_id列的GeoDataFrame，也可以是ntl_model的数据模型（不需要geopandas），
+    # 返回 (投影到epsg的几何数组, zone_id数组)
+    if hasattr(zones, "geometry_in"):
+        return zones.geometry_in(epsg), zones.zone_ids
+    if zones.crs is not None and zones.crs.to_epsg() != epsg:
+        zones = zones.to_crs(epsg=epsg)
+    return np.asarray(zones.geometry.values), zones["zone_id"].to_numpy()
+
+
+def zone_points(zones):
+    # 每个区域的中心点（经纬度），返回以zone_id为索引的DataFrame
+    import shapely
+    geometries, zone_ids = zone_geometries(zones)
+    valid = ~(shapely.is_missing(geometries) | shapely.is_empty(geometries))
+    centroids = shapely.centroid(geometries[valid])
+    return pd.DataFrame({
+        "lat": shapely.get_y(centroids),
+        "lon": shapely.get_x(centroids),
+    }, index=pd.Index(zone_ids[valid], name="zone_id"))
+
+
+def marker_rows(points, names, values):
+    # points来自zone_points，names和values是以zone_id为索引的Series，没有数值的区域不画点
+    frame = points.join(pd.DataFrame({"name": names, "value": values}), how="inner")
+    frame = frame[frame["value"].notna()]
+    return frame[["lat", "lon", "name", "value"]].values.tolist()
+
+
+class FlatPaths:
+    # 一组折线/多边形外环，所有坐标放在一个扁平的(N, 2)数组里，第i条的坐标是coords[offsets[i]:offsets[i+1]]，
+    # owners[i]是它属于原来第几行（比如哪个区域）
+    def __init__(self, coords, offsets, owners):
+        self.coords = coords
+        self.offsets = offsets
+        self.owners = owners
+        self._nested = None
+        self._nested_polygons = None
+
+    def __len__(self):
+        return len(self.owners)
+
+    def nested(self):
+        # pydeck要的是每条一个坐标列表。这个列表只生成一次，之后每次渲染都直接复用
+        if self._nested is None:
+            self._nested = [part.tolist() for part in np.split(self.coords, self.offsets[1:-1])]
+        return self._nested
+
+    def nested_polygons(self):
+        # PolygonLayer的每个多边形是 [外环] 这样多套一层的列表
+        if self._nested_polygons is None:
+            self._nested_polygons = [[ring] for ring in self.nested()]
+        return self._nested_polygons
+
+
+def _flatten(rings, owners):
+    import shapely
+    coords, ring_index = shapely.get_coordinates(rings, return_index=True)
+    counts = np.bincount(ring_index, minlength=len(rings))
+    offsets = np.concatenate(([0], np.cumsum(counts)))
+    return FlatPaths(coords, offsets, owners)
+
+
+def polygon_rings(zones, epsg=4326):
+    # 把(Multi)Polygon拆成单个多边形再取外环，相当于以前的explode加上x.exterior.coords，但一次向量化做完。
+    # 地图用经纬度；离线渲染的时候可以直接给一个投影坐标系，几何只投影这一次
+    import shapely
+    geometries, zone_ids = zone_geometries(zones, epsg)
+    parts, part_index = shapely.get_parts(geometries, return_index=True)
+    is_polygon = shapely.get_type_id(parts) == 3
+    polygons, part_index = parts[is_polygon], part_index[is_polygon]
+    exteriors = shapely.get_exterior_ring(polygons)
+    return _flatten(exteriors, zone_ids[part_index])
+
+
+def line_paths(gdf):
+    # 国界线这种(Multi)LineString，拆成单条折线
+    import shapely
+    gdf = to_wgs84(gdf)
+    lines, part_index = shapely.get_parts(np.asarray(gdf.geometry.values), return_index=True)
+    return _flatten(lines, part_index)
+
+
+def colormap_colors(values, cmap_name, vmin=None, vmax=None):
+    # 整列数值一次性映射成RGB，返回(N, 3)的uint8数组。matplotlib只有这里用，用到的时候才导入
+    from matplotlib import colormaps
+    from matplotlib.colors import Normalize
+    values = np.asarray(values, dtype=np.float64)
+    valid = ~np.isnan(values)
+    # 没有数值的（比如某一年一个市都没有数据）都给无数据的颜色，不让nanmin在空数组上报错
+    rgb = np.tile(np.asarray(NO_DATA_RGB, dtype=np.uint8), (len(values), 1))
+    if not valid.any():
+        return rgb
+    vmin = np.nanmin(values) if vmin is None else vmin
+    vmax = np.nanmax(values) if vmax is None else vmax
+    rgb[valid] = colormaps[cmap_name](Normalize(vmin=vmin, vmax=vmax)(values[valid]), bytes=True)[:, :3]
+    return rgb
+
+
+def hex_colors(values, cmap_name, vmin=None, vmax=None):
+    # 和colormap_colors一样，只是输出成网页用的#rrggbb字符串，没有数值的是None
+    values = np.asarray(values, dtype=np.float64)
+    valid = ~np.isnan(values)
+    colors = [None] * len(values)
+    if valid.any():
+        rgb = colormap_colors(values[valid], cmap_name, vmin, vmax)
+        for i, (r, g, b) in zip(np.flatnonzero(valid), rgb):
+            colors[i] = f"#{r:02x}{g:02x}{b:02x}"
+    return colors
+
+
+def polygon_layer_data(rings, values_by_zone, value_column, cmap_name):
+    # rings是缓存好的FlatPaths，values_by_zone是以zone_id为索引的当年数值（可以带名称等提示框要用的列）。
+    # 几何部分直接复用，每次只按环的归属把数值和颜色展开一遍
+    data = values_by_zone.reindex(rings.owners).reset_index(drop=True)
+    data["coordinates"] = rings.nested_polygons()
+    data = data[data[value_column].notna()].reset_index(drop=True)
+    data["fill_color"] = colormap_colors(data[value_column].to_numpy(), cmap_name).tolist()
+    return data
+
+
+def path_layer_data(paths):
+    return pd.DataFrame({"path": paths.nested()})
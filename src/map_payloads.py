@@ -0,0 +1,76 @@
+import threading
+from collections import Counter
+from concurrent.futures import ThreadPoolExecutor
+import data_cache
+import metrics
+
+# 做好的地图页面（folium生成的整段HTML）的缓存。多人同时用的时候，每个会话都在为同样的
+# （年份, 配色方案, 分级数）重新生成一模一样的地图，而这三个参数一共也就 32年 × 18种配色 × 分级滑块 这么多组合。
+# 这里把生成好的HTML按这三个参数缓存起来，整个进程只有一份，所有会话共用；键里还带着数据版本，数据一变就失效。
+# 每次有人看了某个组合，就在后台线程池里把同一配色、同一分级下的其他年份也提前生成好，
+# 换年份的时候基本都是直接命中缓存。被请求最多的组合也会优先预热。
+# 进程启动后第一次用到的时候，先把默认配色、默认分级下的所有年份预热好，第一个打开页面的人也不用等。
+# 已经在缓存里的键不会再提交到线程池，每次页面重跑只提交真正缺的那几个
+
+DEFAULT_MAX_ENTRIES = 256
+DEFAULT_MAX_BYTES = 512 * 1024 * 1024
+WARM_WORKERS = 2
+# 页面上配色方案和分级数的默认值，也是启动时预热的组合
+DEFAULT_SCHEME = "YlOrRd"
+DEFAULT_BINS = 7
+
+
+def render_html(folium_map):
+    return folium_map.get_root().render()
+
+
+class RenderCache:
+    def __init__(self, max_entries=DEFAULT_MAX_ENTRIES, max_bytes=DEFAULT_MAX_BYTES, warm_workers=WARM_WORKERS):
+        self.cache = data_cache.SharedCache(max_entries=max_entries, max_bytes=max_bytes)
+        self.requests = Counter()
+        self._lock = threading.Lock()
+        self._pool = ThreadPoolExecutor(max_workers=warm_workers, thread_name_prefix="map-warm")
+        self._warming = set()
+        self._seeded = set()
+
+    def get(self, key, version, build):
+        # build(key)返回HTML字符串。同一个键同时只会有一个线程在生成，别的会话等它生成完直接用
+        with self._lock:
+            self.requests[key] += 1
+        with metrics.span("map_payload"):
+            return self.cache.get_or_load("map_payload", key, version, lambda: build(key))
+
+    def _warm_one(self, key, version, build):
+        try:
+            self.cache.get_or_load("map_payload", key, version, lambda: build(key))
+            metrics.count("map_payload_warmed")
+        finally:
+            with self._lock:
+                self._warming.discard((key, version))
+
+    def warm(self, keys, version, build):
+        # 后台预热，不等结果。已经缓存好的、已经在预热队列里的键都不重复提交
+        for key in dict.fromkeys(keys):
+            if self.cache.contains("map_payload", key, version):
+                continue
+            with self._lock:
+                if (key, version) in self._warming:
+                    continue
+                self._warming.add((key, version))
+            self._pool.submit(self._warm_one, key, version, build)
+
+    def seed(self, years, version, build, scheme=DEFAULT_SCHEME, bins=DEFAULT_BINS):
+        # 默认配色、默认分级下的所有年份，每个数据版本只提交一次
+        with self._lock:
+            if version in self._seeded:
+                return
+            self._seeded.add(version)
+        self.warm([(year, scheme, bins) for year in years], version, build)
+
+    def popular(self, n=10):
+        with self._lock:
+            return [key for key, _ in self.requests.most_common(n)]
+
+
+# 整个进程共用的一个实例
+render_cache = RenderCache()
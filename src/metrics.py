@@ -0,0 +1,206 @@
+import functools
+import json
+import os
+import threading
+import time
+
+# 轻量的计时和计数。dashboard慢的时候，想知道时间到底花在读数据、生成GeoJSON、folium、st_folium
+# 还是Plotly序列化上，以前只能靠猜。这里提供三种量：
+#   span     计时区间，with metrics.span("名字"): ... 记录次数、总耗时、最长一次、最近一次
+#   counter  计数器，比如缓存命中/未命中
+#   gauge    当前值，比如这次序列化了多少字节
+# 默认是关着的，关着的时候span返回一个什么都不做的共享对象，counter和gauge直接返回，几乎没有开销。
+# 打开方法：环境变量NTL_METRICS=1，或者调用set_enabled(True)。这是整个进程的开关，app里的调试面板只是显示结果，不会去改它。
+# 批处理脚本设置了NTL_METRICS_FILE的话，结束时会把结果写到这个文件，后缀是.json写JSON，否则写Prometheus文本格式
+
+_enabled = os.environ.get("NTL_METRICS", "") not in ("", "0")
+_lock = threading.Lock()
+_spans = {}
+_counters = {}
+_gauges = {}
+
+
+class _NullSpan:
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        return False
+
+
+_NULL_SPAN = _NullSpan()
+
+
+def enabled():
+    return _enabled
+
+
+def set_enabled(value=True):
+    global _enabled
+    _enabled = bool(value)
+
+
+def _key(name, labels):
+    return name, tuple(sorted(labels.items())) if labels else ()
+
+
+class _Span:
+    __slots__ = ("key", "start")
+
+    def __init__(self, key):
+        self.key = key
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc):
+        record_duration(self.key, time.perf_counter() - self.start)
+        return False
+
+
+def record_duration(key, seconds):
+    with _lock:
+        entry = _spans.get(key)
+        if entry is None:
+            entry = _spans[key] = {"count": 0, "total": 0.0, "max": 0.0, "last": 0.0}
+        entry["count"] += 1
+        entry["total"] += seconds
+        entry["last"] = seconds
+        if seconds > entry["max"]:
+            entry["max"] = seconds
+
+
+def span(name, **labels):
+    if not _enabled:
+        return _NULL_SPAN
+    return _Span(_key(name, labels))
+
+
+def observe(name, seconds, **labels):
+    # 直接记一段已经量好的耗时。和span不同，不管开没开都会记录，给app启动这种只发生一次、开关还没来得及打开的事情用
+    record_duration(_key(name, labels), seconds)
+
+
+def timed(name, **labels):
+    # 装饰器版本的span
+    def decorator(func):
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            with span(name, **labels):
+                return func(*args, **kwargs)
+        return wrapper
+    return decorator
+
+
+def count(name, value=1, **labels):
+    if not _enabled:
+        return
+    key = _key(name, labels)
+    with _lock:
+        _counters[key] = _counters.get(key, 0) + value
+
+
+def gauge(name, value, **labels):
+    if not _enabled:
+        return
+    with _lock:
+        _gauges[_key(name, labels)] = value
+
+
+def reset():
+    with _lock:
+        _spans.clear()
+        _counters.clear()
+        _gauges.clear()
+
+
+def _label_dict(key):
+    return dict(key[1])
+
+
+def snapshot():
+    with _lock:
+        return {
+            "spans": [{"name": k[0], "labels": _label_dict(k), **v} for k, v in sorted(_spans.items())],
+            "counters": [{"name": k[0], "labels": _label_dict(k), "value": v} for k, v in sorted(_counters.items())],
+            "gauges": [{"name": k[0], "labels": _label_dict(k), "value": v} for k, v in sorted(_gauges.items())],
+        }
+
+
+def to_json():
+    return json.dumps(snapshot(), ensure_ascii=False, indent=2)
+
+
+def _prometheus_name(name):
+    return "ntl_" + "".join(c if c.isalnum() else "_" for c in name)
+
+
+def _escape(value):
+    return str(value).replace("\\", "\\\\").replace('"', '\\"')
+
+
+def _prometheus_labels(labels):
+    if not labels:
+        return ""
+    return "{" + ",".join(f'{k}="{_escape(v)}"' for k, v in labels.items()) + "}"
+
+
+def to_prometheus():
+    data = snapshot()
+    lines = []
+    for entry in data["spans"]:
+        base, labels = _prometheus_name(entry["name"]), _prometheus_labels(entry["labels"])
+        lines.append(f"{base}_seconds_total{labels} {entry['total']:.6f}")
+        lines.append(f"{base}_seconds_count{labels} {entry['count']}")
+        lines.append(f"{base}_seconds_max{labels} {entry['max']:.6f}")
+    for entry in data["counters"]:
+        lines.append(f"{_prometheus_name(entry['name'])}_total{_prometheus_labels(entry['labels'])} {entry['value']}")
+    for entry in data["gauges"]:
+        lines.append(f"{_prometheus_name(entry['name'])}{_prometheus_labels(entry['labels'])} {entry['value']}")
+    return "\n".join(lines) + "\n"
+
+
+def dump(path):
+    text = to_json() if path.endswith(".json") else to_prometheus()
+    with open(path, "w", encoding="utf-8") as f:
+        f.write(text)
+
+
+def dump_if_requested():
+    # 批处理脚本结束时调用
+    path = os.environ.get("NTL_METRICS_FILE")
+    if _enabled and path:
+        dump(path)
+
+
+# 每个阶段上一次运行花的时间，给进度条当权重用
+_last_stage_seconds = {}
+
+
+class StageProgress:
+    # 进度条按实际测到的耗时前进，而不是写死的30、50、60：每个阶段的权重是上一次运行时这个阶段花的时间，
+    # 第一次运行还没有测量值，就按各阶段平均分。阶段是按顺序一个接一个的，每完成一个调用一次done，
+    # 耗时就是距离上一次done的时间。这部分不管开没开metrics都会记录，每个阶段只多一次计时
+    def __init__(self, progress_bar, stages):
+        self.progress_bar = progress_bar
+        known = [_last_stage_seconds.get(stage) for stage in stages]
+        measured = [v for v in known if v]
+        default = sum(measured) / len(measured) if measured else 1.0
+        weights = [v or default for v in known]
+        total = sum(weights)
+        self.done_fraction = {}
+        cumulative = 0.0
+        for stage, weight in zip(stages, weights):
+            cumulative += weight
+            self.done_fraction[stage] = cumulative / total
+        self.last = time.perf_counter()
+
+    def done(self, name):
+        now = time.perf_counter()
+        elapsed, self.last = now - self.last, now
+        _last_stage_seconds[name] = elapsed
+        if _enabled:
+            record_duration(_key(f"stage.{name}", None), elapsed)
+        if name in self.done_fraction:
+            self.progress_bar.progress(min(100, int(self.done_fraction[name] * 100)))
@@ -0,0 +1,268 @@
+import argparse
+import glob
+import multiprocessing
+import os
+import sys
+import time
+from concurrent.futures import ThreadPoolExecutor, FIRST_COMPLETED, wait
+from manifest import file_fingerprint, load_manifest, save_manifest
+from zonal_engine import year_from_path
+
+# 整个处理流程的统一入口，在src目录下运行：
+#   python -m ntl run       只重新运行输入有变化的阶段
+#   python -m ntl status    看一下哪些阶段需要重新运行
+# 流程被描述成一个有向无环图：切割 → 传感器相互校正 → 分区统计（省级和市级一起，每年的栅格只读一次）→ 地图用的简化几何，
+# 校正之后还有一支是像元级的数据立方体和趋势指标。
+# 每个阶段声明自己的输入和输出文件，输入的指纹记在pipeline_manifest.json里，输入没变、输出也都在的阶段直接跳过。
+# 分区统计阶段在边界没变的时候只重新统计变化了的那几年，所以每天新加一年的数据只需要几秒钟
+
+abspath = os.path.dirname(os.path.abspath(__file__))
+manifest_file_name = "pipeline_manifest.json"
+
+
+class Stage:
+    # inputs和outputs是函数，因为像“所有切割后的TIFF”这样的文件列表要在运行到这一步的时候才知道
+    def __init__(self, name, inputs, outputs, action, deps=()):
+        self.name = name
+        self.inputs = inputs
+        self.outputs = outputs
+        self.action = action
+        self.deps = tuple(deps)
+
+
+def _shapefile_parts(shp_path):
+    # 可选的部分（.prj、.cpg）不存在就不算输入；必需的部分即使被删了也要列出来，这样删除也会被当成变化
+    stem = os.path.splitext(shp_path)[0]
+    return [stem + ext for ext in (".shp", ".shx", ".dbf", ".prj", ".cpg")
+            if ext in (".shp", ".shx", ".dbf") or os.path.exists(stem + ext)]
+
+
+def _raw_tifs(root):
+    return sorted(glob.glob(os.path.join(root, "*.tif")))
+
+
+def _clipped_tifs(root):
+    return sorted(glob.glob(os.path.join(root, "regions_excluded_tiffs", "clipped_*.tif")))
+
+
+def _calibrated_tifs(root):
+    return sorted(glob.glob(os.path.join(root, "regions_excluded_tiffs", "calibrated_*.tif")))
+
+
+def _store_files(root, layer):
+    import ntl_store
+    store_dir = os.path.join(root, "ntl_store", layer)
+    return [ntl_store.zones_path(store_dir), ntl_store.stats_path(store_dir), ntl_store.analytics_path(store_dir)]
+
+
+# ---------- 各阶段实际要做的事 ----------
+# changed是这次输入里变化了的文件列表，None表示要全部重做
+
+def preprocess_action(root, changed):
+    import data_preprocessing
+    # 切割这一步自己有按文件的清单，只会处理变化了的TIFF
+    data_preprocessing.preprocess(_raw_tifs(root), os.path.join(root, "boundaries", "省级.shp"),
+                                  os.path.join(root, "regions_excluded_tiffs"))
+
+
+def calibrate_action(root, changed):
+    import calibration
+    calibration.calibrate(_clipped_tifs(root))
+
+
+def zonal_action(root, changed):
+    import zonal_pipeline
+    # 每套边界分别判断：边界变了就全部重算，没变就只统计变化了的那几年，两套都没变化的年份不会读栅格
+    layers = zonal_pipeline.default_layers(root)
+    years = {}
+    for layer in layers:
+        boundary_changed = changed is None or any(path in changed for path in _shapefile_parts(layer.shp_path))
+        if boundary_changed or not all(os.path.exists(path) for path in _store_files(root, layer.name)):
+            years[layer.name] = None
+        else:
+            years[layer.name] = {year_from_path(path) for path in changed if year_from_path(path)}
+    # 统计用的是传感器相互校正以后的TIFF
+    zonal_pipeline.run(layers, tiff_path=os.path.join(root, "regions_excluded_tiffs"), years=years,
+                       tif_pattern=zonal_pipeline.tif_pattern)
+
+
+def geometry_tiers_action(root, changed):
+    import geometry_tiers
+    for layer in ("provinces", "cities"):
+        geometry_tiers.write_tiers(os.path.join(root, "ntl_store", layer), layer, os.path.join(root, "geometry_tiers"))
+
+
+def trend_cube_action(root, changed):
+    import ntl_cube
+    cube_dir = os.path.join(root, "ntl_cube")
+    ntl_cube.build_cube(_calibrated_tifs(root), cube_dir)
+    ntl_cube.compute_trends(cube_dir)
+    # 任意区域查询用的块级积分图也在这里生成，查询的时候就不用扫描立方体了
+    import region_query
+    region_query.build_block_tables(cube_dir)
+
+
+def build_stages(root):
+    province_shp = os.path.join(root, "boundaries", "省级.shp")
+    city_shp = os.path.join(root, "City", "CN_city.shp")
+    stages = [
+        Stage("preprocess",
+              inputs=lambda: _raw_tifs(root) + _shapefile_parts(province_shp),
+              outputs=lambda: [os.path.join(root, "regions_excluded_tiffs", "clipped_" + os.path.basename(p))
+                               for p in _raw_tifs(root)],
+              action=preprocess_action),
+        Stage("calibrate",
+              inputs=lambda: _clipped_tifs(root),
+              outputs=lambda: [os.path.join(root, "regions_excluded_tiffs", "calibrated_" + os.path.basename(p))
+                               for p in _raw_tifs(root)],
+              action=calibrate_action, deps=("preprocess",)),
+        Stage("zonal",
+              inputs=lambda: _calibrated_tifs(root) + _shapefile_parts(province_shp) + _shapefile_parts(city_shp),
+              outputs=lambda: _store_files(root, "provinces") + _store_files(root, "cities"),
+              action=zonal_action, deps=("calibrate",)),
+        Stage("geometry_tiers",
+              inputs=lambda: [_store_files(root, layer)[0] for layer in ("provinces", "cities")],
+              outputs=lambda: [os.path.join(root, "geometry_tiers", layer, f"{tier}.geojson")
+                               for layer in ("provinces", "cities") for tier in ("low", "medium", "high")],
+              action=geometry_tiers_action, deps=("zonal",)),
+        Stage("trend_cube",
+              inputs=lambda: _calibrated_tifs(root),
+              outputs=lambda: [os.path.join(root, "ntl_cube", f"trend_{metric}.tif")
+                               for metric in ("ols_slope", "sens_slope", "change_year", "growth_rate",
+                                              "transitions", "first_lit_year")]
+                              + [os.path.join(root, "ntl_cube", name)
+                                 for name in ("block_sat_sum.npy", "block_sat_count.npy", "block_sat.json")],
+              action=trend_cube_action, deps=("calibrate",)),
+    ]
+    return {stage.name: stage for stage in stages}
+
+
+# ---------- 调度 ----------
+
+def stage_fingerprints(stage, root, use_hash=False):
+    # 清单里记相对路径，整个目录挪了位置也不会全部重算。不存在的输入记成None
+    return {os.path.relpath(path, root): file_fingerprint(path, use_hash) if os.path.exists(path) else None
+            for path in stage.inputs()}
+
+
+def changed_inputs(stage, root, manifest, fingerprints, force=False):
+    # 返回变化了的输入文件列表；空列表表示可以跳过；None表示没有记录，要全部重做。
+    # 不存在的输入记的是None，上次存在这次不存在就会被当成变化了的输入；
+    # 像“所有TIFF”这种列表里直接少了一项的，只重算变化的部分没法去掉它留下的结果，所以要全部重做
+    previous = manifest.get(stage.name)
+    if force or previous is None or not all(os.path.exists(path) for path in stage.outputs()):
+        return None
+    if any(fingerprint is not None and path not in fingerprints for path, fingerprint in previous.items()):
+        return None
+    changed = [path for path, fingerprint in fingerprints.items() if previous.get(path) != fingerprint]
+    return [os.path.join(root, path) for path in changed]
+
+
+def _run_action(stage_name, root, changed):
+    sys.path.insert(0, abspath)
+    build_stages(root)[stage_name].action(root, changed)
+
+
+def execute(stage, root, changed, isolate):
+    # 每个阶段在单独的进程里运行，这样分区统计和数据立方体可以真正并行，而且切割阶段自己还可以再开进程池
+    if not isolate:
+        stage.action(root, changed)
+        return
+    process = multiprocessing.get_context("spawn").Process(target=_run_action, args=(stage.name, root, changed))
+    process.start()
+    process.join()
+    if process.exitcode != 0:
+        raise RuntimeError(f"阶段 {stage.name} 运行失败，退出码 {process.exitcode}")
+
+
+def topological_order(stages, only=None):
+    unknown = sorted(set(only or ()) - set(stages))
+    if unknown:
+        raise ValueError(f"没有这些阶段: {', '.join(unknown)}，可选的有: {', '.join(stages)}")
+    selected = set(only or stages)
+    # 选中的阶段依赖的上游阶段也要一起检查
+    pending = list(selected)
+    while pending:
+        for dep in stages[pending.pop()].deps:
+            if dep not in selected:
+                selected.add(dep)
+                pending.append(dep)
+    order, done = [], set()
+    while len(order) < len(selected):
+        for name in selected:
+            if name not in done and all(dep in done for dep in stages[name].deps):
+                order.append(name)
+                done.add(name)
+    return order
+
+
+def run(root=abspath, jobs=2, force=False, only=None, use_hash=False, dry_run=False):
+    root = os.path.abspath(root)
+    stages = build_stages(root)
+    manifest_path = os.path.join(root, manifest_file_name)
+    manifest = load_manifest(manifest_path)
+    order = topological_order(stages, only)
+    finished, running = set(), {}
+    report = {}
+
+    def ready(name):
+        return name not in finished and name not in running and all(dep in finished for dep in stages[name].deps)
+
+    with ThreadPoolExecutor(max_workers=max(1, jobs)) as pool:
+        while len(finished) < len(order):
+            for name in order:
+                if not ready(name):
+                    continue
+                stage = stages[name]
+                # 上游阶段都完成以后再算指纹，这样能看到上游刚刚生成的文件
+                fingerprints = stage_fingerprints(stage, root, use_hash)
+                changed = changed_inputs(stage, root, manifest, fingerprints, force)
+                if dry_run and any(report.get(dep) != "skipped" for dep in stage.deps):
+                    # 空跑不会真的生成上游的输出，这里看到的还是旧文件；上游要重新运行的话，下游的输入一定会变
+                    changed = None
+                if changed == [] or dry_run:
+                    report[name] = "skipped" if changed == [] else ("rebuild" if changed is None else changed)
+                    finished.add(name)
+                    continue
+                start = time.perf_counter()
+                future = pool.submit(execute, stage, root, changed, jobs > 1)
+                running[name] = (future, fingerprints, start)
+            if not running:
+                continue
+            done, _ = wait([future for future, _, _ in running.values()], return_when=FIRST_COMPLETED)
+            for name in [n for n, (future, _, _) in running.items() if future in done]:
+                future, fingerprints, start = running.pop(name)
+                future.result()
+                manifest[name] = fingerprints
+                save_manifest(manifest, manifest_path)
+                report[name] = f"{time.perf_counter() - start:.1f}s"
+                finished.add(name)
+    return report
+
+
+def main():
+    parser = argparse.ArgumentParser(prog="python -m ntl", description="夜间灯光数据处理流程")
+    subparsers = parser.add_subparsers(dest="command", required=True)
+    for command, help_text in (("run", "运行输入有变化的阶段"), ("status", "列出需要重新运行的阶段，不实际运行")):
+        sub = subparsers.add_parser(command, help=help_text)
+        sub.add_argument("--root", default=abspath, help="数据所在目录，默认是这个文件所在的src目录")
+        sub.add_argument("--only", nargs="+", default=None, choices=list(build_stages(abspath)),
+                         help="只运行这些阶段（以及它们依赖的阶段）")
+        sub.add_argument("--hash", action="store_true", help="用内容哈希判断输入是否变化")
+        if command == "run":
+            sub.add_argument("--jobs", type=int, default=2, help="最多同时运行几个阶段，1表示在当前进程里依次运行")
+            sub.add_argument("--force", action="store_true", help="忽略清单，全部重新运行")
+    args = parser.parse_args()
+
+    if args.command == "status":
+        report = run(root=args.root, only=args.only, use_hash=args.hash, dry_run=True)
+    else:
+        report = run(root=args.root, jobs=args.jobs, force=args.force, only=args.only, use_hash=args.hash)
+    for name, state in report.items():
+        if isinstance(state, list):
+            state = f"{len(state)}个输入有变化"
+        print(f"{name:<18}{state}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,109 @@
+import argparse
+import os
+import numpy as np
+import pandas as pd
+import ntl_store
+
+# 各区域在全国里的相对位置：占全国的比例、同比变化、排名和排名变化、百分位、年均复合增长率。
+# 以前app每次重新运行都要把选中那一年的列转成数字、求和、相除，一次只算一年。
+# 这里把所有区域×所有年份排成一个二维数组，每个指标都是对整个数组的一次向量化运算，
+# 统计完以后算一次，存到和时间序列同一个目录下的analytics.parquet里，app只需要按zone_id查
+
+abspath = os.path.dirname(os.path.abspath(__file__))
+store_dirs = {
+    "provinces": os.path.join(abspath, "ntl_store", "provinces"),
+    "cities": os.path.join(abspath, "ntl_store", "cities"),
+}
+METRICS = ("share", "yoy_change", "rank", "rank_change", "percentile", "cagr")
+
+
+def stats_matrix(stats_df, value="mean", n_zones=None):
+    # 长表转成 (区域, 年份) 的二维数组，没有数据的是NaN
+    years = np.sort(stats_df["year"].unique())
+    if n_zones is None:
+        n_zones = int(stats_df["zone_id"].max()) + 1 if len(stats_df) else 0
+    matrix = np.full((n_zones, len(years)), np.nan)
+    matrix[stats_df["zone_id"].to_numpy(), np.searchsorted(years, stats_df["year"].to_numpy())] = \
+        stats_df[value].to_numpy()
+    return years, matrix
+
+
+def rank_matrix(matrix):
+    # 每一年（每一列）从亮到暗排名，最亮的是1，没有数据的是NaN
+    filled = np.where(np.isnan(matrix), -np.inf, matrix)
+    order = np.argsort(-filled, axis=0, kind="stable")
+    ranks = np.empty(matrix.shape)
+    np.put_along_axis(ranks, order, np.arange(1, matrix.shape[0] + 1, dtype=np.float64)[:, None], axis=0)
+    ranks[np.isnan(matrix)] = np.nan
+    return ranks
+
+
+def compute_analytics(years, matrix):
+    # 返回 {指标: (区域, 年份) 的数组}
+    with np.errstate(invalid="ignore", divide="ignore"):
+        total = np.nansum(matrix, axis=0)
+        share = matrix / np.where(total == 0, np.nan, total)
+
+        # 同比变化是相对上一年的变化率，第一年没有上一年
+        yoy_change = np.full(matrix.shape, np.nan)
+        yoy_change[:, 1:] = matrix[:, 1:] / matrix[:, :-1] - 1
+
+        ranks = rank_matrix(matrix)
+        # 排名变化：比上一年前进了几名，前进是正数
+        rank_change = np.full(matrix.shape, np.nan)
+        rank_change[:, 1:] = ranks[:, :-1] - ranks[:, 1:]
+
+        # 百分位：最亮的是100，最暗的是0
+        n_valid = (~np.isnan(matrix)).sum(axis=0)
+        percentile = (n_valid - ranks) / np.where(n_valid > 1, n_valid - 1, np.nan) * 100
+
+        # 年均复合增长率：从这个区域第一个有数据的年份到当年
+        has_value = ~np.isnan(matrix)
+        first = np.argmax(has_value, axis=1)
+        base_value = matrix[np.arange(matrix.shape[0]), first]
+        base_year = np.asarray(years, dtype=np.float64)[first]
+        elapsed = np.asarray(years, dtype=np.float64)[None, :] - base_year[:, None]
+        cagr = np.where((elapsed > 0) & (base_value[:, None] > 0),
+                        (matrix / base_value[:, None]) ** (1 / elapsed) - 1, np.nan)
+
+    return {"share": share, "yoy_change": yoy_change, "rank": ranks, "rank_change": rank_change,
+            "percentile": percentile, "cagr": cagr}
+
+
+def analytics_frame(years, analytics):
+    # 展开成和ntl_stats.parquet一样的长表：zone_id, year, 各指标
+    n_zones, n_years = next(iter(analytics.values())).shape
+    frame = {
+        "zone_id": np.tile(np.arange(n_zones, dtype=np.int32), n_years),
+        "year": np.repeat(np.asarray(years, dtype=np.int16), n_zones),
+    }
+    for metric, values in analytics.items():
+        # 按年份在外、区域在内的顺序展开，和统计表的排序一致
+        frame[metric] = values.T.ravel()
+    return pd.DataFrame(frame)
+
+
+def build_analytics(store_dir, value="mean"):
+    stats_df = ntl_store.read_stats(store_dir, stats=(value,))
+    years, matrix = stats_matrix(stats_df, value)
+    return analytics_frame(years, compute_analytics(years, matrix))
+
+
+def write_analytics(store_dir, value="mean"):
+    # 每次统计完都整张表重算：同比、排名变化这些指标会受相邻年份影响，而且整个数组算一遍也就几毫秒
+    analytics_df = build_analytics(store_dir, value)
+    ntl_store.write_analytics_table(analytics_df, store_dir)
+    return analytics_df
+
+
+def main():
+    parser = argparse.ArgumentParser(description="计算各区域的占比、排名、百分位和增长率")
+    parser.add_argument("--layers", nargs="+", default=list(store_dirs), choices=list(store_dirs))
+    args = parser.parse_args()
+    for layer in args.layers:
+        analytics_df = write_analytics(store_dirs[layer])
+        print(f"{layer}: {analytics_df['zone_id'].nunique()}个区域 × {analytics_df['year'].nunique()}年")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,260 @@
+import argparse
+import glob
+import os
+from concurrent.futures import ProcessPoolExecutor, as_completed
+import numpy as np
+import rasterio
+from rasterio.crs import CRS
+from rasterio.enums import Resampling
+from rasterio.transform import Affine
+from rasterio.vrt import WarpedVRT
+from rasterio.windows import Window
+from manifest import file_fingerprint, load_manifest, save_manifest
+from zonal_engine import ZoneIndex, grid_key, valid_pixel_mask, year_from_path, DEFAULT_NODATA, STATS
+
+# 像元级的时间序列分析。以前每一年都先被压缩成每个区域一个平均值，每个TIFF也是单独处理的，
+# 想知道“哪些地方变亮得最快”就得把32个文件各打开一遍。
+# 这里把所有年份切割后的栅格叠成一个磁盘上的数据立方体（年份 × 行 × 列，float32，nodata是NaN），
+# 用numpy的.npy内存映射文件保存，不需要额外装zarr。
+# 在立方体上按行分块、多进程并行，一次扫描就算出每个像元的：
+#   ols_slope      最小二乘趋势斜率（DN/年）
+#   sens_slope     Sen斜率，所有年份两两之间斜率的中位数，不怕个别年份的异常值
+#   change_year    均值突变点：把序列分成前后两段、前后均值差异最大的那个分割点，取后一段的第一年
+#   growth_rate    相对增长率，OLS斜率除以多年平均值，也就是每年变化了平均亮度的百分之几
+#   transitions    有灯光/无灯光之间切换了几次
+#   first_lit_year 第一次有灯光的年份，一直没有灯光的是NaN
+# 结果写成和立方体同一格网的GeoTIFF，可以直接交给zonal_engine按省/市统计
+
+abspath = os.path.dirname(os.path.abspath(__file__))
+tiff_path = os.path.join(abspath, "regions_excluded_tiffs")
+cube_dir = os.path.join(abspath, "ntl_cube")
+CUBE_FILE = "cube.npy"
+META_FILE = "cube_meta.json"
+METRICS = ("ols_slope", "sens_slope", "change_year", "growth_rate", "transitions", "first_lit_year")
+# DN值大于这个数才算有灯光。calibration.py只校正DN大于0的像元，背景在校正后仍然是0，所以这个阈值对calibrated_*.tif也成立
+LIT_THRESHOLD = 0.0
+# 每块的内存预算（MB），Sen斜率要对所有年份两两配对，是最占内存的一步
+DEFAULT_BLOCK_BUDGET_MB = 256
+
+
+def cube_path(cube_dir):
+    return os.path.join(cube_dir, CUBE_FILE)
+
+
+def meta_path(cube_dir):
+    return os.path.join(cube_dir, META_FILE)
+
+
+def metric_path(cube_dir, metric):
+    return os.path.join(cube_dir, f"trend_{metric}.tif")
+
+
+def _reference_profile(src):
+    return {
+        "driver": "GTiff", "height": src.height, "width": src.width, "count": 1, "dtype": "float32",
+        "crs": src.crs, "transform": src.transform, "nodata": float("nan"),
+        "tiled": True, "blockxsize": 256, "blockysize": 256, "compress": "deflate",
+    }
+
+
+def build_cube(tif_paths, cube_dir=cube_dir, block_rows=512, force=False):
+    # 以第一年的栅格为参考格网，格网不一样的年份（比如不同传感器切出来的范围不同）先重采样到参考格网上。
+    # 输入文件都没变就直接用已有的立方体
+    tif_paths = sorted((p for p in tif_paths if year_from_path(p)), key=year_from_path)
+    if not tif_paths:
+        raise ValueError("没有找到按年份命名的TIFF")
+    os.makedirs(cube_dir, exist_ok=True)
+    fingerprints = {os.path.basename(p): file_fingerprint(p) for p in tif_paths}
+    meta = load_manifest(meta_path(cube_dir))
+    if not force and meta.get("inputs") == fingerprints and os.path.exists(cube_path(cube_dir)):
+        return meta
+
+    with rasterio.open(tif_paths[0]) as ref:
+        profile = _reference_profile(ref)
+        reference_key = grid_key(ref)
+    height, width = profile["height"], profile["width"]
+    cube = np.lib.format.open_memmap(cube_path(cube_dir), mode="w+", dtype=np.float32,
+                                     shape=(len(tif_paths), height, width))
+    for t, tif_path in enumerate(tif_paths):
+        with rasterio.open(tif_path) as src:
+            nodata = src.nodata if src.nodata is not None else DEFAULT_NODATA
+            if grid_key(src) == reference_key:
+                reader = src
+            else:
+                reader = WarpedVRT(src, crs=profile["crs"], transform=profile["transform"], width=width,
+                                   height=height, resampling=Resampling.nearest, src_nodata=nodata, nodata=nodata)
+            with reader:
+                for row in range(0, height, block_rows):
+                    window = Window(0, row, width, min(block_rows, height - row))
+                    band = reader.read(1, window=window).astype(np.float32)
+                    band[~valid_pixel_mask(band, nodata)] = np.nan
+                    cube[t, row:row + band.shape[0], :] = band
+    cube.flush()
+    del cube
+
+    meta = {
+        "years": [int(year_from_path(p)) for p in tif_paths],
+        "crs": profile["crs"].to_wkt() if profile["crs"] else None,
+        "transform": list(profile["transform"])[:6],
+        "height": height,
+        "width": width,
+        "inputs": fingerprints,
+    }
+    save_manifest(meta, meta_path(cube_dir))
+    return meta
+
+
+def open_cube(cube_dir=cube_dir):
+    # 只读方式映射，返回 (立方体, 元数据)，读多少行才会真正从磁盘读多少
+    return np.load(cube_path(cube_dir), mmap_mode="r"), load_manifest(meta_path(cube_dir))
+
+
+def _ols_slope(block, x):
+    # block是 (年份, 像元)，缺失值是NaN。每个像元用自己有效的那些年份做回归
+    valid = ~np.isnan(block)
+    y = np.where(valid, block, 0.0)
+    n = valid.sum(axis=0)
+    xv = np.where(valid, x[:, None], 0.0)
+    sx, sy = xv.sum(axis=0), y.sum(axis=0)
+    sxx, sxy = (xv * xv).sum(axis=0), (xv * y).sum(axis=0)
+    with np.errstate(invalid="ignore", divide="ignore"):
+        slope = (n * sxy - sx * sy) / (n * sxx - sx * sx)
+        mean = sy / n
+    slope[n < 3] = np.nan
+    return slope, mean
+
+
+def _sens_slope(block, x):
+    i, j = np.triu_indices(len(x), k=1)
+    with np.errstate(invalid="ignore"):
+        pair_slopes = (block[j] - block[i]) / (x[j] - x[i])[:, None]
+    valid_pairs = (~np.isnan(pair_slopes)).any(axis=0)
+    slope = np.full(block.shape[1], np.nan, dtype=np.float32)
+    if valid_pairs.any():
+        slope[valid_pairs] = np.nanmedian(pair_slopes[:, valid_pairs], axis=0)
+    return slope
+
+
+def _change_year(block, years):
+    # 用累加和一次算出每个分割点前后两段的均值，统计量是 k(n-k)/n × (前段均值 - 后段均值)²
+    valid = ~np.isnan(block)
+    y = np.where(valid, block, 0.0)
+    cum_sum, cum_count = np.cumsum(y, axis=0), np.cumsum(valid, axis=0)
+    total_sum, total_count = cum_sum[-1], cum_count[-1]
+    left_sum, left_count = cum_sum[:-1], cum_count[:-1]
+    right_sum, right_count = total_sum - left_sum, total_count - left_count
+    with np.errstate(invalid="ignore", divide="ignore"):
+        diff = left_sum / left_count - right_sum / right_count
+        score = left_count * right_count / total_count * diff * diff
+    score = np.where((left_count > 0) & (right_count > 0), score, -np.inf)
+    split = np.argmax(score, axis=0)
+    change = np.asarray(years, dtype=np.float32)[split + 1]
+    change[~np.isfinite(score.max(axis=0)) | (total_count < 3)] = np.nan
+    return change
+
+
+def _lit_transitions(block, years, threshold):
+    valid = ~np.isnan(block)
+    lit = valid & (block > threshold)
+    # 只比较相邻两年都有数据的地方
+    switched = (lit[1:] != lit[:-1]) & valid[1:] & valid[:-1]
+    transitions = switched.sum(axis=0).astype(np.float32)
+    transitions[~valid.any(axis=0)] = np.nan
+    first_lit = np.asarray(years, dtype=np.float32)[np.argmax(lit, axis=0)]
+    first_lit[~lit.any(axis=0)] = np.nan
+    return transitions, first_lit
+
+
+def trend_metrics(block, years, lit_threshold=LIT_THRESHOLD):
+    # block是 (年份, 行, 列) 的一块立方体，返回 {指标: (行, 列)}
+    n_years, rows, cols = block.shape
+    flat = block.reshape(n_years, -1).astype(np.float64)
+    x = np.asarray(years, dtype=np.float64)
+    x = x - x.mean()
+    ols, mean = _ols_slope(flat, x)
+    with np.errstate(invalid="ignore", divide="ignore"):
+        growth = np.where(mean > 0, ols / mean, np.nan)
+    transitions, first_lit = _lit_transitions(flat, years, lit_threshold)
+    out = {
+        "ols_slope": ols,
+        "sens_slope": _sens_slope(flat, x),
+        "change_year": _change_year(flat, years),
+        "growth_rate": growth,
+        "transitions": transitions,
+        "first_lit_year": first_lit,
+    }
+    return {name: value.astype(np.float32).reshape(rows, cols) for name, value in out.items()}
+
+
+def rows_per_block(n_years, width, budget_mb=DEFAULT_BLOCK_BUDGET_MB):
+    # 两两配对的斜率矩阵是 n(n-1)/2 × 像元数 个float64，按它来定每块放几行
+    n_pairs = max(1, n_years * (n_years - 1) // 2)
+    return max(1, int(budget_mb * 1024 * 1024 // (n_pairs * 8 * 2 * width)))
+
+
+def _process_rows(cube_dir, row, n_rows, lit_threshold):
+    cube, meta = open_cube(cube_dir)
+    block = np.asarray(cube[:, row:row + n_rows, :])
+    return row, trend_metrics(block, meta["years"], lit_threshold)
+
+
+def compute_trends(cube_dir=cube_dir, workers=None, budget_mb=DEFAULT_BLOCK_BUDGET_MB, lit_threshold=LIT_THRESHOLD):
+    # 按行分块，每块交给一个进程，进程自己映射立方体只读需要的几行，结果按窗口写回各指标的GeoTIFF
+    cube, meta = open_cube(cube_dir)
+    n_years, height, width = cube.shape
+    del cube
+    profile = {
+        "driver": "GTiff", "height": height, "width": width, "count": 1, "dtype": "float32",
+        "crs": CRS.from_wkt(meta["crs"]) if meta.get("crs") else None,
+        "transform": Affine(*meta["transform"]), "nodata": float("nan"),
+        "tiled": True, "blockxsize": 256, "blockysize": 256, "compress": "deflate",
+    }
+    step = rows_per_block(n_years, width, budget_mb)
+    outputs = {metric: rasterio.open(metric_path(cube_dir, metric), "w", **profile) for metric in METRICS}
+    try:
+        with ProcessPoolExecutor(max_workers=workers) as pool:
+            futures = [pool.submit(_process_rows, cube_dir, row, min(step, height - row), lit_threshold)
+                       for row in range(0, height, step)]
+            for future in as_completed(futures):
+                row, metrics = future.result()
+                window = Window(0, row, width, next(iter(metrics.values())).shape[0])
+                for metric, values in metrics.items():
+                    outputs[metric].write(values, 1, window=window)
+    finally:
+        for dst in outputs.values():
+            dst.close()
+    return {metric: metric_path(cube_dir, metric) for metric in METRICS}
+
+
+def zonal_trend_stats(gdf, cube_dir=cube_dir, metrics=METRICS, stats=STATS, all_touched=False):
+    # 把像元级的指标按区域汇总，返回 {指标: {统计量: 每个区域的值}}。所有指标同一格网，区域只栅格化一次
+    zone_index = None
+    results = {}
+    for metric in metrics:
+        with rasterio.open(metric_path(cube_dir, metric)) as src:
+            if zone_index is None:
+                zone_index = ZoneIndex.from_raster(gdf, src, all_touched=all_touched)
+            band = src.read(1)
+        results[metric] = zone_index.reduce(band, nodata=None, stats=stats)
+    return results
+
+
+def main():
+    parser = argparse.ArgumentParser(description="把各年份栅格叠成数据立方体，并计算每个像元的趋势指标")
+    parser.add_argument("--input", default=tiff_path)
+    parser.add_argument("--cube-dir", default=cube_dir)
+    parser.add_argument("--workers", type=int, default=None)
+    parser.add_argument("--budget-mb", type=float, default=DEFAULT_BLOCK_BUDGET_MB, help="每块的内存预算（MB）")
+    parser.add_argument("--lit-threshold", type=float, default=LIT_THRESHOLD)
+    parser.add_argument("--force", action="store_true", help="输入没变也重新生成立方体")
+    args = parser.parse_args()
+
+    tif_files = glob.glob(os.path.join(args.input, "clipped_*.tif"))
+    meta = build_cube(tif_files, args.cube_dir, force=args.force)
+    print(f"数据立方体: {len(meta['years'])}年 × {meta['height']} × {meta['width']}")
+    for metric, path in compute_trends(args.cube_dir, args.workers, args.budget_mb, args.lit_threshold).items():
+        print(f"{metric}: {path}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,135 @@
+import os
+import numpy as np
+import pandas as pd
+import ntl_store
+from ntl_analytics import stats_matrix, compute_analytics
+
+# dashboard在内存里用的紧凑数据模型。以前每一年都缓存一份带几何的GeoDataFrame，名称列是object类型的中文字符串，
+# 趋势图还要把长表merge、pivot一遍。这里一个区域类型（省/市）只有一个对象：
+#   values       float32的 区域 × 年份 矩阵，行号就是zone_id
+#   share、rank  预先算好的占比和排名，同样形状的float32矩阵
+#   attributes   以zone_id为索引的属性表，字符串列都转成category，每个名字只存一次
+#   geometry     所有区域共用的一个shapely几何数组，第一次要用几何的时候才解码
+# 地图、提示框、占比、趋势图都是从这里切片：换年份只是取矩阵的一列，代价和区域数成正比，不复制几何
+
+VALUE_DTYPE = np.float32
+
+
+def _readonly(array):
+    array = np.ascontiguousarray(array, dtype=VALUE_DTYPE)
+    array.flags.writeable = False
+    return array
+
+
+class NtlModel:
+    def __init__(self, store_dir, years, values, attributes, share=None, rank=None):
+        self.store_dir = store_dir
+        self.years = np.asarray(years, dtype=np.int16)
+        self.values = _readonly(values)
+        self.share = None if share is None else _readonly(share)
+        self.rank = None if rank is None else _readonly(rank)
+        self.attributes = attributes
+        self._year_index = {int(year): j for j, year in enumerate(self.years)}
+        self._geometry = None
+        self._crs = None
+
+    @property
+    def n_zones(self):
+        return self.values.shape[0]
+
+    @property
+    def zone_ids(self):
+        return self.attributes.index.to_numpy()
+
+    @property
+    def nbytes(self):
+        arrays = [self.values, self.share, self.rank]
+        total = sum(array.nbytes for array in arrays if array is not None)
+        total += int(self.attributes.memory_usage(index=True, deep=True).sum())
+        if self._geometry is not None:
+            # 每个几何对象本身的大小算不准，这里只按坐标数粗略估计
+            import shapely
+            total += int(shapely.get_num_coordinates(self._geometry).sum()) * 16
+        return total
+
+    def year_index(self, year):
+        return self._year_index[int(year)]
+
+    def column(self, year, matrix=None):
+        # 某一年所有区域的值，是矩阵的一列视图，不复制
+        matrix = self.values if matrix is None else matrix
+        return matrix[:, self.year_index(year)]
+
+    def year_frame(self, year, value_column="value", share_column=None, rank_column=None, name_columns=()):
+        # 当年的数值（可选带上占比、排名和名称列），以zone_id为索引，给地图和提示框用
+        frame = pd.DataFrame({column: self.attributes[column] for column in name_columns},
+                             index=self.attributes.index)
+        frame[value_column] = self.column(year)
+        if share_column is not None:
+            frame[share_column] = self.column(year, self.share)
+        if rank_column is not None:
+            frame[rank_column] = self.column(year, self.rank)
+        return frame
+
+    def trend_series(self, name_column):
+        # 趋势图要的 (年份, 名称列表, 区域 × 年份矩阵)，按名称排好序，和trend_animation.pivot_series的结果一样
+        names = self.attributes[name_column].astype(str).to_numpy()
+        order = np.argsort(names, kind="stable")
+        return self.years.astype(int), names[order].tolist(), self.values[order].astype(np.float64)
+
+    def set_attribute(self, zone_id, column, value):
+        # 修改某个区域的属性，category列要先把新值加进类别里
+        values = self.attributes[column]
+        if isinstance(values.dtype, pd.CategoricalDtype) and value not in values.cat.categories:
+            values = values.cat.add_categories([value])
+        values = values.copy()
+        values.loc[zone_id] = value
+        self.attributes[column] = values
+
+    def geometry(self):
+        # 所有区域共用的几何数组和坐标系，只解码一次
+        if self._geometry is None:
+            self._geometry, self._crs = ntl_store.read_zone_geometry(self.store_dir)
+        return self._geometry, self._crs
+
+    def geometry_in(self, epsg=4326):
+        # 投影到指定坐标系的几何，只用pyproj和shapely，不需要geopandas。已经是这个坐标系的直接返回共用的那一份
+        import shapely
+        from pyproj import CRS, Transformer
+        geometry, crs = self.geometry()
+        if crs is None:
+            return geometry
+        source = CRS.from_json_dict(crs) if isinstance(crs, dict) else CRS.from_user_input(crs)
+        target = CRS.from_epsg(epsg)
+        if source == target or source.to_epsg() == epsg:
+            return geometry
+        transformer = Transformer.from_crs(source, target, always_xy=True)
+        return shapely.transform(geometry, lambda coords: np.column_stack(transformer.transform(coords[:, 0],
+                                                                                                coords[:, 1])))
+
+
+def _categorize(attributes):
+    for column in attributes.columns:
+        if attributes[column].dtype == object:
+            attributes[column] = attributes[column].astype("category")
+    return attributes
+
+
+def _analytics_matrices(store_dir, years, values):
+    # 预先算好的指标表里只取占比和排名两列；老的数据目录里还没有指标表，或者年份对不上，就在内存里现算
+    if os.path.exists(ntl_store.analytics_path(store_dir)):
+        analytics_df = ntl_store.read_analytics(store_dir, columns=["share", "rank"])
+        analytics_years, share = stats_matrix(analytics_df, "share", values.shape[0])
+        if np.array_equal(analytics_years, years):
+            return share, stats_matrix(analytics_df, "rank", values.shape[0])[1]
+    analytics = compute_analytics(years, values.astype(np.float64))
+    return analytics["share"], analytics["rank"]
+
+
+def load_model(store_dir, value="mean"):
+    attributes = ntl_store.read_zone_attributes(store_dir, columns=ntl_store.zone_attribute_columns(store_dir))
+    attributes = _categorize(attributes.set_index("zone_id").sort_index())
+    stats_df = ntl_store.read_stats(store_dir, stats=(value,))
+    years, values = stats_matrix(stats_df, value, n_zones=len(attributes))
+    share, rank = _analytics_matrices(store_dir, years, values)
+    return NtlModel(store_dir, years, values, attributes, share, rank)
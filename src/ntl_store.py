@@ -0,0 +1,149 @@
+import json
+import os
+import numpy as np
+import pandas as pd
+import pyarrow as pa
+import pyarrow.parquet as pq
+
+# 夜间灯光时间序列的存储格式。以前每一年都写一份带完整几何的shapefile，几何被重复存了32遍，
+# 读的时候还要逐行遍历。现在一个区域类型（省/市）只存两张表：
+#   zones.parquet     区域几何和属性，每个区域一行，zone_id就是行号
+#   ntl_stats.parquet 长表，每行是一个 zone_id × year，各个统计量各占一列
+#   analytics.parquet 和统计表一样的长表，存的是占比、排名、增长率这些派生指标（见ntl_analytics.py）
+# 长表按年份排序、每年一个row group，所以按年份过滤时只会读到需要的那几块
+
+ZONES_FILE = "zones.parquet"
+STATS_FILE = "ntl_stats.parquet"
+ANALYTICS_FILE = "analytics.parquet"
+# 统计表是从哪一种TIFF算出来的（clipped_*.tif还是calibrated_*.tif），同一张表里不能混着两种
+SOURCE_FILE = "source.json"
+
+
+def zones_path(store_dir):
+    return os.path.join(store_dir, ZONES_FILE)
+
+
+def stats_path(store_dir):
+    return os.path.join(store_dir, STATS_FILE)
+
+
+def analytics_path(store_dir):
+    return os.path.join(store_dir, ANALYTICS_FILE)
+
+
+def source_path(store_dir):
+    return os.path.join(store_dir, SOURCE_FILE)
+
+
+def write_source(store_dir, tif_pattern):
+    os.makedirs(store_dir, exist_ok=True)
+    with open(source_path(store_dir), "w", encoding="utf-8") as f:
+        json.dump({"tif_pattern": tif_pattern}, f)
+
+
+def read_source(store_dir):
+    # 没有记录的（老的数据目录）返回None
+    if not os.path.exists(source_path(store_dir)):
+        return None
+    with open(source_path(store_dir), "r", encoding="utf-8") as f:
+        return json.load(f).get("tif_pattern")
+
+
+def write_zone_table(gdf, store_dir):
+    os.makedirs(store_dir, exist_ok=True)
+    zones = gdf.reset_index(drop=True)
+    zones.insert(0, "zone_id", np.arange(len(zones), dtype=np.int32))
+    zones.to_parquet(zones_path(store_dir), index=False)
+
+
+def yearly_stats_to_frame(yearly_stats):
+    # 把zonal_engine返回的 {年份: {统计量: 数组}} 展开成长表
+    frames = []
+    for year, result in yearly_stats.items():
+        n_zones = len(next(iter(result.values())))
+        frame = {
+            "zone_id": np.arange(n_zones, dtype=np.int32),
+            "year": np.full(n_zones, int(year), dtype=np.int16),
+        }
+        for stat, values in result.items():
+            frame[stat] = np.asarray(values, dtype=np.float64)
+        frames.append(pd.DataFrame(frame))
+    if not frames:
+        return pd.DataFrame({"zone_id": np.array([], dtype=np.int32), "year": np.array([], dtype=np.int16)})
+    return pd.concat(frames, ignore_index=True)
+
+
+def write_stats_table(yearly_stats, store_dir, replace_all=False):
+    # 如果已经有数据，就只替换这次算过的年份，其他年份原样保留；replace_all为True时整张表重写
+    os.makedirs(store_dir, exist_ok=True)
+    new_df = yearly_stats_to_frame(yearly_stats)
+    path = stats_path(store_dir)
+    if os.path.exists(path) and not replace_all:
+        old_df = pq.read_table(path).to_pandas()
+        old_df = old_df[~old_df["year"].isin(new_df["year"].unique())]
+        new_df = pd.concat([old_df, new_df], ignore_index=True)
+    new_df = new_df.sort_values(["year", "zone_id"], kind="stable").reset_index(drop=True)
+
+    table = pa.Table.from_pandas(new_df, preserve_index=False)
+    n_zones = int(new_df["zone_id"].max()) + 1 if len(new_df) else 1
+    pq.write_table(table, path, row_group_size=n_zones)
+
+
+def read_stats(store_dir, years=None, stats=("mean",)):
+    # 只读需要的统计量列和年份，返回 zone_id, year, 统计量... 的长表
+    columns = ["zone_id", "year", *stats]
+    filters = None
+    if years is not None:
+        filters = [("year", "in", [int(year) for year in years])]
+    table = pq.read_table(stats_path(store_dir), columns=columns, filters=filters)
+    return table.to_pandas()
+
+
+def write_analytics_table(analytics_df, store_dir):
+    os.makedirs(store_dir, exist_ok=True)
+    analytics_df = analytics_df.sort_values(["year", "zone_id"], kind="stable").reset_index(drop=True)
+    table = pa.Table.from_pandas(analytics_df, preserve_index=False)
+    n_zones = int(analytics_df["zone_id"].max()) + 1 if len(analytics_df) else 1
+    pq.write_table(table, analytics_path(store_dir), row_group_size=n_zones)
+
+
+def read_analytics(store_dir, years=None, columns=None):
+    filters = None
+    if years is not None:
+        filters = [("year", "in", [int(year) for year in years])]
+    if columns is not None:
+        columns = ["zone_id", "year", *columns]
+    return pq.read_table(analytics_path(store_dir), columns=columns, filters=filters).to_pandas()
+
+
+def read_years(store_dir):
+    years = pq.read_table(stats_path(store_dir), columns=["year"]).column("year").to_numpy()
+    return sorted(int(year) for year in np.unique(years))
+
+
+def read_zone_attributes(store_dir, columns):
+    # 只要属性不要几何的时候，用pandas读就够了，不用解析几何
+    return pd.read_parquet(zones_path(store_dir), columns=["zone_id", *columns])
+
+
+def zone_attribute_columns(store_dir):
+    # 区域表里除了zone_id和几何以外的属性列，只读文件的schema
+    names = pq.read_schema(zones_path(store_dir)).names
+    return [name for name in names if name not in ("zone_id", "geometry")]
+
+
+def read_zone_geometry(store_dir):
+    # 不经过geopandas，直接把GeoParquet里的WKB解码成shapely几何数组，按zone_id排列。
+    # 坐标系是GeoParquet元数据里的PROJJSON，没有写的话按GeoParquet的约定就是经纬度
+    import shapely
+    table = pq.read_table(zones_path(store_dir), columns=["geometry"])
+    geo_metadata = json.loads((table.schema.metadata or {}).get(b"geo", b"{}"))
+    crs = geo_metadata.get("columns", {}).get("geometry", {}).get("crs", "EPSG:4326")
+    return shapely.from_wkb(table.column("geometry").to_numpy(zero_copy_only=False)), crs
+
+
+def read_zones(store_dir, columns=None):
+    import geopandas as gpd
+    if columns is not None:
+        columns = ["zone_id", *columns, "geometry"]
+    return gpd.read_parquet(zones_path(store_dir), columns=columns)
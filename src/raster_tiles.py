@@ -0,0 +1,204 @@
+import argparse
+import glob
+import json
+import os
+from concurrent.futures import ProcessPoolExecutor, as_completed
+import numpy as np
+import rasterio
+from rasterio import shutil as rio_shutil
+from rasterio.enums import Resampling
+from rasterio.transform import from_bounds
+from rasterio.vrt import WarpedVRT
+from rasterio.warp import transform_bounds
+from zonal_engine import year_from_path
+import vector_tiles
+import data_cache
+
+# 像元级夜间灯光影像的切片。地图上以前只有各区域的平均值，看不到真正的灯光分布。
+# 这里把regions_excluded_tiffs里每一年的TIFF转成带内部金字塔（overview）的云优化GeoTIFF（COG），
+# 再渲染成上好色的 z/x/y PNG/WebP 切片金字塔。各年份之间互不相关，用进程池并行处理。
+# 地图只按视野去取切片，Streamlit进程自己从来不读整幅栅格；没有预先生成的切片由tile_server.py从COG现场渲染
+
+TILE_SIZE = 256
+# DMSP的DN值范围是0-63，所有年份用同一个固定的拉伸范围，不同年份之间颜色才能对比
+VALUE_RANGE = (0, 63)
+DEFAULT_CMAP = "inferno"
+
+abspath = os.path.dirname(os.path.abspath(__file__))
+tiff_path = os.path.join(abspath, "regions_excluded_tiffs")
+cog_dir = os.path.join(abspath, "cog_tiffs")
+tiles_dir = os.path.join(abspath, "raster_tiles")
+# 一年的切片金字塔全部渲染完以后写这个文件，记下渲染参数；只有按需渲染的零星几片时没有它
+RENDERED_FILE = ".rendered.json"
+
+
+def cog_path_for(year, cog_dir=cog_dir):
+    return os.path.join(cog_dir, f"cog_{year}.tif")
+
+
+# 每一年的切片放在按这一年COG版本命名的子目录里：{tiles_dir}/{年份}/{COG版本}/{z}/{x}/{y}.png，
+# COG重新生成以后就换到新的子目录，旧的由data_cache.use_disk_version删掉
+def year_tiles_dir(tiles_dir, year, cog_path):
+    return data_cache.use_disk_version(os.path.join(tiles_dir, str(year)), data_cache.files_version(cog_path))
+
+
+def tile_file_path(year_dir, z, x, y, fmt="png"):
+    return os.path.join(year_dir, str(z), str(x), f"{y}.{fmt}")
+
+
+def write_cog(src_path, dst_path):
+    # GDAL 3.1以上直接用COG驱动；老版本先建金字塔，再按COG的布局复制一份
+    os.makedirs(os.path.dirname(dst_path), exist_ok=True)
+    try:
+        rio_shutil.copy(src_path, dst_path, driver="COG", compress="DEFLATE", overview_resampling="average",
+                        blocksize=TILE_SIZE)
+        return dst_path
+    except (rasterio.errors.DriverRegistrationError, rasterio.errors.RasterioIOError):
+        # 没有COG驱动的GDAL报的是DriverRegistrationError
+        pass
+    tmp_path = dst_path + ".tmp.tif"
+    rio_shutil.copy(src_path, tmp_path, driver="GTiff", tiled=True, blockxsize=TILE_SIZE, blockysize=TILE_SIZE,
+                    compress="deflate")
+    with rasterio.open(tmp_path, "r+") as dst:
+        factors = [2 ** i for i in range(1, 8) if max(dst.width, dst.height) // 2 ** i >= TILE_SIZE // 2]
+        dst.build_overviews(factors, Resampling.average)
+    rio_shutil.copy(tmp_path, dst_path, driver="GTiff", tiled=True, blockxsize=TILE_SIZE, blockysize=TILE_SIZE,
+                    compress="deflate", copy_src_overviews=True)
+    os.remove(tmp_path)
+    return dst_path
+
+
+def colormap_lut(cmap_name=DEFAULT_CMAP):
+    # 256级的RGBA查找表，渲染的时候把数值量化成0-255再查表，一次向量化完成
+    from matplotlib import colormaps
+    lut = colormaps[cmap_name](np.linspace(0, 1, 256), bytes=True)
+    lut[0, 3] = 0  # 没有灯光的地方透明，能看到底图
+    return lut
+
+
+def colorize(values, valid, lut):
+    low, high = VALUE_RANGE
+    index = np.clip((values.astype(np.float32) - low) / (high - low) * 255, 0, 255).astype(np.uint8)
+    rgba = lut[index]
+    rgba[~valid] = 0
+    return rgba
+
+
+def encode_image(rgba, fmt="png"):
+    import io
+    from PIL import Image
+    buffer = io.BytesIO()
+    Image.fromarray(rgba, mode="RGBA").save(buffer, format="WEBP" if fmt == "webp" else "PNG",
+                                            **({"lossless": True} if fmt == "webp" else {"optimize": True}))
+    return buffer.getvalue()
+
+
+def source_resolution_m(src):
+    res = src.res[0]
+    return res * 111320 if src.crs is not None and src.crs.is_geographic else res
+
+
+def open_for_zoom(cog_path, z):
+    # 按缩放级别挑一个合适的金字塔层级打开：切片的一个像元对应源数据多少个像元，就用不超过这个倍数的最粗一级
+    with rasterio.open(cog_path) as src:
+        factors = src.overviews(1)
+        tile_res = 2 * vector_tiles.WEB_MERCATOR_HALF / (TILE_SIZE * (1 << z))
+        decimation = tile_res / source_resolution_m(src)
+    level = None
+    for i, factor in enumerate(factors):
+        if factor <= decimation:
+            level = i
+    return rasterio.open(cog_path, overview_level=level) if level is not None else rasterio.open(cog_path)
+
+
+def render_tile(src, z, x, y, lut, fmt="png"):
+    # 只把这一片范围重投影到Web墨卡托的256×256格网上，读到的只有这一片需要的像元
+    nodata = src.nodata if src.nodata is not None else 0
+    transform = from_bounds(*vector_tiles.tile_bounds(z, x, y), TILE_SIZE, TILE_SIZE)
+    with WarpedVRT(src, crs="EPSG:3857", transform=transform, width=TILE_SIZE, height=TILE_SIZE,
+                   resampling=Resampling.average, src_nodata=nodata, nodata=nodata) as vrt:
+        data = vrt.read(1)
+    valid = data != nodata
+    if not valid.any():
+        return None
+    return encode_image(colorize(data, valid, lut), fmt)
+
+
+def render_cog_tile(cog_path, z, x, y, cmap_name=DEFAULT_CMAP, fmt="png"):
+    # 给切片服务现场渲染单独一片用
+    with open_for_zoom(cog_path, z) as src:
+        return render_tile(src, z, x, y, colormap_lut(cmap_name), fmt)
+
+
+def render_params(min_zoom, max_zoom, cmap_name, fmt):
+    return {"min_zoom": min_zoom, "max_zoom": max_zoom, "cmap": cmap_name, "format": fmt}
+
+
+def year_rendered(cog_path, year, tiles_dir, params):
+    # 当前COG版本的切片目录里有完整渲染的记录，而且参数一样
+    rendered_path = os.path.join(year_tiles_dir(tiles_dir, year, cog_path), RENDERED_FILE)
+    if not os.path.exists(rendered_path):
+        return False
+    with open(rendered_path, "r", encoding="utf-8") as f:
+        return json.load(f) == params
+
+
+def render_year(cog_path, year, tiles_dir, min_zoom, max_zoom, cmap_name=DEFAULT_CMAP, fmt="png"):
+    year_dir = year_tiles_dir(tiles_dir, year, cog_path)
+    lut = colormap_lut(cmap_name)
+    count = 0
+    with rasterio.open(cog_path) as src:
+        bounds = transform_bounds(src.crs, "EPSG:3857", *src.bounds)
+    for z in range(min_zoom, max_zoom + 1):
+        with open_for_zoom(cog_path, z) as src:
+            for x, y in vector_tiles.tiles_covering(bounds, z):
+                data = render_tile(src, z, x, y, lut, fmt)
+                if data is None:
+                    continue
+                path = tile_file_path(year_dir, z, x, y, fmt)
+                os.makedirs(os.path.dirname(path), exist_ok=True)
+                with open(path, "wb") as f:
+                    f.write(data)
+                count += 1
+    with open(os.path.join(year_dir, RENDERED_FILE), "w", encoding="utf-8") as f:
+        json.dump(render_params(min_zoom, max_zoom, cmap_name, fmt), f)
+    return count
+
+
+def process_year(src_path, cog_dir, tiles_dir, min_zoom, max_zoom, cmap_name, fmt, force):
+    year = year_from_path(src_path)
+    cog_path = cog_path_for(year, cog_dir)
+    # COG比源文件新就说明这一年没变，不用重新转换；切片还要看当前COG版本下是不是已经完整渲染过
+    cog_current = (not force and os.path.exists(cog_path)
+                   and os.path.getmtime(cog_path) >= os.path.getmtime(src_path))
+    if not cog_current:
+        write_cog(src_path, cog_path)
+    elif year_rendered(cog_path, year, tiles_dir, render_params(min_zoom, max_zoom, cmap_name, fmt)):
+        return year, 0
+    return year, render_year(cog_path, year, tiles_dir, min_zoom, max_zoom, cmap_name, fmt)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="把切割后的TIFF转成COG和上色的XYZ切片金字塔")
+    parser.add_argument("--input", default=tiff_path)
+    parser.add_argument("--cog-dir", default=cog_dir)
+    parser.add_argument("--tiles-dir", default=tiles_dir)
+    parser.add_argument("--min-zoom", type=int, default=3)
+    parser.add_argument("--max-zoom", type=int, default=7)
+    parser.add_argument("--cmap", default=DEFAULT_CMAP)
+    parser.add_argument("--format", choices=("png", "webp"), default="png")
+    parser.add_argument("--workers", type=int, default=None)
+    parser.add_argument("--force", action="store_true")
+    args = parser.parse_args()
+
+    tif_files = sorted(glob.glob(os.path.join(args.input, "clipped_*.tif")))
+    with ProcessPoolExecutor(max_workers=args.workers) as pool:
+        futures = [pool.submit(process_year, path, args.cog_dir, args.tiles_dir, args.min_zoom, args.max_zoom,
+                               args.cmap, args.format, args.force) for path in tif_files]
+        for future in as_completed(futures):
+            year, count = future.result()
+            print(f"{year}: 生成了{count}片切片")
+
+
+if __name__ == "__main__":
+    main()
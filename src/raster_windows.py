@@ -0,0 +1,90 @@
+import math
+import numpy as np
+import rasterio
+from rasterio import features
+from rasterio.windows import Window
+from shapely.geometry import box
+
+# 分块读写栅格的工具。VIIRS这种500米分辨率的全国栅格一次读进内存太大了，
+# 所以这里沿着栅格内部的块（block）布局把它切成若干窗口，每次只处理一个窗口，
+# 内存峰值只和每块的大小有关，和整幅栅格的大小无关
+
+# 处理一个像元大概要用到的字节数：原始值、float64转换、掩膜、区域编号等加在一起的粗略估计
+BYTES_PER_PIXEL_ESTIMATE = 24
+
+
+def tile_budget_to_pixels(tile_budget_mb):
+    return max(1, int(tile_budget_mb * 1024 * 1024 // BYTES_PER_PIXEL_ESTIMATE))
+
+
+def iter_tile_windows(src, max_tile_pixels, within=None):
+    # 把若干个相邻的内部块拼成一个不超过max_tile_pixels的窗口，窗口边界总是和块边界对齐，
+    # 这样每个块只会被读一次。within可以限定只遍历某个窗口范围内的部分
+    if within is None:
+        within = Window(0, 0, src.width, src.height)
+    block_h, block_w = src.block_shapes[0]
+    block_pixels = block_h * block_w
+
+    blocks_per_row = math.ceil(src.width / block_w)
+    cols_in_tile = max(1, min(blocks_per_row, max_tile_pixels // block_pixels))
+    rows_in_tile = max(1, max_tile_pixels // (block_pixels * cols_in_tile))
+    tile_h = rows_in_tile * block_h
+    tile_w = cols_in_tile * block_w
+
+    row_start = int(within.row_off) // tile_h * tile_h
+    col_start = int(within.col_off) // tile_w * tile_w
+    row_stop = int(within.row_off + within.height)
+    col_stop = int(within.col_off + within.width)
+    for row in range(row_start, row_stop, tile_h):
+        for col in range(col_start, col_stop, tile_w):
+            r0 = max(row, int(within.row_off))
+            c0 = max(col, int(within.col_off))
+            r1 = min(row + tile_h, row_stop)
+            c1 = min(col + tile_w, col_stop)
+            if r1 > r0 and c1 > c0:
+                yield Window(c0, r0, c1 - c0, r1 - r0)
+
+
+def window_bounds_box(src, window):
+    return box(*rasterio.windows.bounds(window, src.transform))
+
+
+def shapes_in_window(src, window, shapes):
+    # 只保留和这个窗口相交的几何，栅格化的时候少做无用功
+    window_box = window_bounds_box(src, window)
+    return [geom for geom in shapes if geom is not None and geom.intersects(window_box)]
+
+
+def mask_raster_windowed(src, shapes, output_path, nodata, max_tile_pixels, all_touched=False):
+    # 和rasterio.mask.mask(crop=True)的结果一样，但是一块一块地读、掩膜、写出
+    shapes = [geom for geom in shapes if geom is not None and not geom.is_empty]
+    crop_window = features.geometry_window(src, shapes)
+    out_transform = src.window_transform(crop_window)
+
+    out_meta = src.meta.copy()
+    out_meta.update({
+        "driver": "GTiff",
+        "height": int(crop_window.height),
+        "width": int(crop_window.width),
+        "transform": out_transform,
+        "nodata": nodata,
+        "tiled": True,
+        "blockxsize": 256,
+        "blockysize": 256,
+    })
+
+    with rasterio.open(output_path, "w", **out_meta) as dst:
+        for window in iter_tile_windows(src, max_tile_pixels, within=crop_window):
+            data = src.read(window=window)
+            window_shapes = shapes_in_window(src, window, shapes)
+            if window_shapes:
+                inside = features.geometry_mask(window_shapes, out_shape=(int(window.height), int(window.width)),
+                                                transform=src.window_transform(window), invert=True,
+                                                all_touched=all_touched)
+            else:
+                inside = np.zeros((int(window.height), int(window.width)), dtype=bool)
+            data[:, ~inside] = nodata
+            dst_window = Window(window.col_off - crop_window.col_off, window.row_off - crop_window.row_off,
+                                window.width, window.height)
+            dst.write(data, window=dst_window)
+    return out_transform
@@ -0,0 +1,260 @@
+import argparse
+import json
+import os
+import threading
+import numpy as np
+import pandas as pd
+import shapely
+from shapely.geometry import shape, mapping
+from rasterio import features
+from rasterio.crs import CRS
+from rasterio.transform import Affine, rowcol
+from rasterio.warp import transform_geom
+from manifest import load_manifest, save_manifest
+import ntl_cube
+
+# 任意区域的灯光时间序列查询。分析的时候经常想圈一块地方（画个多边形或者给个经纬度范围）直接看它历年的灯光，
+# 而不是只能看预先定义好的省市。
+# 数据来自ntl_cube.py生成的像元立方体。先把立方体按 BLOCK_SIZE×BLOCK_SIZE 像元分块，算出每年每块的
+# 亮度总和和有效像元数，再沿行列做累加，得到块级的积分图（summed-area table）。查询的时候：
+#   - 完全落在区域里面的块，从积分图里直接取，每块只要四次加减，和块里有多少像元无关
+#   - 只有区域边界穿过的那些块，才回到立方体里读原始像元，按像元中心是否在区域内做掩膜
+# 所以每次查询读的只是边界附近的一圈像元，所有年份一起算完，不用重新打开32个TIFF。
+# 积分图在ntl.py的trend_cube阶段和立方体一起生成，查询的时候只读已有的积分图，不会去扫描整个立方体
+# 另外用STRtree给省/市边界建了索引，可以马上知道查询区域覆盖了哪些省市
+
+BLOCK_SIZE = 16
+SAT_SUM_FILE = "block_sat_sum.npy"
+SAT_COUNT_FILE = "block_sat_count.npy"
+SAT_META_FILE = "block_sat.json"
+abspath = os.path.dirname(os.path.abspath(__file__))
+store_dirs = {
+    "provinces": os.path.join(abspath, "ntl_store", "provinces"),
+    "cities": os.path.join(abspath, "ntl_store", "cities"),
+}
+NAME_COLUMNS = {"provinces": "省", "cities": "NAME"}
+
+
+def block_table_paths(cube_dir=ntl_cube.cube_dir):
+    return [os.path.join(cube_dir, name) for name in (SAT_SUM_FILE, SAT_COUNT_FILE, SAT_META_FILE)]
+
+
+def block_tables_ready(cube_dir=ntl_cube.cube_dir, block_size=BLOCK_SIZE):
+    # 积分图都在，而且是由当前立方体的输入、按这个块大小生成的
+    if not all(os.path.exists(path) for path in block_table_paths(cube_dir)):
+        return False
+    if not os.path.exists(ntl_cube.cube_path(cube_dir)):
+        return False
+    meta = load_manifest(ntl_cube.meta_path(cube_dir))
+    previous = load_manifest(os.path.join(cube_dir, SAT_META_FILE))
+    return previous.get("inputs") == meta.get("inputs") and previous.get("block_size") == block_size
+
+
+def build_block_tables(cube_dir=ntl_cube.cube_dir, block_size=BLOCK_SIZE, force=False):
+    # 按块行扫描一遍立方体，算出每块的总和和有效像元数，再做成积分图存到立方体旁边。
+    # 立方体的输入没变就直接用已有的
+    if not force and block_tables_ready(cube_dir, block_size):
+        return
+    cube, meta = ntl_cube.open_cube(cube_dir)
+    sat_meta_path = os.path.join(cube_dir, SAT_META_FILE)
+    n_years, height, width = cube.shape
+    n_block_rows = -(-height // block_size)
+    n_block_cols = -(-width // block_size)
+    block_sum = np.zeros((n_years, n_block_rows, n_block_cols), dtype=np.float64)
+    block_count = np.zeros((n_years, n_block_rows, n_block_cols), dtype=np.int64)
+    for bi in range(n_block_rows):
+        rows = np.asarray(cube[:, bi * block_size:(bi + 1) * block_size, :], dtype=np.float64)
+        # 最右边和最下边不满一块的部分补上NaN，这样就能整体reshape
+        padded = np.full((n_years, block_size, n_block_cols * block_size), np.nan)
+        padded[:, :rows.shape[1], :width] = rows
+        padded = padded.reshape(n_years, block_size, n_block_cols, block_size)
+        valid = ~np.isnan(padded)
+        block_sum[:, bi] = np.where(valid, padded, 0.0).sum(axis=(1, 3))
+        block_count[:, bi] = valid.sum(axis=(1, 3))
+
+    for name, blocks in ((SAT_SUM_FILE, block_sum), (SAT_COUNT_FILE, block_count)):
+        sat = np.zeros((n_years, n_block_rows + 1, n_block_cols + 1), dtype=blocks.dtype)
+        sat[:, 1:, 1:] = blocks.cumsum(axis=1).cumsum(axis=2)
+        np.save(os.path.join(cube_dir, name), sat)
+    save_manifest({"inputs": meta.get("inputs"), "block_size": block_size}, sat_meta_path)
+
+
+def _block_values(sat, i0, i1, j0, j1):
+    # 积分图里取出第i0..i1行、j0..j1列的每一块各自的值，返回 (年份, 块行, 块列)
+    return (sat[:, i0 + 1:i1 + 1, j0 + 1:j1 + 1] - sat[:, i0:i1, j0 + 1:j1 + 1]
+            - sat[:, i0 + 1:i1 + 1, j0:j1] + sat[:, i0:i1, j0:j1])
+
+
+class RegionQuery:
+    def __init__(self, cube_dir=ntl_cube.cube_dir, block_size=BLOCK_SIZE, store_dirs=store_dirs):
+        if not block_tables_ready(cube_dir, block_size):
+            raise FileNotFoundError(f"{cube_dir}里没有和立方体对应的积分图，先运行 python ntl.py run --only trend_cube")
+        self.cube, meta = ntl_cube.open_cube(cube_dir)
+        self.years = meta["years"]
+        self.crs = CRS.from_wkt(meta["crs"]) if meta.get("crs") else None
+        self.transform = Affine(*meta["transform"])
+        self.height, self.width = meta["height"], meta["width"]
+        self.block_size = block_size
+        self.sat_sum = np.load(os.path.join(cube_dir, SAT_SUM_FILE), mmap_mode="r")
+        self.sat_count = np.load(os.path.join(cube_dir, SAT_COUNT_FILE), mmap_mode="r")
+        self.store_dirs = store_dirs
+        self._zone_index = None
+        self._zone_lock = threading.Lock()
+
+    def _to_cube_crs(self, geometry, crs):
+        if crs is None or self.crs is None or CRS.from_user_input(crs) == self.crs:
+            return geometry
+        return shape(transform_geom(crs, self.crs, mapping(geometry)))
+
+    def _block_boxes(self, i0, i1, j0, j1):
+        # 每一块在立方体CRS下的外框
+        b = self.block_size
+        cols = np.arange(j0, j1) * b
+        rows = np.arange(i0, i1) * b
+        col_grid, row_grid = np.meshgrid(cols, rows)
+        x0, y0 = self.transform * (col_grid, row_grid)
+        x1, y1 = self.transform * (np.minimum(col_grid + b, self.width), np.minimum(row_grid + b, self.height))
+        return shapely.box(np.minimum(x0, x1), np.minimum(y0, y1), np.maximum(x0, x1), np.maximum(y0, y1))
+
+    def _partial_block_totals(self, geometry, partial, i0, j0):
+        # 边界穿过的块按块行逐行处理，每一行里连续的边界块合成一段读一次。
+        # 完全在区域内的块已经从积分图里算过了，不会出现在读的窗口里
+        b = self.block_size
+        total_sum = np.zeros(len(self.years))
+        total_count = np.zeros(len(self.years), dtype=np.int64)
+        for bi in np.flatnonzero(partial.any(axis=1)):
+            block_cols = np.flatnonzero(partial[bi])
+            breaks = np.flatnonzero(np.diff(block_cols) > 1) + 1
+            r0 = (i0 + bi) * b
+            r1 = min(r0 + b, self.height)
+            for run in np.split(block_cols, breaks):
+                c0 = (j0 + run[0]) * b
+                c1 = min((j0 + run[-1] + 1) * b, self.width)
+                window_transform = self.transform * Affine.translation(c0, r0)
+                inside = features.geometry_mask([geometry], out_shape=(r1 - r0, c1 - c0),
+                                                transform=window_transform, invert=True)
+                if not inside.any():
+                    continue
+                values = np.asarray(self.cube[:, r0:r1, c0:c1])[:, inside]
+                valid = ~np.isnan(values)
+                total_sum += np.where(valid, values, 0.0).sum(axis=1)
+                total_count += valid.sum(axis=1)
+        return total_sum, total_count
+
+    def series(self, geometry, crs="EPSG:4326"):
+        # 返回这个区域每一年的灯光总和、有效像元数和平均值，按年份排列
+        geometry = self._to_cube_crs(geometry, crs)
+        minx, miny, maxx, maxy = geometry.bounds
+        rows, cols = rowcol(self.transform, [minx, maxx], [maxy, miny])
+        r0, r1 = max(0, min(rows)), min(self.height, max(rows) + 1)
+        c0, c1 = max(0, min(cols)), min(self.width, max(cols) + 1)
+        total_sum = np.zeros(len(self.years))
+        total_count = np.zeros(len(self.years), dtype=np.int64)
+        if r1 > r0 and c1 > c0:
+            b = self.block_size
+            i0, i1 = r0 // b, -(-r1 // b)
+            j0, j1 = c0 // b, -(-c1 // b)
+            boxes = self._block_boxes(i0, i1, j0, j1)
+            shapely.prepare(geometry)
+            full = shapely.contains(geometry, boxes)
+            partial = shapely.intersects(geometry, boxes) & ~full
+            if full.any():
+                total_sum += (_block_values(self.sat_sum, i0, i1, j0, j1) * full).sum(axis=(1, 2))
+                total_count += (_block_values(self.sat_count, i0, i1, j0, j1) * full).sum(axis=(1, 2))
+            if partial.any():
+                partial_sum, partial_count = self._partial_block_totals(geometry, partial, i0, j0)
+                total_sum += partial_sum
+                total_count += partial_count
+        with np.errstate(invalid="ignore", divide="ignore"):
+            mean = total_sum / total_count
+        return pd.DataFrame({"year": self.years, "sum": total_sum, "count": total_count, "mean": mean})
+
+    def bbox_series(self, minx, miny, maxx, maxy, crs="EPSG:4326"):
+        return self.series(shapely.box(minx, miny, maxx, maxy), crs)
+
+    def _zones(self):
+        # 省/市边界的STRtree第一次用到的时候才建，之后所有查询共用
+        with self._zone_lock:
+            if self._zone_index is None:
+                import ntl_store
+                geometries, layers, zone_ids, names = [], [], [], []
+                for layer, store_dir in self.store_dirs.items():
+                    if not os.path.exists(ntl_store.zones_path(store_dir)):
+                        continue
+                    zones = ntl_store.read_zones(store_dir)
+                    if self.crs is not None and zones.crs is not None and zones.crs != self.crs:
+                        zones = zones.to_crs(self.crs)
+                    name_column = NAME_COLUMNS.get(layer)
+                    geometries.extend(zones.geometry.values)
+                    layers.extend([layer] * len(zones))
+                    zone_ids.extend(zones["zone_id"].tolist())
+                    names.extend(zones[name_column].astype(str).tolist() if name_column in zones.columns
+                                 else [""] * len(zones))
+                geometries = np.asarray(geometries)
+                self._zone_index = (shapely.STRtree(geometries), geometries,
+                                    pd.DataFrame({"layer": layers, "zone_id": zone_ids, "name": names}))
+            return self._zone_index
+
+    def zones_in(self, geometry, crs="EPSG:4326"):
+        # 查询区域覆盖了哪些省市，overlap是这个省/市的面积有多大比例落在查询区域里
+        geometry = self._to_cube_crs(geometry, crs)
+        tree, geometries, attributes = self._zones()
+        hits = tree.query(geometry, predicate="intersects")
+        result = attributes.iloc[hits].reset_index(drop=True)
+        with np.errstate(invalid="ignore", divide="ignore"):
+            result["overlap"] = shapely.area(shapely.intersection(geometries[hits], geometry)) / shapely.area(
+                geometries[hits])
+        return result.sort_values(["layer", "overlap"], ascending=[True, False], ignore_index=True)
+
+
+_default_query = None
+_default_lock = threading.Lock()
+
+
+def default_query():
+    # 进程里只建一个查询对象，app的各个会话和各次查询共用同一份积分图和索引
+    global _default_query
+    with _default_lock:
+        if _default_query is None:
+            _default_query = RegionQuery()
+        return _default_query
+
+
+def query_region(geometry, crs="EPSG:4326"):
+    # geometry可以是shapely几何，也可以是GeoJSON的geometry字典
+    if isinstance(geometry, dict):
+        geometry = shape(geometry)
+    return default_query().series(geometry, crs)
+
+
+def query_bbox(minx, miny, maxx, maxy, crs="EPSG:4326"):
+    return default_query().bbox_series(minx, miny, maxx, maxy, crs)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="查询任意区域的历年夜间灯光")
+    parser.add_argument("--bbox", nargs=4, type=float, metavar=("MINX", "MINY", "MAXX", "MAXY"))
+    parser.add_argument("--geojson", help="包含一个多边形的GeoJSON文件")
+    parser.add_argument("--crs", default="EPSG:4326")
+    parser.add_argument("--build", action="store_true", help="只重新生成块级积分图")
+    args = parser.parse_args()
+
+    if args.build:
+        build_block_tables(force=True)
+        return
+    if args.geojson:
+        with open(args.geojson, "r", encoding="utf-8") as f:
+            data = json.load(f)
+        geometry = data["features"][0]["geometry"] if data.get("type") == "FeatureCollection" else data
+        geometry = shape(geometry.get("geometry", geometry))
+    elif args.bbox:
+        geometry = shapely.box(*args.bbox)
+    else:
+        parser.error("需要--bbox或者--geojson")
+    query = default_query()
+    print(query.series(geometry, args.crs).to_string(index=False))
+    print(query.zones_in(geometry, args.crs).head(20).to_string(index=False))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,155 @@
+import argparse
+import json
+import os
+import re
+import threading
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+import ntl_store
+import vector_tiles
+import raster_tiles
+import metrics
+
+# 本地切片服务，给地图页面提供矢量切片和每年的数值数组：
+#   /tiles/{图层}/{z}/{x}/{y}.pbf     矢量切片，预先生成过的直接读文件，没有的现场生成并写到目录里
+#   /values/{图层}/{年份}.json        这一年按zone_id排列的灯光平均值
+#   /raster/{年份}/{z}/{x}/{y}.png    像元级灯光影像切片，没有预先渲染的从COG现场渲染
+# 写到磁盘上的切片和数值都放在按生成它们的数据版本命名的子目录里（见data_cache.use_disk_version），
+# 区域几何、统计表或者COG一变，就换到新的子目录，不会一直返回过期的结果，也不会和正在写文件的请求线程冲突
+#   /metrics                          Prometheus文本格式的计时和计数，要设置环境变量NTL_METRICS=1才有内容
+# 启动方法：在src目录下运行 python tile_server.py，默认端口8765
+
+abspath = os.path.dirname(os.path.abspath(__file__))
+DEFAULT_PORT = 8765
+NAME_COLUMNS = {"provinces": "省", "cities": "NAME"}
+
+_sources = {}
+_sources_lock = threading.Lock()
+
+
+def vector_source(layer, version):
+    # 每个图层、每个几何版本的切片生成器只建一次，所有请求线程共用
+    with _sources_lock:
+        if layer not in _sources or _sources[layer][0] != version:
+            zones = ntl_store.read_zones(vector_tiles.store_dirs[layer])
+            name_column = NAME_COLUMNS.get(layer)
+            _sources[layer] = (version, vector_tiles.VectorTileSource(
+                zones, layer, name_column if name_column in zones.columns else None))
+        return _sources[layer][1]
+
+
+def read_or_build(path, build):
+    if os.path.exists(path):
+        with open(path, "rb") as f:
+            return f.read()
+    data = build()
+    if data is not None:
+        try:
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            tmp_path = f"{path}.{threading.get_ident()}.tmp"
+            with open(tmp_path, "wb") as f:
+                f.write(data)
+            os.replace(tmp_path, path)
+        except OSError:
+            # 数据刚换了版本，旧版本的目录正在被删掉；这次的结果照样返回，只是不落盘
+            pass
+    return data
+
+
+def vector_tile(tiles_dir, layer, z, x, y):
+    store_dir = vector_tiles.store_dirs[layer]
+    version = vector_tiles.tiles_version(store_dir)
+    layer_dir = vector_tiles.layer_tiles_dir(tiles_dir, layer, store_dir)
+    return read_or_build(vector_tiles.tile_path(layer_dir, z, x, y),
+                         lambda: vector_source(layer, version).get_tile(z, x, y))
+
+
+def year_values(tiles_dir, layer, year):
+    store_dir = vector_tiles.store_dirs[layer]
+    values_dir = vector_tiles.layer_values_dir(tiles_dir, layer, store_dir)
+
+    def build():
+        # 只读这一年的row group
+        values = vector_tiles.year_values(store_dir, years=[year]).get(year)
+        return None if values is None else json.dumps(values, separators=(",", ":")).encode("utf-8")
+    return read_or_build(vector_tiles.values_path(values_dir, year), build)
+
+
+def raster_tile(year, z, x, y):
+    cog_path = raster_tiles.cog_path_for(year)
+    if not os.path.exists(cog_path):
+        return None
+    year_dir = raster_tiles.year_tiles_dir(raster_tiles.tiles_dir, year, cog_path)
+    return read_or_build(raster_tiles.tile_file_path(year_dir, z, x, y),
+                         lambda: raster_tiles.render_cog_tile(cog_path, z, x, y))
+
+
+# 路由表：(正则, 处理函数, Content-Type)，处理函数返回bytes，返回None表示这一片是空的
+ROUTES = [
+    (re.compile(r"^/tiles/(?P<layer>\w+)/(?P<z>\d+)/(?P<x>\d+)/(?P<y>\d+)\.pbf$"),
+     lambda tiles_dir, m: vector_tile(tiles_dir, m["layer"], int(m["z"]), int(m["x"]), int(m["y"])),
+     "application/x-protobuf"),
+    (re.compile(r"^/values/(?P<layer>\w+)/(?P<year>\d{4})\.json$"),
+     lambda tiles_dir, m: year_values(tiles_dir, m["layer"], int(m["year"])),
+     "application/json"),
+    (re.compile(r"^/raster/(?P<year>\d{4})/(?P<z>\d+)/(?P<x>\d+)/(?P<y>\d+)\.png$"),
+     lambda tiles_dir, m: raster_tile(m["year"], int(m["z"]), int(m["x"]), int(m["y"])),
+     "image/png"),
+    (re.compile(r"^/metrics$"), lambda tiles_dir, m: metrics.to_prometheus().encode("utf-8"),
+     "text/plain; version=0.0.4"),
+]
+
+
+def make_handler(tiles_dir):
+    class TileHandler(BaseHTTPRequestHandler):
+        def do_GET(self):
+            path = self.path.split("?", 1)[0]
+            for pattern, handler, content_type in ROUTES:
+                match = pattern.match(path)
+                if match is None:
+                    continue
+                if match.groupdict().get("layer") not in (None, *vector_tiles.store_dirs):
+                    break
+                with metrics.span("tile_request", route=path.split("/")[1]):
+                    data = handler(tiles_dir, match)
+                if data is None:
+                    self.send_response(204)
+                    self._send_common_headers()
+                    self.end_headers()
+                    return
+                self.send_response(200)
+                self.send_header("Content-Type", content_type)
+                self.send_header("Content-Length", str(len(data)))
+                self._send_common_headers()
+                self.end_headers()
+                self.wfile.write(data)
+                return
+            self.send_error(404)
+
+        def _send_common_headers(self):
+            # 地图页面和切片服务不在同一个端口，需要允许跨域
+            self.send_header("Access-Control-Allow-Origin", "*")
+            self.send_header("Cache-Control", "public, max-age=3600")
+
+        def log_message(self, format, *args):
+            pass
+
+    return TileHandler
+
+
+def serve(tiles_dir=vector_tiles.output_dir, host="127.0.0.1", port=DEFAULT_PORT):
+    server = ThreadingHTTPServer((host, port), make_handler(tiles_dir))
+    print(f"切片服务已启动: http://{host}:{port}")
+    server.serve_forever()
+
+
+def main():
+    parser = argparse.ArgumentParser(description="本地切片服务")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=DEFAULT_PORT)
+    parser.add_argument("--tiles-dir", default=vector_tiles.output_dir)
+    args = parser.parse_args()
+    serve(args.tiles_dir, args.host, args.port)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,96 @@
+import numpy as np
+import plotly.graph_objects as go
+from plotly.colors import qualitative
+
+# 历年变化趋势的动画折线图。以前的做法是对每一年都把“小于等于这一年”的数据复制一份再拼起来交给plotly express，
+# 行数随年份数平方增长。这里先把数据整理成 区域 × 年份 的矩阵，然后直接生成plotly的帧：
+#   "window"（默认）：所有折线只画一次，每一帧只挪动x轴的右边界，帧本身只有一个坐标范围，
+#             序列化以后的大小是 区域数 × 年份数，市级这种几百条折线也没问题
+#   "cumulative"：每一帧的每条折线都是矩阵这一行的前k个点，和以前plotly express的效果完全一样，
+#             但所有帧加起来是 区域数 × 年份数² 个点，只适合区域很少的时候
+
+DEFAULT_LABELS = {
+    "Year": "年份",
+    "NTL_Value": "平均灯光强度",
+    "name": "省份/区域",
+    "animation_frame_id": "动画播放年份",
+}
+
+
+def pivot_series(consolidated_df, name_column, value_column="NTL_Value"):
+    # 长表转成矩阵，返回 (年份数组, 区域名称列表, 区域 × 年份的数值矩阵)
+    table = consolidated_df.pivot_table(index=name_column, columns="Year", values=value_column, aggfunc="first")
+    table = table.sort_index(axis=0).sort_index(axis=1)
+    return table.columns.to_numpy(dtype=int), table.index.tolist(), table.to_numpy(dtype=np.float64)
+
+
+def _frame_duration_args(duration):
+    # redraw=True的参考来源https://stackoverflow.com/questions/70523979/how-to-create-an-animated-line-plot-with-ploty-express
+    return {"frame": {"duration": duration, "redraw": True}, "mode": "immediate",
+            "fromcurrent": True, "transition": {"duration": 0}}
+
+
+def build_trend_figure(years, names, matrix, labels=None, mode="window", width=1000, height=600,
+                       colors=qualitative.Light24, frame_duration=500):
+    labels = {**DEFAULT_LABELS, **(labels or {})}
+    n_years = len(years)
+    if n_years == 0:
+        # 数据目录里还没有任何年份，给一张只有坐标轴标题的空图
+        figure = go.Figure()
+        figure.update_layout(width=width, height=height, xaxis={"title": labels["Year"]},
+                             yaxis={"title": labels["NTL_Value"]})
+        return figure
+    x_range = [years[0] - 0.5, years[-1] + 0.5]
+    # 校正以后可能有负值，下界取数据的最小值（最小值是正的时候还是从0开始）
+    finite = np.isfinite(matrix)
+    y_min = min(0.0, float(np.nanmin(matrix[finite]))) if finite.any() else 0.0
+    y_max = float(np.nanmax(matrix[finite])) if finite.any() else 1.0
+    padding = (y_max - y_min) * 0.05 or 1.0
+    y_range = [y_min - padding if y_min < 0 else 0.0, y_max + padding]
+
+    # 第一帧：cumulative模式只画第一年的点，window模式把全部数据画好，靠x轴范围控制显示到哪一年
+    shown = 1 if mode == "cumulative" else n_years
+    traces = []
+    for i, name in enumerate(names):
+        traces.append(go.Scatter(
+            x=years[:shown], y=matrix[i, :shown], name=str(name), legendgroup=str(name),
+            mode="lines+markers", line={"color": colors[i % len(colors)]},
+            hovertemplate=f"{labels['name']}={name}<br>{labels['Year']}=%{{x}}<br>{labels['NTL_Value']}=%{{y}}<extra></extra>",
+        ))
+
+    frames = []
+    for k, year in enumerate(years):
+        if mode == "cumulative":
+            frames.append(go.Frame(
+                name=str(year),
+                data=[go.Scatter(x=years[:k + 1], y=matrix[i, :k + 1]) for i in range(len(names))],
+                traces=list(range(len(names))),
+            ))
+        else:
+            frames.append(go.Frame(name=str(year), layout={"xaxis": {"range": [x_range[0], year + 0.5]}}))
+
+    first_x_range = x_range if mode == "cumulative" else [x_range[0], years[0] + 0.5]
+    slider_steps = [{"method": "animate", "label": str(year),
+                     "args": [[str(year)], _frame_duration_args(0)]} for year in years]
+    figure = go.Figure(data=traces, frames=frames)
+    figure.update_layout(
+        width=width, height=height,
+        xaxis={"title": labels["Year"], "range": first_x_range},
+        yaxis={"title": labels["NTL_Value"], "range": y_range},
+        legend={"title": labels["name"]},
+        updatemenus=[{
+            "type": "buttons", "direction": "left", "x": 0.1, "y": 0, "xanchor": "right", "yanchor": "top",
+            "pad": {"r": 10, "t": 70}, "showactive": False,
+            "buttons": [
+                {"label": "&#9654;", "method": "animate", "args": [None, _frame_duration_args(frame_duration)]},
+                {"label": "&#9724;", "method": "animate", "args": [[None], _frame_duration_args(0)]},
+            ],
+        }],
+        sliders=[{
+            "active": 0, "x": 0.1, "y": 0, "xanchor": "left", "yanchor": "top", "len": 0.9,
+            "pad": {"b": 10, "t": 60},
+            "currentvalue": {"prefix": f"{labels['animation_frame_id']}="},
+            "steps": slider_steps,
+        }],
+    )
+    return figure
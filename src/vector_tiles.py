@@ -0,0 +1,199 @@
+import argparse
+import json
+import math
+import os
+from functools import lru_cache
+import numpy as np
+import shapely
+import ntl_store
+import data_cache
+
+# 市级（以后还有县级）区域的矢量切片（Mapbox Vector Tile）。几百个城市的多边形整个塞进GeoJSON太重了，
+# 切成 z/x/y 的金字塔以后，浏览器只会去取当前视野、当前缩放级别下的那几片。
+# 切片里只有几何和zone_id，不带灯光数值；每年的数值单独存成一个很小的数组，在浏览器里按zone_id接上去。
+# 切片可以预先生成到目录里，也可以由tile_server.py按需生成并缓存。
+# 编码用的是mapbox-vector-tile这个包，只有生成切片的时候才需要它
+
+EXTENT = 4096
+BUFFER = 64
+WEB_MERCATOR_HALF = 20037508.342789244
+
+abspath = os.path.dirname(os.path.abspath(__file__))
+store_dirs = {
+    "provinces": os.path.join(abspath, "ntl_store", "provinces"),
+    "cities": os.path.join(abspath, "ntl_store", "cities"),
+}
+output_dir = os.path.join(abspath, "vector_tiles")
+
+
+def tile_bounds(z, x, y):
+    # 一片切片在Web墨卡托下的范围 (minx, miny, maxx, maxy)
+    span = 2 * WEB_MERCATOR_HALF / (1 << z)
+    minx = -WEB_MERCATOR_HALF + x * span
+    maxy = WEB_MERCATOR_HALF - y * span
+    return minx, maxy - span, minx + span, maxy
+
+
+def tiles_covering(bounds, z):
+    # bounds是Web墨卡托下的范围，返回覆盖它的所有 (x, y)
+    n = 1 << z
+    span = 2 * WEB_MERCATOR_HALF / n
+    minx, miny, maxx, maxy = bounds
+    x0 = max(0, int((minx + WEB_MERCATOR_HALF) // span))
+    x1 = min(n - 1, int((maxx + WEB_MERCATOR_HALF) // span))
+    y0 = max(0, int((WEB_MERCATOR_HALF - maxy) // span))
+    y1 = min(n - 1, int((WEB_MERCATOR_HALF - miny) // span))
+    for x in range(x0, x1 + 1):
+        for y in range(y0, y1 + 1):
+            yield x, y
+
+
+def _encode(layer_name, geometries, properties):
+    try:
+        import mapbox_vector_tile
+    except ImportError as error:
+        raise ImportError("生成矢量切片需要安装mapbox-vector-tile: pip install mapbox-vector-tile") from error
+    features = [{"geometry": geometry, "properties": props} for geometry, props in zip(geometries, properties)]
+    return mapbox_vector_tile.encode([{"name": layer_name, "features": features}])
+
+
+class VectorTileSource:
+    # 一个区域图层的切片生成器。几何只投影一次，用STRtree找每片切片里有哪些区域
+    def __init__(self, zones, layer_name, name_column=None):
+        if zones.crs is not None and zones.crs.to_epsg() != 3857:
+            zones = zones.to_crs(epsg=3857)
+        self.layer_name = layer_name
+        self.geometries = np.asarray(zones.geometry.values)
+        self.zone_ids = zones["zone_id"].to_numpy()
+        self.names = zones[name_column].astype(str).to_numpy() if name_column else None
+        self.tree = shapely.STRtree(self.geometries)
+        self.bounds = tuple(shapely.total_bounds(self.geometries))
+        # 同一片切片被请求多次时直接返回缓存的结果
+        self.get_tile = lru_cache(maxsize=4096)(self._build_tile)
+
+    def _build_tile(self, z, x, y):
+        minx, miny, maxx, maxy = tile_bounds(z, x, y)
+        scale = EXTENT / (maxx - minx)
+        pad = BUFFER / scale
+        clip_box = shapely.box(minx - pad, miny - pad, maxx + pad, maxy + pad)
+        candidates = self.tree.query(clip_box, predicate="intersects")
+        if len(candidates) == 0:
+            return None
+        # 按当前缩放级别一个像素（切片坐标里的1个单位）的精度简化，再裁剪到切片范围
+        geometries = shapely.simplify(self.geometries[candidates], 1 / scale, preserve_topology=True)
+        geometries = shapely.clip_by_rect(geometries, *clip_box.bounds)
+        keep = ~shapely.is_empty(geometries)
+        if not keep.any():
+            return None
+        candidates, geometries = candidates[keep], geometries[keep]
+        # 转成切片内的坐标：左下角是(0, 0)，右上角是(EXTENT, EXTENT)
+        geometries = shapely.transform(geometries, lambda coords: (coords - (minx, miny)) * scale)
+        properties = []
+        for i in candidates:
+            props = {"zone_id": int(self.zone_ids[i])}
+            if self.names is not None:
+                props["name"] = self.names[i]
+            properties.append(props)
+        return _encode(self.layer_name, geometries, properties)
+
+    def write_pyramid(self, layer_dir, min_zoom, max_zoom):
+        # layer_dir是这个图层当前几何版本的切片目录，见layer_tiles_dir
+        count = 0
+        for z in range(min_zoom, max_zoom + 1):
+            for x, y in tiles_covering(self.bounds, z):
+                data = self._build_tile(z, x, y)
+                if data is None:
+                    continue
+                path = tile_path(layer_dir, z, x, y)
+                os.makedirs(os.path.dirname(path), exist_ok=True)
+                with open(path, "wb") as f:
+                    f.write(data)
+                count += 1
+        return count
+
+
+# 切片只和区域几何有关，数值数组只和统计表有关，各自放在按各自数据版本命名的子目录里：
+#   {tiles_dir}/{图层}/{几何版本}/{z}/{x}/{y}.pbf
+#   {tiles_dir}/values/{图层}/{统计表版本}/{年份}.json
+def layer_tiles_dir(tiles_dir, layer, store_dir):
+    return data_cache.use_disk_version(os.path.join(tiles_dir, layer), tiles_version(store_dir))
+
+
+def layer_values_dir(tiles_dir, layer, store_dir):
+    return data_cache.use_disk_version(os.path.join(tiles_dir, "values", layer), values_version(store_dir))
+
+
+def tile_path(layer_dir, z, x, y):
+    return os.path.join(layer_dir, str(z), str(x), f"{y}.pbf")
+
+
+def values_path(values_dir, year):
+    return os.path.join(values_dir, f"{year}.json")
+
+
+def tiles_version(store_dir):
+    return data_cache.files_version(ntl_store.zones_path(store_dir))
+
+
+def values_version(store_dir):
+    return data_cache.files_version(ntl_store.stats_path(store_dir))
+
+
+def year_values(store_dir, n_zones=None, years=None):
+    # 每年一个按zone_id排列的数值数组，没有数据的是null。years不为None时只读这几年的row group
+    stats_df = ntl_store.read_stats(store_dir, years=years, stats=("mean",))
+    if n_zones is None:
+        n_zones = len(ntl_store.read_zone_attributes(store_dir, columns=[]))
+    result = {}
+    for year, values in stats_df.groupby("year"):
+        array = np.full(n_zones, np.nan)
+        array[values["zone_id"].to_numpy()] = values["mean"].to_numpy()
+        result[int(year)] = [None if math.isnan(v) else round(float(v), 3) for v in array]
+    return result
+
+
+def write_year_values(store_dir, tiles_dir, layer):
+    values_dir = layer_values_dir(tiles_dir, layer, store_dir)
+    for year, values in year_values(store_dir).items():
+        path = values_path(values_dir, year)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        with open(path, "w", encoding="utf-8") as f:
+            json.dump(values, f, separators=(",", ":"))
+
+
+def style_function_js(layer, colors, opacity=0.7):
+    # 浏览器端的样式函数：按zone_id到颜色数组里取当年的颜色，颜色数组是Python这边根据当年数值算好的
+    return f"""{{
+        "vectorTileLayerStyles": {{
+            "{layer}": function (properties, zoom) {{
+                var colors = {json.dumps(colors)};
+                var color = colors[properties.zone_id];
+                return {{
+                    fill: true, fillColor: color || "#cccccc", fillOpacity: color ? {opacity} : 0.1,
+                    color: "#666666", weight: 0.5, opacity: 0.6
+                }};
+            }}
+        }}
+    }}"""
+
+
+def main():
+    parser = argparse.ArgumentParser(description="把区域几何切成矢量切片金字塔")
+    parser.add_argument("--layers", nargs="+", default=list(store_dirs), choices=list(store_dirs))
+    parser.add_argument("--min-zoom", type=int, default=3)
+    parser.add_argument("--max-zoom", type=int, default=8)
+    parser.add_argument("--output", default=output_dir)
+    args = parser.parse_args()
+
+    for layer in args.layers:
+        zones = ntl_store.read_zones(store_dirs[layer])
+        name_column = "省" if layer == "provinces" else "NAME"
+        source = VectorTileSource(zones, layer, name_column if name_column in zones.columns else None)
+        count = source.write_pyramid(layer_tiles_dir(args.output, layer, store_dirs[layer]), args.min_zoom,
+                                     args.max_zoom)
+        write_year_values(store_dirs[layer], args.output, layer)
+        print(f"{layer}: 生成了{count}片切片")
+
+
+if __name__ == "__main__":
+    main()
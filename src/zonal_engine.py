@@ -0,0 +1,386 @@
+import os
+import re
+import tempfile
+from contextlib import ExitStack
+import numpy as np
+import rasterio
+from rasterio import features
+from raster_windows import iter_tile_windows, window_bounds_box
+import metrics
+
+# 这个模块是分区统计的核心。以前每个脚本对每一年都调用一次rasterstats.zonal_stats，
+# 每一年都要把所有省/市的多边形重新栅格化一遍。其实所有年份的TIFF都在同一个格网上，
+# 所以这里把每个区域只栅格化一次，记下每个区域覆盖了哪些像元，之后每一年只需要读一次栅格，
+# 再用np.bincount一次性算出所有区域的统计量。
+
+# 支持的统计量，名字和rasterstats保持一致。sum就是区域的总灯光量（TNL）。
+# 另外还支持：
+#   lit_area  有灯光的像元（值大于lit_threshold）的面积，单位平方公里
+#   p50、p90… 百分位数，p后面是0-100之间的数
+STATS = ("mean", "sum", "count", "min", "max", "std")
+DEFAULT_NODATA = -128.0
+# 值大于这个数的像元才算有灯光。原始DN是整数，1就是最暗的灯光；calibrated_*.tif是浮点数，
+# 背景保持0，但多项式会在暗像元附近留下一些零点几的值，取半个DN把这些当作背景。
+# 阈值不能小于0，否则DN是0的背景也会算进灯光面积，整个区域的面积都成了“有灯光”
+LIT_THRESHOLD = 0.5
+# 百分位用按区域累加的直方图来算，这样分块累加、合并的时候也不用把所有像元值留在内存里。
+# DMSP的DN值是0-63，校正以后会略微超出，默认在0到128之间分512个箱，精度是0.25，超出范围的值算在两端的箱里，
+# 最后再用区域的最小值和最大值截一下
+PERCENTILE_EDGES = np.linspace(0.0, 128.0, 513)
+EARTH_RADIUS_KM = 6371.0088
+
+
+def year_from_path(path):
+    # 文件名中的四位数字就是年份
+    match = re.search(r'(\d{4})', os.path.basename(path))
+    return match.group(1) if match else None
+
+
+def percentile_of(stat):
+    # "p90" → 90.0，不是百分位的统计量返回None
+    match = re.fullmatch(r"p(\d{1,2}(?:\.\d+)?|100)", stat)
+    return float(match.group(1)) if match else None
+
+
+def is_supported_stat(stat):
+    return stat in STATS or stat == "lit_area" or percentile_of(stat) is not None
+
+
+def pixel_area_rows(transform, crs, row_start, n_rows):
+    # 每一行像元的面积（平方公里）。经纬度格网的像元面积随纬度变化，按球面上经纬度网格的面积公式算；
+    # 投影坐标系下每个像元一样大，假定单位是米
+    if crs is not None and crs.is_geographic:
+        top = transform.f + transform.e * np.arange(row_start, row_start + n_rows, dtype=np.float64)
+        bottom = top + transform.e
+        return (EARTH_RADIUS_KM ** 2 * np.radians(abs(transform.a))
+                * np.abs(np.sin(np.radians(top)) - np.sin(np.radians(bottom))))
+    return np.full(n_rows, abs(transform.a * transform.e) / 1e6)
+
+
+def valid_pixel_mask(values, nodata):
+    # nodata和NaN都不参与统计
+    valid = np.ones(values.shape, dtype=bool)
+    if nodata is not None:
+        valid &= values != nodata
+    if np.issubdtype(values.dtype, np.floating):
+        valid &= ~np.isnan(values)
+    return valid
+
+
+class ZonalAccumulator:
+    # 按区域累加的中间量。count、sum、平方和、最小值、最大值、灯光面积和直方图都可以增量合并，
+    # 所以整幅栅格一次算完，或者分块一块一块地加进来，结果都是一样的。
+    # 灯光面积和直方图只有stats里要了才累加
+    def __init__(self, n_zones, stats=STATS, lit_threshold=LIT_THRESHOLD, percentile_edges=PERCENTILE_EDGES):
+        self.n_zones = n_zones
+        self.count = np.zeros(n_zones, dtype=np.int64)
+        self.sum = np.zeros(n_zones, dtype=np.float64)
+        self.sum_sq = np.zeros(n_zones, dtype=np.float64)
+        self.min = np.full(n_zones, np.inf)
+        self.max = np.full(n_zones, -np.inf)
+        if "lit_area" in stats and not lit_threshold >= 0:
+            # 只有DN是0的像元的区域，灯光面积必须是0
+            raise ValueError(f"灯光阈值不能小于0: {lit_threshold}")
+        self.lit_threshold = lit_threshold
+        self.lit_area = np.zeros(n_zones, dtype=np.float64) if "lit_area" in stats else None
+        self.percentile_edges = percentile_edges
+        self.hist = None
+        if any(percentile_of(stat) is not None for stat in stats):
+            self.hist = np.zeros((n_zones, len(percentile_edges) - 1), dtype=np.int64)
+
+    @property
+    def needs_area(self):
+        return self.lit_area is not None
+
+    def update(self, zone_ids, values, presorted=False, areas=None):
+        # zone_ids是从0开始的区域编号，values是对应的像元值，两者都应该已经去掉了nodata。
+        # 要算灯光面积的时候areas是每个像元的面积
+        if zone_ids.size == 0:
+            return
+        values = values.astype(np.float64, copy=False)
+        self.count += np.bincount(zone_ids, minlength=self.n_zones)
+        self.sum += np.bincount(zone_ids, weights=values, minlength=self.n_zones)
+        self.sum_sq += np.bincount(zone_ids, weights=values * values, minlength=self.n_zones)
+        if self.lit_area is not None:
+            lit = values > self.lit_threshold
+            self.lit_area += np.bincount(zone_ids[lit], weights=areas[lit], minlength=self.n_zones)
+        if self.hist is not None:
+            # 区域编号和箱号拼成一个编号，一次bincount就得到所有区域的直方图
+            n_bins = self.hist.shape[1]
+            bins = np.clip(np.searchsorted(self.percentile_edges, values, side="right") - 1, 0, n_bins - 1)
+            self.hist += np.bincount(zone_ids.astype(np.int64) * n_bins + bins,
+                                     minlength=self.n_zones * n_bins).reshape(self.n_zones, n_bins)
+
+        # 最小值和最大值没法用bincount，先按区域排好序，再对每一段做reduceat
+        if not presorted:
+            order = np.argsort(zone_ids, kind="stable")
+            zone_ids = zone_ids[order]
+            values = values[order]
+        starts = np.concatenate(([0], np.flatnonzero(np.diff(zone_ids)) + 1))
+        zones = zone_ids[starts]
+        self.min[zones] = np.minimum(self.min[zones], np.minimum.reduceat(values, starts))
+        self.max[zones] = np.maximum(self.max[zones], np.maximum.reduceat(values, starts))
+
+    def merge(self, other):
+        self.count += other.count
+        self.sum += other.sum
+        self.sum_sq += other.sum_sq
+        np.minimum(self.min, other.min, out=self.min)
+        np.maximum(self.max, other.max, out=self.max)
+        if self.lit_area is not None:
+            self.lit_area += other.lit_area
+        if self.hist is not None:
+            self.hist += other.hist
+
+    def percentile(self, q):
+        # 在累计直方图里找到第q百分位落在哪个箱，箱内按线性插值
+        cumulative = np.cumsum(self.hist, axis=1)
+        target = q / 100 * self.count
+        bin_index = np.minimum((cumulative < target[:, None]).sum(axis=1), self.hist.shape[1] - 1)
+        rows = np.arange(self.n_zones)
+        in_bin = self.hist[rows, bin_index]
+        before = cumulative[rows, bin_index] - in_bin
+        with np.errstate(invalid="ignore", divide="ignore"):
+            fraction = np.where(in_bin > 0, (target - before) / in_bin, 0.0)
+        edges = self.percentile_edges
+        value = edges[bin_index] + fraction * (edges[bin_index + 1] - edges[bin_index])
+        return np.clip(value, self.min, self.max)
+
+    def result(self, stats=STATS):
+        # 没有有效像元的区域除了count以外都返回NaN，和rasterstats返回None的含义一致
+        empty = self.count == 0
+        with np.errstate(invalid="ignore", divide="ignore"):
+            mean = self.sum / self.count
+        out = {}
+        for stat in stats:
+            if stat == "count":
+                value = self.count.astype(np.float64)
+            elif stat == "sum":
+                value = self.sum.copy()
+            elif stat == "mean":
+                value = mean.copy()
+            elif stat == "min":
+                value = self.min.copy()
+            elif stat == "max":
+                value = self.max.copy()
+            elif stat == "std":
+                with np.errstate(invalid="ignore", divide="ignore"):
+                    value = np.sqrt(np.maximum(self.sum_sq / self.count - mean * mean, 0.0))
+            elif stat == "lit_area" and self.lit_area is not None:
+                value = self.lit_area.copy()
+            elif percentile_of(stat) is not None and self.hist is not None:
+                value = self.percentile(percentile_of(stat))
+            else:
+                raise ValueError(f"不支持的统计量: {stat}")
+            if stat != "count":
+                value[empty] = np.nan
+            out[stat] = value
+        return out
+
+
+def grid_key(src):
+    # 用CRS、仿射变换和行列数来判断两个栅格是不是在同一个格网上
+    crs = src.crs.to_wkt() if src.crs else None
+    return crs, tuple(src.transform), src.height, src.width
+
+
+class ZoneIndex:
+    # 每个区域覆盖的像元索引，按区域编号排好序存放。
+    # pixel_index是展平后的像元位置，zone_ids是对应的区域编号（从0开始）
+    def __init__(self, pixel_index, zone_ids, n_zones, shape, transform, crs=None):
+        self.pixel_index = pixel_index
+        self.zone_ids = zone_ids
+        self.n_zones = n_zones
+        self.shape = shape
+        self.transform = transform
+        self.crs = crs
+        self._pixel_areas = None
+
+    @classmethod
+    def from_geometries(cls, geometries, shape, transform, crs=None, all_touched=False):
+        geometries = list(geometries)
+        n_zones = len(geometries)
+        label_dtype = "uint16" if n_zones < np.iinfo(np.uint16).max else "int32"
+        # 编号0留给不属于任何区域的像元，所以区域编号从1开始
+        shapes = ((geom, i + 1) for i, geom in enumerate(geometries)
+                  if geom is not None and not geom.is_empty)
+        labels = features.rasterize(shapes, out_shape=shape, transform=transform, fill=0,
+                                    all_touched=all_touched, dtype=label_dtype)
+        flat = labels.ravel()
+        index_dtype = np.int32 if flat.size < np.iinfo(np.int32).max else np.int64
+        pixel_index = np.flatnonzero(flat).astype(index_dtype)
+        zone_ids = flat[pixel_index].astype(np.int32) - 1
+        order = np.argsort(zone_ids, kind="stable")
+        return cls(pixel_index[order], zone_ids[order], n_zones, shape, transform, crs)
+
+    @classmethod
+    def from_raster(cls, gdf, src, all_touched=False):
+        if gdf.crs is not None and src.crs is not None and gdf.crs != src.crs:
+            gdf = gdf.to_crs(src.crs)
+        return cls.from_geometries(gdf.geometry, (src.height, src.width), src.transform,
+                                   crs=src.crs, all_touched=all_touched)
+
+    def pixel_areas(self):
+        # 每个区域像元的面积，和pixel_index一一对应，第一次要算灯光面积的时候才算
+        if self._pixel_areas is None:
+            row_areas = pixel_area_rows(self.transform, self.crs, 0, self.shape[0])
+            self._pixel_areas = row_areas[self.pixel_index // self.shape[1]]
+        return self._pixel_areas
+
+    def accumulate(self, band, nodata=DEFAULT_NODATA, accumulator=None):
+        if accumulator is None:
+            accumulator = ZonalAccumulator(self.n_zones)
+        values = band.ravel()[self.pixel_index]
+        valid = valid_pixel_mask(values, nodata)
+        areas = self.pixel_areas()[valid] if accumulator.needs_area else None
+        accumulator.update(self.zone_ids[valid], values[valid], presorted=True, areas=areas)
+        return accumulator
+
+    def reduce(self, band, nodata=DEFAULT_NODATA, stats=STATS, lit_threshold=LIT_THRESHOLD):
+        # band是和这个索引同一格网的二维数组，返回 {统计量: 每个区域的值}
+        if band.shape != self.shape:
+            raise ValueError(f"栅格大小{band.shape}和区域索引的格网{self.shape}不一致")
+        accumulator = ZonalAccumulator(self.n_zones, stats, lit_threshold)
+        return self.accumulate(band, nodata, accumulator).result(stats)
+
+
+class ZonalLayer:
+    # 一套边界和它要算的统计量。years不为None时只统计这几年，用于某套边界没变、只需要补几年的情况
+    def __init__(self, gdf, stats=STATS, years=None, all_touched=False, lit_threshold=LIT_THRESHOLD):
+        self.gdf = gdf
+        self.stats = tuple(stats)
+        self.years = None if years is None else {str(year) for year in years}
+        self.all_touched = all_touched
+        self.lit_threshold = lit_threshold
+
+    def wants(self, year):
+        return self.years is None or str(year) in self.years
+
+
+def zonal_stats_by_year_multi(layers, tif_paths, nodata=DEFAULT_NODATA):
+    # 几套边界同时统计，layers是 {名字: ZonalLayer}，返回 {名字: {年份: {统计量: 每个区域的值}}}。
+    # 每一年的栅格只读一次，各套边界在同一份数组上各做一次归约，多一套边界只多一次bincount，不多一遍读盘
+    indexes = {}
+    results = {name: {} for name in layers}
+    for tif_path in tif_paths:
+        year = year_from_path(tif_path)
+        if year is None:
+            continue
+        wanted = [name for name, layer in layers.items() if layer.wants(year)]
+        if not wanted:
+            continue
+        with rasterio.open(tif_path) as src:
+            key = grid_key(src)
+            for name in wanted:
+                if (name, key) not in indexes:
+                    with metrics.span("zonal_rasterize", layer=name):
+                        indexes[name, key] = ZoneIndex.from_raster(layers[name].gdf, src,
+                                                                   all_touched=layers[name].all_touched)
+            with metrics.span("raster_read"):
+                band = src.read(1)
+            metrics.count("raster_bytes_read", band.nbytes)
+        for name in wanted:
+            layer = layers[name]
+            with metrics.span("zonal_reduce", layer=name):
+                results[name][year] = indexes[name, key].reduce(band, nodata=nodata, stats=layer.stats,
+                                                                lit_threshold=layer.lit_threshold)
+    return results
+
+
+def zonal_stats_by_year(gdf, tif_paths, stats=STATS, nodata=DEFAULT_NODATA, all_touched=False):
+    # 对一组按年份命名的TIFF做分区统计，返回 {年份: {统计量: 每个区域的值}}。
+    # 每个格网只栅格化一次区域，之后每一年的代价只是读一次栅格
+    layers = {"zones": ZonalLayer(gdf, stats, all_touched=all_touched)}
+    return zonal_stats_by_year_multi(layers, tif_paths, nodata)["zones"]
+
+
+# 下面是分块模式，给一次读不进内存的大栅格用。区域编号不再放在内存里，而是先分块栅格化成一个
+# 和数据同格网的编号栅格写到磁盘上，之后每一年都按块同时读编号和数据，把统计量一块一块地累加起来
+
+
+def write_label_raster(gdf, src, label_path, max_tile_pixels, all_touched=False):
+    if gdf.crs is not None and src.crs is not None and gdf.crs != src.crs:
+        gdf = gdf.to_crs(src.crs)
+    geometries = list(gdf.geometry)
+    label_dtype = "uint16" if len(geometries) < np.iinfo(np.uint16).max else "int32"
+    profile = {
+        "driver": "GTiff", "height": src.height, "width": src.width, "count": 1,
+        "dtype": label_dtype, "crs": src.crs, "transform": src.transform, "nodata": 0,
+        "tiled": True, "blockxsize": 256, "blockysize": 256, "compress": "deflate",
+    }
+    with rasterio.open(label_path, "w", **profile) as dst:
+        for window in iter_tile_windows(src, max_tile_pixels):
+            out_shape = (int(window.height), int(window.width))
+            window_box = window_bounds_box(src, window)
+            window_shapes = [(geom, i + 1) for i, geom in enumerate(geometries)
+                             if geom is not None and not geom.is_empty and geom.intersects(window_box)]
+            if window_shapes:
+                labels = features.rasterize(window_shapes,
+                                            out_shape=out_shape, transform=src.window_transform(window),
+                                            fill=0, all_touched=all_touched, dtype=label_dtype)
+            else:
+                labels = np.zeros(out_shape, dtype=label_dtype)
+            dst.write(labels, 1, window=window)
+    return len(geometries)
+
+
+def accumulate_windowed(src, label_srcs, accumulators, max_tile_pixels, nodata=DEFAULT_NODATA):
+    # label_srcs和accumulators都是 {图层名: ...}。每个窗口的数据只读一次，
+    # 各套边界读各自的编号栅格，累加到各自的累加器里
+    for window in iter_tile_windows(src, max_tile_pixels):
+        band = band_valid = row_areas = None
+        for name, label_src in label_srcs.items():
+            labels = label_src.read(1, window=window)
+            zoned = labels > 0
+            if not zoned.any():
+                continue
+            if band is None:
+                band = src.read(1, window=window)
+                band_valid = valid_pixel_mask(band, nodata)
+            valid = zoned & band_valid
+            accumulator = accumulators[name]
+            areas = None
+            if accumulator.needs_area:
+                if row_areas is None:
+                    row_areas = pixel_area_rows(src.transform, src.crs, int(window.row_off), int(window.height))
+                areas = np.broadcast_to(row_areas[:, None], band.shape)[valid]
+            accumulator.update(labels[valid].astype(np.int32) - 1, band[valid], areas=areas)
+    return accumulators
+
+
+def zonal_stats_by_year_windowed_multi(layers, tif_paths, max_tile_pixels, nodata=DEFAULT_NODATA, label_dir=None):
+    # 和zonal_stats_by_year_multi的结果一样，但内存峰值只取决于max_tile_pixels。
+    # label_dir不指定的话，编号栅格放在临时目录里，函数结束就删掉
+    with tempfile.TemporaryDirectory(dir=label_dir) as tmp_dir:
+        label_files = {}
+        results = {name: {} for name in layers}
+        for tif_path in tif_paths:
+            year = year_from_path(tif_path)
+            if year is None:
+                continue
+            wanted = [name for name, layer in layers.items() if layer.wants(year)]
+            if not wanted:
+                continue
+            with rasterio.open(tif_path) as src, ExitStack() as stack:
+                key = grid_key(src)
+                for name in wanted:
+                    if (name, key) not in label_files:
+                        label_path = os.path.join(tmp_dir, f"zone_labels_{len(label_files)}.tif")
+                        with metrics.span("zonal_rasterize", layer=name):
+                            n_zones = write_label_raster(layers[name].gdf, src, label_path, max_tile_pixels,
+                                                         layers[name].all_touched)
+                        label_files[name, key] = (label_path, n_zones)
+                label_srcs = {name: stack.enter_context(rasterio.open(label_files[name, key][0])) for name in wanted}
+                accumulators = {name: ZonalAccumulator(label_files[name, key][1], layers[name].stats,
+                                                       layers[name].lit_threshold) for name in wanted}
+                with metrics.span("zonal_reduce"):
+                    accumulate_windowed(src, label_srcs, accumulators, max_tile_pixels, nodata)
+            for name in wanted:
+                results[name][year] = accumulators[name].result(layers[name].stats)
+    return results
+
+
+def zonal_stats_by_year_windowed(gdf, tif_paths, max_tile_pixels, stats=STATS, nodata=DEFAULT_NODATA,
+                                 all_touched=False, label_dir=None):
+    layers = {"zones": ZonalLayer(gdf, stats, all_touched=all_touched)}
+    return zonal_stats_by_year_windowed_multi(layers, tif_paths, max_tile_pixels, nodata, label_dir)["zones"]
@@ -0,0 +1,144 @@
+import argparse
+import glob
+import os
+import geopandas as gpd
+from zonal_engine import (ZonalLayer, zonal_stats_by_year_multi, zonal_stats_by_year_windowed_multi, STATS,
+                          DEFAULT_NODATA, LIT_THRESHOLD, is_supported_stat)
+from raster_windows import tile_budget_to_pixels
+import ntl_store
+import ntl_analytics
+import metrics
+
+# 通用的分区统计流程：任意一套或几套边界（省、市、县、经济区……），任意一组统计量。
+# 以前省级和市级各有一个几乎一模一样的脚本，各自把32年的栅格从头读一遍；再加县级就要再复制一份、再读一遍。
+# 这里所有边界一起统计，每一年的栅格只读一次，每套边界各做一次归约，加一套边界的代价基本上只是每年多一次bincount。
+# 每套边界的结果写到各自的ntl_store目录下：几何一份zones.parquet，统计量一张ntl_stats.parquet长表，再加上派生指标。
+# 在src目录下运行：
+#   python zonal_pipeline.py                                  省级和市级
+#   python zonal_pipeline.py --boundary counties=县级/县.shp   再加一套县级边界，结果在ntl_store/counties
+#   python zonal_pipeline.py --stats mean sum lit_area p50 p90
+#   python zonal_pipeline.py --lit-threshold 6             灯光面积只算DN大于6的像元
+
+abspath = os.path.dirname(os.path.abspath(__file__))
+tiff_path = os.path.join(abspath, "regions_excluded_tiffs")
+store_root = os.path.join(abspath, "ntl_store")
+# 高分辨率栅格一次读不进内存时，设置每块的内存预算（MB）就会按块流式统计，None表示整幅读入
+tile_budget_mb = None
+# 统计哪一种TIFF：clipped_*.tif是切割后的原始值，calibrated_*.tif是经过calibration.py传感器相互校正的。
+# 默认用校正过的，和ntl.py run一致；provinces_nightlight.py、cities_nightlight.py也用这个默认值。
+# 用的是哪一种记在数据目录的source.json里，换了一种就整张表重算，不会一张表里有的年份校正过、有的没有
+tif_pattern = "calibrated_*.tif"
+# 默认的统计量：rasterstats那几个，加上灯光面积。百分位要的话在--stats里加p50、p90这样的名字
+DEFAULT_STATS = STATS + ("lit_area",)
+
+
+class BoundaryLayer:
+    # 一套边界：名字、shapefile、结果写到哪个目录，以及灯光面积用的阈值
+    def __init__(self, name, shp_path, output_dir=None, stats=DEFAULT_STATS, all_touched=False,
+                 lit_threshold=LIT_THRESHOLD):
+        self.name = name
+        self.shp_path = shp_path
+        self.output_dir = output_dir or os.path.join(store_root, name)
+        self.stats = tuple(stats)
+        self.all_touched = all_touched
+        self.lit_threshold = lit_threshold
+
+
+def default_layers(root=abspath, stats=DEFAULT_STATS, lit_threshold=LIT_THRESHOLD):
+    return [
+        BoundaryLayer("provinces", os.path.join(root, "boundaries", "省级.shp"),
+                      os.path.join(root, "ntl_store", "provinces"), stats, lit_threshold=lit_threshold),
+        BoundaryLayer("cities", os.path.join(root, "City", "CN_city.shp"),
+                      os.path.join(root, "ntl_store", "cities"), stats, lit_threshold=lit_threshold),
+    ]
+
+
+BOUNDARY_LAYERS = {layer.name: layer for layer in default_layers()}
+
+
+def run(layers, tiff_path=tiff_path, tile_budget_mb=tile_budget_mb, years=None, tif_pattern=tif_pattern):
+    # years不为None时只重新统计这几年，其他年份保留已有结果，用于边界没变、只新增或更新了某几年TIFF的情况。
+    # 也可以是 {图层名: 年份集合或None}，每套边界分别指定；年份集合是空的边界这次不用统计
+    if not isinstance(years, dict):
+        years = {layer.name: years for layer in layers}
+    years = {layer.name: None if ntl_store.read_source(layer.output_dir) != tif_pattern else years.get(layer.name)
+             for layer in layers}
+    layers = [layer for layer in layers if years.get(layer.name) is None or years[layer.name]]
+    if not layers:
+        return {}
+    tif_files = sorted(glob.glob(os.path.join(tiff_path, tif_pattern)))
+    if not tif_files:
+        raise FileNotFoundError(f"{tiff_path}里没有{tif_pattern}，calibrated_*.tif要先运行calibration.py生成")
+
+    zonal_layers = {}
+    for layer in layers:
+        with metrics.span("read_boundaries", layer=layer.name):
+            gdf = gpd.read_file(layer.shp_path)
+        zonal_layers[layer.name] = ZonalLayer(gdf, layer.stats, years.get(layer.name), layer.all_touched,
+                                              layer.lit_threshold)
+
+    # 所有年份的TIFF共用一个格网，每套边界只栅格化一次，之后每年只读一次栅格
+    with metrics.span("zonal_stats", layers=",".join(zonal_layers)):
+        if tile_budget_mb is None:
+            results = zonal_stats_by_year_multi(zonal_layers, tif_files, nodata=DEFAULT_NODATA)
+        else:
+            results = zonal_stats_by_year_windowed_multi(zonal_layers, tif_files,
+                                                         tile_budget_to_pixels(tile_budget_mb), nodata=DEFAULT_NODATA)
+
+    for layer in layers:
+        layer_years = years.get(layer.name)
+        with metrics.span("write_store", layer=layer.name):
+            if layer_years is None or not os.path.exists(ntl_store.zones_path(layer.output_dir)):
+                ntl_store.write_zone_table(zonal_layers[layer.name].gdf, layer.output_dir)
+            ntl_store.write_stats_table(results[layer.name], layer.output_dir, replace_all=layer_years is None)
+            ntl_store.write_source(layer.output_dir, tif_pattern)
+            # 占比、排名这些指标依赖所有区域和相邻年份，统计表一变就整张重算
+            ntl_analytics.write_analytics(layer.output_dir)
+    return results
+
+
+def parse_boundary(text):
+    # --boundary的type，"名字=shapefile路径" → (名字, 绝对路径)
+    name, sep, shp_path = text.partition("=")
+    if not sep or not name or not shp_path:
+        raise argparse.ArgumentTypeError(f"边界要写成 名字=shapefile路径: {text}")
+    return name, os.path.abspath(shp_path)
+
+
+def parse_stat(text):
+    # --stats的type，名字不对在解析参数的时候就报错，不用等读完边界、开始统计了才发现
+    if not is_supported_stat(text):
+        raise argparse.ArgumentTypeError(f"不支持的统计量: {text}，可以是 {' '.join(STATS)} lit_area 或者p50这样的百分位")
+    return text
+
+
+def main():
+    parser = argparse.ArgumentParser(description="对一套或几套边界做逐年的夜间灯光分区统计")
+    parser.add_argument("--layers", nargs="*", default=list(BOUNDARY_LAYERS), choices=list(BOUNDARY_LAYERS),
+                        help="内置的边界，默认省级和市级都算")
+    parser.add_argument("--boundary", action="append", default=[], type=parse_boundary,
+                        help="额外的边界，写成 名字=shapefile路径，可以写多次")
+    parser.add_argument("--stats", nargs="+", default=list(DEFAULT_STATS), type=parse_stat,
+                        help="统计量：mean sum count min max std lit_area，百分位写成p50、p90")
+    parser.add_argument("--lit-threshold", type=float, default=LIT_THRESHOLD,
+                        help="值大于这个数的像元算有灯光，用于lit_area")
+    parser.add_argument("--years", nargs="+", default=None, help="只重新统计这几年")
+    parser.add_argument("--tile-budget-mb", type=float, default=tile_budget_mb)
+    parser.add_argument("--tif-pattern", default=tif_pattern)
+    args = parser.parse_args()
+    if args.lit_threshold < 0:
+        parser.error("--lit-threshold不能小于0")
+
+    layers = [BoundaryLayer(name, BOUNDARY_LAYERS[name].shp_path, BOUNDARY_LAYERS[name].output_dir, args.stats,
+                            lit_threshold=args.lit_threshold)
+              for name in args.layers]
+    layers += [BoundaryLayer(name, shp_path, stats=args.stats, lit_threshold=args.lit_threshold)
+               for name, shp_path in args.boundary]
+    results = run(layers, tile_budget_mb=args.tile_budget_mb, years=args.years, tif_pattern=args.tif_pattern)
+    for name, yearly_stats in results.items():
+        print(f"{name}: 统计了{len(yearly_stats)}年")
+
+
+if __name__ == "__main__":
+    main()
+    metrics.dump_if_requested()